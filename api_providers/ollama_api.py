@@ -1,63 +1,187 @@
-from flask import Flask, request, jsonify
-import base64
-from PIL import Image
-import io
+from flask import Flask, request, jsonify, Response
+import asyncio
+import os
+import queue
+import sys
+import threading
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from image_utils import resize_and_encode_image
+from metrics import ERRORS, QUEUE_DEPTH, instrument_app, record_generation, timed
+from transport import read_caption_request
+
+try:
+    import ollama
+except ImportError as e:
+    print('Please install Ollama library first.')
+
+
+'''
+Async Ollama backend.
+
+- One persistent ollama.AsyncClient (one connection pool) running on a background event loop, shared by all Flask threads.
+- `keep_alive` keeps the model loaded in VRAM between requests, so Ollama doesn't reload it after 5 minutes idle.
+- Up to `num_parallel` chats are in flight at the same time. Match it with OLLAMA_NUM_PARALLEL of the Ollama server.
+- Send {"stream": true} to /caption to receive the caption as plain text while it's being generated.
+
+Set OLLAMA_HOST to point it at another Ollama server (or a local stub server for testing).
+'''
 
 app = Flask(__name__)
+instrument_app(app)
 
-def resize_and_encode_image(image_path, max_size=1024):
-    with Image.open(image_path) as img:
-        # 获取原始尺寸
-        original_width, original_height = img.size
-
-        # 计算调整后的尺寸，保持宽高比
-        if max(original_width, original_height) > max_size:
-            if original_width > original_height:
-                new_width = max_size
-                new_height = int((new_width / original_width) * original_height)
-            else:
-                new_height = max_size
-                new_width = int((new_height / original_height) * original_width)
-            
-            # 调整图像大小
-            img = img.resize((new_width, new_height), Image.BICUBIC)
-            img = img.convert('RGB')
-
-        # 将图像转为字节流
-        img_byte_array = io.BytesIO()
-        img.save(img_byte_array, format='PNG')  
-        img_byte_array = img_byte_array.getvalue()
-
-    # 将字节流编码为base64
-    image_base64 = base64.b64encode(img_byte_array).decode('utf-8')
-    return image_base64
-
-def perform_caption(prompt:str, image:str, model='llama3.2-vision:11b-instruct-q8_0'):
-    image_base64 = resize_and_encode_image(image)
-    try:
-        response = ollama.chat(
-            model=model,
-            messages=[{
-                'role': 'user',
-                'content': prompt,
-                'images': [f'{image_base64}']
-            }]
-        )
+_STREAM_END = object()
+
+
+class OllamaBackend:
+    def __init__(self, host: str = None, model: str = 'llama3.2-vision:11b-instruct-q8_0', keep_alive='30m',
+                 num_parallel: int = 4):
+        self.host = host
+        self.model = model
+        self.keep_alive = keep_alive
+        self.num_parallel = num_parallel
+        self.waiting = 0 # Chats waiting for a free slot.
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+        # The client and the semaphore must be created on the loop they are used on.
+        self.run(self._setup())
+
+    async def _setup(self):
+        self.client = ollama.AsyncClient(host=self.host)
+        self.semaphore = asyncio.Semaphore(self.num_parallel)
+
+    def run(self, coroutine, timeout: float = None):
+        # Called from Flask threads: run `coroutine` on the backend loop and wait for its result.
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def build_messages(self, prompt: str, image, system: str = None) -> list:
+        # Called in the Flask thread, so encoding the image doesn't block the event loop.
+        messages = [{
+            'role': 'user',
+            'content': prompt,
+            'images': [resize_and_encode_image(image)]
+        }]
+        if system:
+            # Ollama reuses the KV cache of the prompt prefix it has already evaluated, a shared system turn included.
+            messages.insert(0, {'role': 'system', 'content': system})
+        return messages
+
+    async def warm_up(self):
+        # A chat without messages only loads the model (and keeps it loaded for `keep_alive`).
+        await self.client.chat(model=self.model, messages=[], keep_alive=self.keep_alive)
+
+    async def _acquire(self):
+        # Only touched on the loop thread, no lock needed.
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+    @staticmethod
+    def _record_generation(response):
+        # The final response of a chat has the generated token count and the generation time in ns.
+        if response.get('eval_count'):
+            record_generation(response['eval_count'], (response.get('eval_duration') or 0) / 1e9)
+
+    async def caption(self, messages: list) -> str:
+        await self._acquire()
+        try:
+            response = await self.client.chat(model=self.model, messages=messages, keep_alive=self.keep_alive)
+        finally:
+            self.semaphore.release()
+        self._record_generation(response)
         return response['message']['content']
+
+    async def caption_stream(self, messages: list, chunks: queue.Queue, cancelled: threading.Event = None):
+        # cancelled: Set when the client has gone away. The chat is stopped and its slot released.
+        try:
+            await self._acquire()
+            try:
+                if cancelled is not None and cancelled.is_set():
+                    return
+                stream = await self.client.chat(model=self.model, messages=messages, keep_alive=self.keep_alive, stream=True)
+                try:
+                    async for part in stream:
+                        if cancelled is not None and cancelled.is_set():
+                            break
+                        chunks.put(part['message']['content'])
+                        if part.get('done'):
+                            self._record_generation(part)
+                finally:
+                    # Closes the response, so Ollama stops generating for nobody.
+                    await stream.aclose()
+            finally:
+                self.semaphore.release()
+        except Exception as e:
+            chunks.put(e)
+        finally:
+            chunks.put(_STREAM_END)
+
+
+def perform_caption(prompt:str, image:str, system:str=None):
+    try:
+        with timed('image_load'):
+            messages = backend.build_messages(prompt, image, system)
+        with timed('generate'):
+            return backend.run(backend.caption(messages))
     except Exception as e:
         print(f'Error: {e}')
         return None
 
+def stream_caption(prompt:str, image:str, system:str=None):
+    chunks = queue.Queue()
+    with timed('image_load'):
+        messages = backend.build_messages(prompt, image, system)
+    cancelled = threading.Event()
+    asyncio.run_coroutine_threadsafe(backend.caption_stream(messages, chunks, cancelled), backend.loop)
+    try:
+        with timed('generate'):
+            while True:
+                chunk = chunks.get()
+                if chunk is _STREAM_END:
+                    return
+                if isinstance(chunk, Exception):
+                    ERRORS.inc(stage='generate', error=type(chunk).__name__)
+                    print(f'Error: {chunk}')
+                    return
+                yield chunk
+    finally:
+        # Also runs when the client disconnects mid-stream and Flask closes this generator.
+        cancelled.set()
+
 @app.route('/caption', methods=['POST'])
 def api():
-    try:
-        import ollama
-    except ImportError as e:
-        print('Please install Ollama library first.')
-    data = request.json
-    
+    # json, multipart or shared memory, see transport.py.
+    data = read_caption_request(request)
+
     prompt = data.get("prompt")
     image = data.get("image")
-    
-    caption = perform_caption(prompt, image)
-    return jsonify({"caption": caption[0]})
\ No newline at end of file
+    system = data.get("system")
+
+    if data.get("stream"):
+        return Response(stream_caption(prompt, image, system), mimetype='text/plain')
+
+    caption = perform_caption(prompt, image, system)
+    if caption is None:
+        return jsonify({"error": "Failed to caption the image."}), 500
+    with timed('serialize'):
+        return jsonify({"caption": caption})
+
+@app.route('/health', methods=['GET'])
+def health():
+    # For load_balancer.py: the server is up and its model is loaded (the route is only served once it is).
+    return jsonify({"status": "ok"})
+
+if __name__ == "__main__":
+    ollama_host = os.environ.get('OLLAMA_HOST', 'http://127.0.0.1:11434')
+    model = 'llama3.2-vision:11b-instruct-q8_0'
+    keep_alive = '30m' # How long the model stays loaded after the last request. -1 keeps it loaded forever.
+    num_parallel = int(os.environ.get('OLLAMA_NUM_PARALLEL', 4)) # Concurrent chats. Should match the Ollama server.
+
+    backend = OllamaBackend(ollama_host, model, keep_alive, num_parallel)
+    QUEUE_DEPTH.set_function(lambda: backend.waiting)
+    backend.run(backend.warm_up())
+    app.run(port=5090, threaded=True)
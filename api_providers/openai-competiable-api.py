@@ -1,88 +1,277 @@
-from flask import Flask, request, jsonify
-from PIL import Image
-from urllib3.util.retry import Retry
-from requests.adapters import HTTPAdapter
-import requests
-import base64
-import io
-
-app = Flask(__name__)
-
-def resize_and_encode_image(image_path, max_size=1024):
-    with Image.open(image_path) as img:
-        original_width, original_height = img.size
-
-        if max(original_width, original_height) > max_size:
-            if original_width > original_height:
-                new_width = max_size
-                new_height = int((new_width / original_width) * original_height)
-            else:
-                new_height = max_size
-                new_width = int((new_height / original_height) * original_width)
-
-            img = img.resize((new_width, new_height), Image.BICUBIC)
-            img = img.convert('RGB')
-
-        img_byte_array = io.BytesIO()
-        img.save(img_byte_array, format='PNG')  
-        img_byte_array = img_byte_array.getvalue()
-
-    image_base64 = base64.b64encode(img_byte_array).decode('utf-8')
-    return image_base64
-
-def perform_caption(model:str, prompt:str, image:Image.Image) -> str:
-
-    image_base64 = resize_and_encode_image(image)
-    data = {
-        "model": model, 
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "image_url", "image_url": {"url": "data:image/png;base64," + image_base64}},
-                    {"type": "text", "text": prompt}
-                ]
-            }
-        ],
-        "temperature": 0.3,
-        "max_tokens": 4096
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector, web
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from http_client import RETRY_STATUS, HTTPClientError, backoff_delay
+from image_utils import image_to_data_url
+from metrics import ERRORS, GENERATED_TOKENS, instrument_aiohttp_app, timed
+from rate_limiter import RateLimiter, data_url_size
+from transport import read_caption_request_async
+
+
+'''
+Async proxy from our /caption api to OpenAI compatible chat completion apis (OpenAI, OpenRouter, Mistral, a local vLLM...).
+
+A remote api is latency bound, not compute bound: throughput comes from having many requests in flight.
+- One aiohttp server, no worker thread blocked per request while the upstream is generating.
+- One shared upstream connection pool (keep-alive), `--pool-size` connections at most.
+- Retries on 429/5xx with jittered backoff, honouring Retry-After.
+- Optional per backend RPM/TPM quotas ("rpm", "tpm" in the config, see rate_limiter.py): requests are queued to stay
+  right at the quota, instead of hitting 429s and backing off.
+- Per request backend and model: {"prompt": ..., "image": ..., "backend": "openrouter", "model": "..."}.
+  Without them the default backend and its default model are used.
+- {"stream": true} streams the caption back as plain text while the upstream generates it.
+
+Backends and api keys come from a json config (--config), or the defaults below with the keys from the environment:
+    {
+        "default_backend": "openrouter",
+        "backends": {
+            "openrouter": {"url": "https://openrouter.ai/api/v1/chat/completions", "api_key_env": "OPENROUTER_API_KEY",
+                           "model": "meta-llama/llama-3.2-11b-vision-instruct", "max_in_flight": 64,
+                           "rpm": 200, "tpm": 400000},
+            "local": {"url": "http://127.0.0.1:8000/v1/chat/completions", "model": "Qwen2-VL-7B-Instruct"}
+        }
     }
 
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {gpt_api_key if 'gpt' in model else mistral_api_key}"}
-    
-    retries = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["HEAD", "GET", "OPTIONS", "POST"])
+Try it against a local fake upstream:
+    python benchmarks/fake_openai_upstream.py --port 8000
+    python api_providers/openai-competiable-api.py --config local.json
+'''
+
+DEFAULT_CONFIG = {
+    'default_backend': 'openai',
+    'backends': {
+        'openai': {'url': 'https://api.openai.com/v1/chat/completions', 'api_key_env': 'OPENAI_API_KEY',
+                   'model': 'gpt-4o'}, # gpt-4o-mini, pixtral-12b (free) or llama-3.2-vision-11b (via openrouter) will be more suitable for this task
+        'openrouter': {'url': 'https://openrouter.ai/api/v1/chat/completions', 'api_key_env': 'OPENROUTER_API_KEY',
+                       'model': 'meta-llama/llama-3.2-11b-vision-instruct'},
+        'mistral': {'url': 'https://api.mistral.ai/v1/chat/completions', 'api_key_env': 'MISTRAL_API_KEY',
+                    'model': 'pixtral-12b-2409'},
+    },
+}
+
+
+class Backend:
+    def __init__(self, name: str, url: str, model: str, api_key: str = None, api_key_env: str = None,
+                 max_in_flight: int = 64, rpm: float = None, tpm: float = None):
+        self.name = name
+        self.url = url
+        self.model = model
+        self.api_key = api_key or (os.environ.get(api_key_env) if api_key_env else None)
+        if self.api_key is None and api_key_env:
+            print(f'{api_key_env} is not set, requests to {name} are sent without an api key.')
+        # Upstream requests in flight to this backend. Requests beyond that wait here, not at the upstream.
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.limiter = RateLimiter(rpm, tpm, name=name)
+
+    @property
+    def headers(self) -> dict:
+        return {'Authorization': f'Bearer {self.api_key}'} if self.api_key else {}
+
+
+def load_config(config_path: str = None) -> dict:
+    if config_path is None:
+        return DEFAULT_CONFIG
+    with open(config_path, 'r') as f:
+        return json.load(f)
+
+
+def _prepare_image(image):
+    # Runs in the executor: the data url sent upstream, and its size (from the header) for the rate limit cost.
+    image_data_url = image_to_data_url(image)
+    return image_data_url, data_url_size(image_data_url) or (1024, 1024)
+
+
+def _retry_after(response) -> float:
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class Proxy:
+    def __init__(self, config: dict, pool_size: int = 256, retries: int = 5, backoff_factor: float = 1.0,
+                 timeout: float = 180, connect_timeout: float = 10, temperature: float = 0.3, max_tokens: int = 4096):
+        '''
+        pool_size: Upstream connections kept open, i.e. max upstream requests in flight across all backends.
+        timeout: Seconds an upstream request may take in total. connect_timeout: Seconds to connect.
+        '''
+        self.backends = {name: Backend(name, **backend) for name, backend in config['backends'].items()}
+        self.default_backend = config.get('default_backend') or next(iter(self.backends))
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = ClientTimeout(total=timeout, sock_connect=connect_timeout)
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.session = None
+
+    async def start(self, app):
+        self.session = ClientSession(connector=TCPConnector(limit=self.pool_size, ttl_dns_cache=300), timeout=self.timeout)
+
+    async def close(self, app):
+        await self.session.close()
+
+    def resolve(self, data: dict):
+        name = data.get('backend') or self.default_backend
+        if name not in self.backends:
+            raise ValueError(f'Unknown backend {name}, use one of {", ".join(self.backends)}.')
+        backend = self.backends[name]
+        return backend, data.get('model') or backend.model
+
+    async def build_payload(self, data: dict, model: str, stream: bool) -> tuple:
+        # Returns (payload, image size for the rate limiter's estimate).
+        # Encoding is CPU bound, keep it off the event loop. A data url from the client is passed through.
+        with timed('image_load'):
+            image_data_url, image_size = await asyncio.get_running_loop().run_in_executor(None, _prepare_image, data.get('image'))
+        payload = {
+            "model": model,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "image_url", "image_url": {"url": image_data_url}},
+                        {"type": "text", "text": data.get('prompt')}
+                    ]
+                }
+            ],
+            "temperature": data.get('temperature', self.temperature),
+            "max_tokens": data.get('max_tokens', self.max_tokens),
+        }
+        if data.get('system'):
+            payload['messages'].insert(0, {"role": "system", "content": data['system']})
+        if stream:
+            payload['stream'] = True
+        return payload, image_size
+
+    async def send(self, backend: Backend, payload: dict, cost: int = 0):
+        # Returns the upstream response, which the caller must release (async with). Retries 429/5xx and connection errors.
+        # cost: Estimated tokens of the request, taken from the backend's rate limit budget once. A retry takes a request
+        # slot, not the tokens again: a rejected request used none, and record_usage only corrects the first charge.
+        for attempt in range(self.retries + 1):
+            await backend.limiter.acquire(cost if attempt == 0 else 0)
+            try:
+                response = await self.session.post(backend.url, json=payload, headers=backend.headers)
+            except (ClientError, asyncio.TimeoutError) as e:
+                if attempt >= self.retries:
+                    raise HTTPClientError(f'Request to {backend.name} failed: {e!r}') from e
+                await asyncio.sleep(backoff_delay(attempt, self.backoff_factor))
+                continue
+
+            backend.limiter.update_from_headers(response.headers)
+            if response.status == 429:
+                # Pauses every request to this backend, not only this one.
+                backend.limiter.on_rate_limited(_retry_after(response))
+            if response.status in RETRY_STATUS and attempt < self.retries:
+                delay = _retry_after(response) or backoff_delay(attempt, self.backoff_factor)
+                response.release()
+                await asyncio.sleep(delay)
+                continue
+            return response
+
+    async def caption(self, request: web.Request) -> web.StreamResponse:
+        '''
+        {
+            "prompt": 'Describe this image.',
+            "image": image path, data url or shm:// url (or a multipart/form-data request, see transport.py),
+            "system": optional, "backend": optional, "model": optional, "stream": optional
+        }
+        '''
+        data = await read_caption_request_async(request)
+        try:
+            backend, model = self.resolve(data)
+        except ValueError as e:
+            return web.json_response({"error": str(e)}, status=400)
+        stream = bool(data.get('stream'))
 
-    with requests.Session() as s:
-        s.mount('https://', HTTPAdapter(max_retries=retries))
         try:
-            response = s.post(api_url, headers=headers, json=data, timeout=180)
-            response.raise_for_status()
-            response_data = response.json()
-            if 'error' in response_data:
-                return False, f"API error: {response_data['error']['message']}"
-            return True, response_data["choices"][0]["message"]["content"]
-        except requests.exceptions.RequestException as e:
-            return False, f"API error: {e}"
-
-    
-    return output_text
-    
-@app.route('/caption', methods=['POST'])
-def api():
-    data = request.json
-    
-    prompt = data.get("prompt")
-    image = data.get("image")
-    model = 'gpt-4o' # gpt-4o-mini, pixtral-12b (free) or llama-3.2-vision-11b (via openrouter) will be more suitable for this task
-    
-    status, caption = perform_caption(model, prompt, image)
-    if status:
-        return jsonify({"caption": caption})
-    else:
-        return jsonify({"error": caption}), 500
+            payload, image_size = await self.build_payload(data, model, stream)
+        except Exception as e:
+            return web.json_response({"error": f"Failed to read the image: {e}"}, status=400)
+
+        text = (data.get('system') or '') + (data.get('prompt') or '')
+        cost = backend.limiter.estimate(text, max_tokens=payload['max_tokens'], image_size=image_size)
+        async with backend.semaphore:
+            with timed('generate'):
+                try:
+                    response = await self.send(backend, payload, cost)
+                except HTTPClientError as e:
+                    return web.json_response({"error": f"API error: {e}"}, status=502)
+
+                async with response:
+                    if response.status != 200:
+                        ERRORS.inc(stage='generate', error=f'HTTP{response.status}')
+                        text = await response.text()
+                        # 4xx (bad request, rate limited...) are passed on as they are, so the client sees why.
+                        status = response.status if response.status < 500 else 502
+                        return web.json_response({"error": f"API error: {backend.name} returned {response.status}: {text[:200]}"},
+                                                 status=status)
+                    if stream:
+                        return await self._stream(request, response, backend, cost)
+                    response_data = await response.json()
+
+        if 'error' in response_data:
+            ERRORS.inc(stage='generate', error='APIError')
+            return web.json_response({"error": f"API error: {response_data['error'].get('message')}"}, status=502)
+        GENERATED_TOKENS.inc((response_data.get('usage') or {}).get('completion_tokens', 0))
+        backend.limiter.record_usage(cost, response_data.get('usage'))
+        with timed('serialize'):
+            return web.json_response({"caption": response_data["choices"][0]["message"]["content"]})
+
+    async def _stream(self, request: web.Request, response, backend: Backend, cost: int) -> web.StreamResponse:
+        # Upstream server-sent events -> the plain text of the caption, chunk by chunk.
+        output = web.StreamResponse(headers={'Content-Type': 'text/plain; charset=utf-8'})
+        await output.prepare(request)
+        async for line in response.content:
+            line = line.decode('utf-8').strip()
+            if not line.startswith('data:'):
+                continue
+            event = line[len('data:'):].strip()
+            if event == '[DONE]':
+                break
+            event = json.loads(event)
+            if event.get('usage'):
+                GENERATED_TOKENS.inc(event['usage'].get('completion_tokens', 0))
+                backend.limiter.record_usage(cost, event['usage'])
+            for choice in event.get('choices', []):
+                content = (choice.get('delta') or {}).get('content')
+                if content:
+                    await output.write(content.encode('utf-8'))
+        await output.write_eof()
+        return output
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok", "backends": list(self.backends), "default_backend": self.default_backend})
+
+
+def create_app(proxy: Proxy) -> web.Application:
+    app = web.Application(client_max_size=64 * 1024 * 1024) # Data urls of large images.
+    instrument_aiohttp_app(app)
+    app.router.add_post('/caption', proxy.caption, name='caption')
+    app.router.add_get('/health', proxy.health, name='health')
+    app.on_startup.append(proxy.start)
+    app.on_cleanup.append(proxy.close)
+    return app
+
 
 if __name__ == "__main__":
-    api_url = 'http://api.openai.com/v1/chat/completions' # 'https://openrouter.ai/api/v1/chat/completions' or 'https://api.mistral.ai/v1/chat/completions'
-    gpt_api_key = 'sk-1145141919810' # If you use openrouter, replace this to your api key.
-    mistral_api_key = 'sk-1145141919810' 
-    app.run(port=5000)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Async proxy to OpenAI compatible apis.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--config', default=None, help='Json file with the backends. Defaults to OpenAI/OpenRouter/Mistral.')
+    parser.add_argument('--default-backend', default=None, help='Overrides default_backend of the config.')
+    parser.add_argument('--pool-size', type=int, default=256, help='Max upstream connections (requests in flight).')
+    parser.add_argument('--retries', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=180, help='Seconds an upstream request may take.')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    if args.default_backend:
+        config = {**config, 'default_backend': args.default_backend}
+    proxy = Proxy(config, pool_size=args.pool_size, retries=args.retries, timeout=args.timeout)
+    web.run_app(create_app(proxy), host=args.host, port=args.port, access_log=None)
@@ -3,10 +3,20 @@ from transformers import AutoModelForCausalLM, AutoProcessor
 from transformers.dynamic_module_utils import get_imports
 import torch
 import os
-from PIL import Image
+import sys
+import time
+from functools import lru_cache
 from unittest.mock import patch
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from image_utils import load_image
+from metrics import BATCH_SIZE, QUEUE_DEPTH, instrument_app, record_generation, timed
+from micro_batcher import MicroBatcher
+from prefix_cache import PrefixCache
+from transport import read_caption_request, resolve_image
+
 app = Flask(__name__)
+instrument_app(app)
 
 def model_loader():
     repo_name = "./phi-3.5-vision-instruct"
@@ -21,43 +31,147 @@ def model_loader():
     return model, processor
 
 
-def perform_caption(text, image_path):
+def collate_inputs(batch_inputs:list) -> dict:
+    # Phi-3.5's processor handles one prompt at a time. Left pad the prompts and stack the images ourselves.
+    pad_token_id = processor.tokenizer.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = processor.tokenizer.eos_token_id
+    max_length = max(inputs['input_ids'].shape[1] for inputs in batch_inputs)
+
+    input_ids, attention_mask = [], []
+    for inputs in batch_inputs:
+        padding = max_length - inputs['input_ids'].shape[1]
+        input_ids.append(torch.nn.functional.pad(inputs['input_ids'], (padding, 0), value=pad_token_id))
+        attention_mask.append(torch.nn.functional.pad(inputs['attention_mask'], (padding, 0), value=0))
+
+    return {
+        'input_ids': torch.cat(input_ids),
+        'attention_mask': torch.cat(attention_mask),
+        'pixel_values': torch.cat([inputs['pixel_values'] for inputs in batch_inputs]),
+        'image_sizes': torch.cat([inputs['image_sizes'] for inputs in batch_inputs]),
+    }
+
+
+def build_prompt(text:str, system:str=None) -> str:
     prompt = f"{user_prompt}<|image_1|>\n{text}{prompt_suffix}{assistant_prompt}"
-    image = Image.open(image_path).convert("RGB")
-
-    inputs = processor(prompt, image, return_tensors="pt").to("cuda:0")
-    generate_ids = model.generate(**inputs,
-                                  max_new_tokens=1000,
-                                  eos_token_id=processor.tokenizer.eos_token_id,
-                                  )
-    generate_ids = generate_ids[:, inputs['input_ids'].shape[1]:]
-    response = processor.batch_decode(generate_ids,
-                                      skip_special_tokens=True,
-                                      clean_up_tokenization_spaces=False)[0]
+    if system:
+        prompt = f"{system_prompt}{system}{prompt_suffix}{prompt}"
+    return prompt
+
+
+@lru_cache(maxsize=16)
+def prefix_ids(system:str) -> torch.Tensor:
+    # Everything in front of the image: the system turn and the user tag. The processor tokenizes it the same way.
+    return processor.tokenizer(f"{system_prompt}{system}{prompt_suffix}{user_prompt}", return_tensors="pt").input_ids[0]
+
+
+def perform_caption_batch(items:list) -> list:
+    # items: [(prompt, image, system), ...]. One padded, batched generate for all of them.
+    BATCH_SIZE.observe(len(items))
+    # The system turn's KV cache is reused if the whole batch shares it (see prefix_cache.py).
+    systems = {system for _, _, system in items}
+    shared_system = systems.pop() if len(systems) == 1 else None
+    batch_inputs = []
+    for text, image, system in items:
+        prompt = build_prompt(text, system)
+        # Phi-3.5's processor tokenizes the prompt and preprocesses the image in one call.
+        with timed('preprocess'):
+            batch_inputs.append(processor(prompt, image, return_tensors="pt"))
+
+    with timed('preprocess'):
+        inputs = {key: value.to("cuda:0") for key, value in collate_inputs(batch_inputs).items()}
+    with timed('generate'):
+        start = time.perf_counter()
+        generate_ids = prefix_cache.generate(inputs,
+                                             prefix_ids(shared_system) if shared_system else None,
+                                             max_new_tokens=1000,
+                                             eos_token_id=processor.tokenizer.eos_token_id,
+                                             )
+        generate_ids = generate_ids[:, inputs['input_ids'].shape[1]:]
+        # Shorter captions are padded up to the longest one in the batch, padding isn't generated.
+        pad_token_id = processor.tokenizer.pad_token_id
+        tokens = int((generate_ids != (pad_token_id if pad_token_id is not None else processor.tokenizer.eos_token_id)).sum())
+        record_generation(tokens, time.perf_counter() - start)
+    with timed('decode'):
+        response = processor.batch_decode(generate_ids,
+                                          skip_special_tokens=True,
+                                          clean_up_tokenization_spaces=False)
 
     
     return response
+
+
+def prepare_image(image):
+    # image: a path, a data url or the image bytes. Decoded in the request's own thread, before it's queued: a bad
+    # image fails only its request (400), and decoding runs in parallel instead of in front of the batched generate.
+    return load_image(image, max_size=None).convert("RGB")
+
+
+def perform_caption(text, image, system=None):
+    # image: prepared by prepare_image.
+    return perform_caption_batch([(text, image, system)])[0]
     
 @app.route('/caption', methods=['POST'])
 def api():
-    data = request.json
+    # json, multipart or shared memory, see transport.py.
+    data = read_caption_request(request)
     
     prompt = data.get("prompt")
-    image = data.get("image")
+    system = data.get("system")
+    try:
+        with timed('image_load'):
+            image = prepare_image(data.get("image"))
+    except Exception as e:
+        return jsonify({"error": f"Failed to read the image: {e}"}), 400
     
-    caption = perform_caption(prompt, image)
+    # Concurrent requests are merged into one batched generate by the batcher.
+    caption = batcher.submit((prompt, image, system))
+
+    with timed('serialize'):
+        return jsonify({"caption": caption})
 
-    return jsonify({"caption": caption})
+@app.route('/caption_batch', methods=['POST'])
+def api_batch():
+    '''
+    {
+        "items": [{"prompt": 'Describe this image.', "image": image path, data url or shm:// url, "system": optional}, ...]
+    }
+    '''
+    data = request.json
+
+    try:
+        with timed('image_load'):
+            items = [(item.get("prompt"), prepare_image(resolve_image(item.get("image"))), item.get("system"))
+                     for item in data.get("items", [])]
+    except Exception as e:
+        return jsonify({"error": f"Failed to read an image: {e}"}), 400
+
+    captions = batcher.submit_many(items)
+    with timed('serialize'):
+        return jsonify({"captions": captions})
+
+@app.route('/health', methods=['GET'])
+def health():
+    # For load_balancer.py: the server is up and its model is loaded (the route is only served once it is).
+    return jsonify({"status": "ok"})
 
 if __name__ == "__main__":
     kwargs = {}
     kwargs['torch_dtype'] = torch.bfloat16
 
+    system_prompt = '<|system|>\n'
     user_prompt = '<|user|>\n'
     assistant_prompt = '<|assistant|>\n'
     prompt_suffix = "<|end|>\n"
 
+    max_batch_size = 8 # Max requests in one generate. Lower it if you run out of VRAM.
+    max_batch_wait = 0.05 # Seconds to wait for more requests before running a batch.
+
     model, processor = model_loader()
+    # Reuse the KV cache of a shared system turn (see prefix_cache.py). Off by default: only checked on tiny CPU
+    # models, not with the Phi-3.5-vision remote code. PREFIX_CACHE=1 turns it on.
+    prefix_cache = PrefixCache(model, enabled=os.environ.get('PREFIX_CACHE', '0') == '1')
+    batcher = MicroBatcher(perform_caption_batch, max_batch_size=max_batch_size, max_wait=max_batch_wait)
+    QUEUE_DEPTH.set_function(lambda: batcher.queue_depth)
 
-    app.run(port=5000)
-    
\ No newline at end of file
+    app.run(port=5000, threaded=True)
@@ -4,10 +4,23 @@ import torch.nn.functional as F
 from transformers import Qwen2VLForConditionalGeneration, AutoTokenizer, AutoProcessor
 from qwen_vl_utils import process_vision_info
 from PIL import Image
-import base64
-import io
+import os
+import sys
+import time
+from functools import lru_cache
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from image_utils import load_image
+from metrics import BATCH_SIZE, QUEUE_DEPTH, REGISTRY, instrument_app, record_generation, timed
+from micro_batcher import MicroBatcher
+from prefix_cache import PrefixCache
+from transport import read_caption_request, resolve_image
+from visual_budget import DEFAULT_MAX_PIXELS, DEFAULT_MIN_PIXELS, FACTOR, fit_to_budget
 
 app = Flask(__name__)
+instrument_app(app)
+VISUAL_TOKENS = REGISTRY.histogram('visual_tokens', 'Visual tokens per image.',
+                                   buckets=(64, 128, 256, 384, 512, 768, 1024, 1280, 1536, 2048, 4096))
 
 def model_loader():
     repo_name = "./Qwen2-VL-7B-Instruct-AWQ"
@@ -15,78 +28,143 @@ def model_loader():
     
     model = Qwen2VLForConditionalGeneration.from_pretrained(repo_name, **arguments)
     
-    processor = AutoProcessor.from_pretrained(repo_name, **arguments)
+    # The same budget as prepare_image, so the processor never resizes the images again.
+    processor = AutoProcessor.from_pretrained(repo_name, min_pixels=min_pixels, max_pixels=max_pixels, **arguments)
+    # Batched generate needs left padding, so every prompt ends right before the generated tokens.
+    processor.tokenizer.padding_side = 'left'
 
     return processor, model
 
-def resize_and_encode_image(image_path, max_size=1024):
-    with Image.open(image_path) as img:
-        # 获取原始尺寸
-        original_width, original_height = img.size
-
-        # 计算调整后的尺寸，保持宽高比
-        if max(original_width, original_height) > max_size:
-            if original_width > original_height:
-                new_width = max_size
-                new_height = int((new_width / original_width) * original_height)
-            else:
-                new_height = max_size
-                new_width = int((new_height / original_height) * original_width)
-            
-            # 调整图像大小
-            img = img.resize((new_width, new_height), Image.BICUBIC)
-            img = img.convert('RGB')
-
-        # 将图像转为字节流
-        img_byte_array = io.BytesIO()
-        img.save(img_byte_array, format='PNG')  
-        img_byte_array = img_byte_array.getvalue()
-
-    # 将字节流编码为base64
-    image_base64 = base64.b64encode(img_byte_array).decode('utf-8')
-    return image_base64
-
-def perform_caption(prompt:str, image:Image.Image) -> str:
-
-    image_base64 = resize_and_encode_image(image)
+def prepare_image(image) -> Image.Image:
+    # image: a path, a data url or the image bytes. Decoded in the request's own thread, before it's queued: a bad
+    # image fails only its request (400), and decoding runs in parallel instead of in front of the batched generate.
+    # qwen_vl_utils then gets a PIL image instead of a data url it would have to decode again.
+    # Resized to the visual token budget (see visual_budget.py): one token per 28x28 pixels, between
+    # min_pixels and max_pixels per image, whatever the client sent.
+    image = fit_to_budget(load_image(image, max_size=None), min_pixels, max_pixels)
+    image.load()
+    VISUAL_TOKENS.observe((image.width // FACTOR) * (image.height // FACTOR))
+    return image
 
+def build_messages(prompt:str, image:Image.Image, system:str=None) -> list:
+    # image: prepared by prepare_image.
     messages = [
         {
             "role": "user",
             "content": [
                 {
                     "type": "image",
-                    "image": "data:image/png;base64," + image_base64,
+                    "image": image,
+                    # Already a multiple of 28 within the budget, so qwen_vl_utils keeps it as it is.
+                    "resized_width": image.width,
+                    "resized_height": image.height,
                 },
                 {"type": "text", "text": prompt},
             ],
         }
     ]
+    if system:
+        # In front of the image, so it's a prefix shared by every request.
+        messages.insert(0, {"role": "system", "content": system})
+    return messages
 
-    text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    image_inputs, video_inputs = process_vision_info(messages)
-    inputs = processor(text=[text],images=image_inputs,videos=video_inputs,padding=True,return_tensors="pt")
-    inputs = inputs.to("cuda")
-    generated_ids = model.generate(**inputs, max_new_tokens=512)
-    generated_ids_trimmed = [
-        out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-    ]
-    output_text = processor.batch_decode(
-        generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
-    )
+@lru_cache(maxsize=16)
+def prefix_ids(system:str) -> torch.Tensor:
+    # The system turn, tokenized the same way as at the start of a whole prompt.
+    text = processor.apply_chat_template([{"role": "system", "content": system}], tokenize=False)
+    return processor.tokenizer(text, return_tensors="pt").input_ids[0]
+
+def perform_caption_batch(items:list) -> list:
+    # items: [(prompt, image, system), ...]. One padded, batched generate for all of them.
+    BATCH_SIZE.observe(len(items))
+    # The system turn's KV cache is reused if the whole batch shares it (see prefix_cache.py).
+    systems = {system for _, _, system in items}
+    shared_system = systems.pop() if len(systems) == 1 else None
+    with timed('preprocess'):
+        batch_messages = [build_messages(prompt, image, system) for prompt, image, system in items]
+        image_inputs, video_inputs = process_vision_info(batch_messages)
+
+    with timed('tokenize'):
+        texts = [processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True) for messages in batch_messages]
+    with timed('preprocess'):
+        inputs = processor(text=texts,images=image_inputs,videos=video_inputs,padding=True,return_tensors="pt")
+        inputs = inputs.to("cuda")
+
+    with timed('generate'):
+        start = time.perf_counter()
+        generated_ids = prefix_cache.generate(inputs, prefix_ids(shared_system) if shared_system else None, max_new_tokens=512)
+        generated_ids_trimmed = [
+            out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
+        ]
+        # Shorter captions are padded up to the longest one in the batch, padding isn't generated.
+        tokens = sum(int((ids != processor.tokenizer.pad_token_id).sum()) for ids in generated_ids_trimmed)
+        record_generation(tokens, time.perf_counter() - start)
+
+    with timed('decode'):
+        output_text = processor.batch_decode(
+            generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )
     
     return output_text
+
+def perform_caption(prompt:str, image:Image.Image, system:str=None) -> str:
+    # image: prepared by prepare_image.
+    return perform_caption_batch([(prompt, image, system)])[0]
     
 @app.route('/caption', methods=['POST'])
 def api():
-    data = request.json
+    # json, multipart or shared memory, see transport.py.
+    data = read_caption_request(request)
     
     prompt = data.get("prompt")
-    image = data.get("image")
+    system = data.get("system")
+    try:
+        with timed('image_load'):
+            image = prepare_image(data.get("image"))
+    except Exception as e:
+        return jsonify({"error": f"Failed to read the image: {e}"}), 400
     
-    caption = perform_caption(prompt, image)
-    return jsonify({"caption": caption[0]})
+    # Concurrent requests are merged into one batched generate by the batcher.
+    caption = batcher.submit((prompt, image, system))
+    with timed('serialize'):
+        return jsonify({"caption": caption})
+
+@app.route('/caption_batch', methods=['POST'])
+def api_batch():
+    '''
+    {
+        "items": [{"prompt": 'Describe this image.', "image": image path, data url or shm:// url, "system": optional}, ...]
+    }
+    '''
+    data = request.json
+
+    try:
+        with timed('image_load'):
+            items = [(item.get("prompt"), prepare_image(resolve_image(item.get("image"))), item.get("system"))
+                     for item in data.get("items", [])]
+    except Exception as e:
+        return jsonify({"error": f"Failed to read an image: {e}"}), 400
+
+    captions = batcher.submit_many(items)
+    with timed('serialize'):
+        return jsonify({"captions": captions})
+
+@app.route('/health', methods=['GET'])
+def health():
+    # For load_balancer.py: the server is up and its model is loaded (the route is only served once it is).
+    return jsonify({"status": "ok"})
 
 if __name__ == "__main__":
+    max_batch_size = 8 # Max requests in one generate. Lower it if you run out of VRAM.
+    max_batch_wait = 0.05 # Seconds to wait for more requests before running a batch.
+    # Visual token budget per image: every image is resized to between min_pixels and max_pixels (one token per
+    # 28x28 pixels, 256 to 1024 tokens by default). Lower the max if large images run out of VRAM.
+    min_pixels = int(os.environ.get('QWEN2_VL_MIN_PIXELS', DEFAULT_MIN_PIXELS))
+    max_pixels = int(os.environ.get('QWEN2_VL_MAX_PIXELS', DEFAULT_MAX_PIXELS))
+
     processor, model = model_loader()
-    app.run(port=5090)
\ No newline at end of file
+    # Reuse the KV cache of a shared system turn (see prefix_cache.py). PREFIX_CACHE=0 turns it off.
+    prefix_cache = PrefixCache(model, enabled=os.environ.get('PREFIX_CACHE', '1') == '1')
+    batcher = MicroBatcher(perform_caption_batch, max_batch_size=max_batch_size, max_wait=max_batch_wait)
+    QUEUE_DEPTH.set_function(lambda: batcher.queue_depth)
+    app.run(port=5090, threaded=True)
\ No newline at end of file
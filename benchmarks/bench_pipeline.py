@@ -0,0 +1,297 @@
+import argparse
+import base64
+import io
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import requests
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import caption_based_on_tag
+import caption_sink
+import http_client
+from bench_preprocess import synthetic_images
+from image_utils import DEFAULT_MAX_SIZE, DEFAULT_QUALITY
+from mock_server import start_mock_server
+
+
+'''
+End-to-end throughput of caption_based_on_tag.main, against a mock caption server (see mock_server.py) or a real provider.
+
+1. A synthetic dataset (WebP images + tag jsons) is generated, or reused from --data-dir.
+2. decode / resize / encode are timed on a sample of the images. (In a run they happen inside the pre-encoding worker
+   processes or on the server, where they can't be timed separately.)
+3. main() is run once per combination of --max-in-flight, --preencode-workers, --transport and --bucket-window.
+   Reported per run: images/sec, per-image latency p50/p95/p99, the time spent in each stage (prompt, http, write),
+   and with the mock server, the share of the batches' visual tokens that was padding.
+4. Everything is written to --output as json. With --baseline, the runs are compared with a previous result file.
+
+    python benchmarks/bench_pipeline.py --images 200 --latency 0.5 --jitter 0.1 --max-in-flight 1 4 8 16
+    python benchmarks/bench_pipeline.py --images 200 --max-in-flight 8 --preencode-workers 0 4 --baseline bench_results.json
+    python benchmarks/bench_pipeline.py --images 200 --token-latency 0.0002 --bucket-window 0 64
+    python benchmarks/bench_pipeline.py --api-url http://127.0.0.1:5090/caption  # A real provider.
+'''
+
+TAG_VOCABULARY = ['1girl', 'solo', 'long_hair', 'smile', 'looking_at_viewer', 'blue_eyes', 'short_hair', 'outdoors',
+                  'sky', 'cloud', 'dress', 'holding', 'flower', 'school_uniform', 'upper_body', 'simple_background']
+
+
+def percentile(values: list, q: float) -> float:
+    # Nearest rank.
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))]
+
+
+def summarize(values: list) -> dict:
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'total': round(sum(values), 4),
+        'mean': round(sum(values) / len(values), 4),
+        'p50': round(percentile(values, 50), 4),
+        'p95': round(percentile(values, 95), 4),
+        'p99': round(percentile(values, 99), 4),
+    }
+
+
+class StageTimer:
+    '''
+    Times the functions of a run by temporarily wrapping them.
+        timer.wrap(module_or_class, 'function name', 'stage')
+        ...
+        timer.restore()
+    '''
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._wrapped = []
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+    def wrap(self, owner, name: str, stage: str, count_failures: bool = False):
+        original = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = original(*args, **kwargs)
+            except Exception:
+                if count_failures:
+                    with self._lock:
+                        self.failures += 1
+                raise
+            finally:
+                self.record(stage, time.perf_counter() - start)
+            if count_failures and not result:
+                with self._lock:
+                    self.failures += 1
+            return result
+
+        setattr(owner, name, timed)
+        self._wrapped.append((owner, name, original))
+
+    def restore(self):
+        for owner, name, original in reversed(self._wrapped):
+            setattr(owner, name, original)
+        self._wrapped = []
+
+
+def make_dataset(data_dir: str, count: int, seed: int = 0):
+    # <data_dir>/image/<id>.webp and <data_dir>/tags/<id>.json. An existing dataset with enough images is reused.
+    image_dir, tags_dir = os.path.join(data_dir, 'image'), os.path.join(data_dir, 'tags')
+    if os.path.isdir(image_dir) and len(os.listdir(image_dir)) >= count:
+        return image_dir, tags_dir
+    os.makedirs(image_dir, exist_ok=True)
+    os.makedirs(tags_dir, exist_ok=True)
+
+    rng = random.Random(seed)
+    for i, data in enumerate(synthetic_images(count)):
+        with open(os.path.join(image_dir, f'{i}.webp'), 'wb') as f:
+            f.write(data)
+        tags = {
+            'rating': rng.choice(['general', 'sensitive']),
+            'general': ', '.join(rng.sample(TAG_VOCABULARY, 6)),
+            'meta': '',
+            'character': rng.choice(['', 'hatsune miku (vocaloid)', 'hakurei reimu (touhou)']),
+            'copyright': rng.choice(['', 'vocaloid', 'touhou']),
+            'artist': f'artist_{rng.randrange(20)}',
+        }
+        with open(os.path.join(tags_dir, f'{i}.json'), 'w') as f:
+            json.dump(tags, f)
+    return image_dir, tags_dir
+
+
+def time_preprocess(image_dir: str, limit: int, max_size: int = DEFAULT_MAX_SIZE, quality: int = DEFAULT_QUALITY) -> dict:
+    # The steps of image_utils.encode_image, timed one by one.
+    samples = defaultdict(list)
+    for name in sorted(os.listdir(image_dir))[:limit]:
+        start = time.perf_counter()
+        img = Image.open(os.path.join(image_dir, name))
+        img.load()
+        decoded = time.perf_counter()
+        if max(img.size) > max_size:
+            img.thumbnail((max_size, max_size), Image.BICUBIC, reducing_gap=2.0)
+        resized = time.perf_counter()
+        buffer = io.BytesIO()
+        img.convert('RGB').save(buffer, format='JPEG', quality=quality)
+        base64.b64encode(buffer.getvalue())
+        encoded = time.perf_counter()
+
+        samples['decode'].append(decoded - start)
+        samples['resize'].append(resized - decoded)
+        samples['encode'].append(encoded - resized)
+    return {stage: summarize(values) for stage, values in samples.items()}
+
+
+def server_stats(api_url: str) -> dict:
+    # The mock server's counters. None for a real provider.
+    try:
+        return requests.get(api_url.rsplit('/', 1)[0] + '/stats', timeout=5).json()
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+
+
+def run_once(image_dir: str, tags_dir: str, api_url: str, max_in_flight: int, preencode_workers: int,
+             output_format: str, transport: str = 'json', bucket_window: int = 0) -> dict:
+    output_dir = tempfile.mkdtemp(prefix='bench_captions_')
+    timer = StageTimer()
+    timer.wrap(caption_based_on_tag, 'process_job', 'image', count_failures=True)
+    timer.wrap(caption_based_on_tag, 'generate_prompt', 'prompt')
+    timer.wrap(http_client.HTTPClient, 'post', 'http') # post_json goes through post too.
+    timer.wrap(caption_sink.TxtSink, 'write', 'write')
+    # Shard sinks only buffer in write(), the records are written by _flush().
+    timer.wrap(caption_sink._ShardSink, '_flush', 'write')
+    stats_before = server_stats(api_url)
+    start = time.perf_counter()
+    try:
+        caption_based_on_tag.main(tags_dir, image_dir, output_dir, max_in_flight=max_in_flight, api_url=api_url,
+                                  preencode_workers=preencode_workers, output_format=output_format, transport=transport,
+                                  bucket_window=bucket_window)
+    finally:
+        elapsed = time.perf_counter() - start
+        timer.restore()
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    images = len(timer.samples['image'])
+    captioned = images - timer.failures
+    stages = {stage: summarize(values) for stage, values in timer.samples.items() if stage != 'image'}
+    stats_after = server_stats(api_url)
+    padding = None
+    if stats_before and stats_after and 'visual_tokens' in stats_after:
+        tokens = stats_after['visual_tokens'] - stats_before['visual_tokens']
+        padding_tokens = stats_after['visual_padding_tokens'] - stats_before['visual_padding_tokens']
+        padding = round(padding_tokens / max(tokens + padding_tokens, 1), 4)
+    return {
+        'params': {'max_in_flight': max_in_flight, 'preencode_workers': preencode_workers, 'output_format': output_format,
+                   'transport': transport, 'bucket_window': bucket_window},
+        'images': images,
+        'captioned': captioned,
+        'failed': timer.failures,
+        'elapsed': round(elapsed, 3),
+        'images_per_sec': round(captioned / max(elapsed, 1e-9), 3),
+        'latency': summarize(timer.samples['image']),
+        'stages': stages,
+        'visual_padding': padding,
+    }
+
+
+def compare(runs: list, baseline_path: str):
+    with open(baseline_path, 'r') as f:
+        baseline = {json.dumps(run['params'], sort_keys=True): run for run in json.load(f)['runs']}
+    print(f"\nCompared with {baseline_path}:")
+    for run in runs:
+        before = baseline.get(json.dumps(run['params'], sort_keys=True))
+        if before is None:
+            print(f"  {run['params']}: not in the baseline")
+            continue
+        change = (run['images_per_sec'] - before['images_per_sec']) / max(before['images_per_sec'], 1e-9) * 100
+        print(f"  {run['params']}: {before['images_per_sec']:.2f} -> {run['images_per_sec']:.2f} images/sec ({change:+.1f}%), "
+              f"p95 {before['latency'].get('p95')} -> {run['latency'].get('p95')}s")
+
+
+def print_run(run: dict):
+    latency = run['latency']
+    print(f"\n{run['params']}: {run['captioned']}/{run['images']} captioned in {run['elapsed']:.1f}s, "
+          f"{run['images_per_sec']:.2f} images/sec, latency p50={latency.get('p50')} p95={latency.get('p95')} p99={latency.get('p99')}s")
+    if run.get('visual_padding') is not None:
+        print(f"  {run['visual_padding'] * 100:.1f}% of the batches' visual tokens were padding")
+    for stage, summary in run['stages'].items():
+        print(f"  {stage:<8} {summary['total']:8.2f}s total {summary['mean'] * 1000:8.1f} ms mean {summary['p95'] * 1000:8.1f} ms p95")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the captioning pipeline end to end.')
+    parser.add_argument('--images', type=int, default=100, help='Synthetic images to generate.')
+    parser.add_argument('--data-dir', default=None, help='Keep (and reuse) the synthetic dataset here. A temporary directory if not set.')
+    parser.add_argument('--api-url', default=None, help='Benchmark against this caption endpoint instead of the mock server.')
+    parser.add_argument('--port', type=int, default=5391, help='Port of the mock server.')
+    parser.add_argument('--latency', type=float, default=0.5, help='Mock server: seconds per generate.')
+    parser.add_argument('--jitter', type=float, default=0.1, help='Mock server: +- jitter on the latency.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Mock server: fraction of requests answered with 503.')
+    parser.add_argument('--max-batch-size', type=int, default=8, help='Mock server: max requests per generate.')
+    parser.add_argument('--token-latency', type=float, default=0.0, help='Mock server: seconds per padded visual token.')
+    parser.add_argument('--max-in-flight', type=int, nargs='+', default=[8])
+    parser.add_argument('--preencode-workers', type=int, nargs='+', default=[0])
+    parser.add_argument('--transport', nargs='+', default=['json'], choices=caption_based_on_tag.TRANSPORTS)
+    parser.add_argument('--bucket-window', type=int, nargs='+', default=[0])
+    parser.add_argument('--output-format', default='txt', choices=['txt', 'jsonl', 'parquet'])
+    parser.add_argument('--preprocess-samples', type=int, default=20, help='Images to time decode/resize/encode on.')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', default=None, help='A previous --output file to compare with.')
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='bench_data_')
+    try:
+        print(f"Preparing {args.images} images in {data_dir}...")
+        image_dir, tags_dir = make_dataset(data_dir, args.images)
+
+        api_url = args.api_url or start_mock_server(args.port, latency=args.latency, jitter=args.jitter,
+                                                    error_rate=args.error_rate, max_batch_size=args.max_batch_size,
+                                                    token_latency=args.token_latency)
+
+        preprocess = time_preprocess(image_dir, args.preprocess_samples)
+        print("Preprocessing, per image: " + ', '.join(f"{stage} {summary['mean'] * 1000:.1f} ms"
+                                                       for stage, summary in preprocess.items()))
+
+        runs = []
+        for max_in_flight, preencode_workers, transport, bucket_window in itertools.product(
+                args.max_in_flight, args.preencode_workers, args.transport, args.bucket_window):
+            run = run_once(image_dir, tags_dir, api_url, max_in_flight, preencode_workers, args.output_format, transport,
+                           bucket_window)
+            print_run(run)
+            runs.append(run)
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    results = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': vars(args),
+        'preprocess': preprocess,
+        'runs': runs,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        compare(runs, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import argparse
+import base64
+import io
+import os
+import sys
+import time
+
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from image_utils import encode_image
+
+
+'''
+Compare the old resize_and_encode_image (full decode, BICUBIC, lossless PNG) with image_utils.encode_image.
+
+Usage:
+    python benchmarks/bench_preprocess.py --image-dir ./image --limit 200
+    python benchmarks/bench_preprocess.py  # Uses synthetic WebP images.
+'''
+
+
+def legacy_resize_and_encode_image(image_path, max_size=1024):
+    # The implementation that used to be copy-pasted in every script.
+    with Image.open(image_path) as img:
+        original_width, original_height = img.size
+
+        if max(original_width, original_height) > max_size:
+            if original_width > original_height:
+                new_width = max_size
+                new_height = int((new_width / original_width) * original_height)
+            else:
+                new_height = max_size
+                new_width = int((new_height / original_height) * original_width)
+
+            img = img.resize((new_width, new_height), Image.BICUBIC)
+            img = img.convert('RGB')
+
+        img_byte_array = io.BytesIO()
+        img.save(img_byte_array, format='PNG')
+        img_byte_array = img_byte_array.getvalue()
+
+    return base64.b64encode(img_byte_array).decode('utf-8')
+
+
+def synthetic_images(count, sizes=((2048, 1536), (1200, 1800), (800, 600), (3000, 2000))):
+    images = []
+    for i in range(count):
+        width, height = sizes[i % len(sizes)]
+        # A gradient with some noise compresses roughly like an illustration, unlike a flat color.
+        img = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+        img = Image.blend(img, Image.effect_noise((width, height), 40).convert('RGB'), 0.3)
+        buffer = io.BytesIO()
+        img.save(buffer, format='WEBP', quality=90)
+        images.append(buffer.getvalue())
+    return images
+
+
+def run(name, func, images):
+    total_bytes = 0
+    start = time.perf_counter()
+    for image in images:
+        total_bytes += len(func(image))
+    elapsed = time.perf_counter() - start
+    print(f"{name:<28} {elapsed / len(images) * 1000:8.1f} ms/image {total_bytes / len(images) / 1024:9.1f} KiB/image (base64)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark image preprocessing.')
+    parser.add_argument('--image-dir', default=None, help='Directory of .webp images. Synthetic images are used if not set.')
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--max-size', type=int, default=1024)
+    parser.add_argument('--quality', type=int, default=90)
+    args = parser.parse_args()
+
+    if args.image_dir:
+        names = sorted(f for f in os.listdir(args.image_dir) if f.endswith('.webp'))[:args.limit]
+        images = []
+        for name in names:
+            with open(os.path.join(args.image_dir, name), 'rb') as f:
+                images.append(f.read())
+    else:
+        images = synthetic_images(args.limit)
+    print(f"{len(images)} images, max_size={args.max_size}")
+
+    run('legacy (PNG)', lambda data: legacy_resize_and_encode_image(io.BytesIO(data), args.max_size), images)
+    for format in ('PNG', 'JPEG', 'WEBP'):
+        run(f'image_utils ({format})',
+            lambda data: base64.b64encode(encode_image(data, args.max_size, format, args.quality)[0]), images)
+    run('image_utils (no passthrough)',
+        lambda data: base64.b64encode(encode_image(data, args.max_size, 'JPEG', args.quality, passthrough=False)[0]), images)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import argparse
+import asyncio
+import collections
+import json
+import random
+import time
+
+from aiohttp import web
+
+
+'''
+A fake OpenAI compatible /v1/chat/completions endpoint, to test and benchmark api_providers/openai-competiable-api.py
+without an api key.
+
+Each completion takes `latency` +- `jitter` seconds, and a request is answered with 429 (with Retry-After) with
+probability `rate_limit_rate`. With `rpm`, a real requests-per-minute quota is enforced (sliding window) and reported
+in x-ratelimit-* headers, like OpenAI does. With "stream": true the completion is sent as server-sent events, word by word.
+Many requests are in flight at the same time, like a remote api.
+
+    python benchmarks/fake_openai_upstream.py --port 8000 --latency 2 --jitter 0.5
+'''
+
+
+def create_app(latency: float = 1.0, jitter: float = 0.2, rate_limit_rate: float = 0.0, rpm: int = None) -> web.Application:
+    stats = {'requests': 0, 'rate_limited': 0, 'in_flight': 0, 'max_in_flight': 0}
+    accepted = collections.deque() # Times of the requests accepted in the last minute.
+
+    def quota_headers() -> dict:
+        now = time.monotonic()
+        while accepted and accepted[0] < now - 60:
+            accepted.popleft()
+        if rpm is None:
+            return {}
+        reset = accepted[0] + 60 - now if accepted else 0.0
+        return {'x-ratelimit-limit-requests': str(rpm), 'x-ratelimit-remaining-requests': str(max(0, rpm - len(accepted))),
+                'x-ratelimit-reset-requests': f'{reset:.3f}s'}
+
+    async def completions(request: web.Request) -> web.StreamResponse:
+        stats['requests'] += 1
+        headers = quota_headers()
+        over_quota = rpm is not None and len(accepted) >= rpm
+        if over_quota or random.random() < rate_limit_rate:
+            stats['rate_limited'] += 1
+            return web.json_response({"error": {"message": "Rate limit reached."}}, status=429,
+                                     headers={'Retry-After': '1', **headers})
+        accepted.append(time.monotonic())
+        headers = quota_headers()
+
+        data = await request.json()
+        prompt = next(part['text'] for part in data['messages'][-1]['content'] if part['type'] == 'text')
+        words = f'A fake caption from {data["model"]}, asked: {prompt[:60]}'.split(' ')
+        usage = {"prompt_tokens": len(prompt.split()), "completion_tokens": len(words), "total_tokens": len(prompt.split()) + len(words)}
+
+        stats['in_flight'] += 1
+        stats['max_in_flight'] = max(stats['max_in_flight'], stats['in_flight'])
+        try:
+            delay = max(0.0, latency + random.uniform(-jitter, jitter))
+            if not data.get('stream'):
+                await asyncio.sleep(delay)
+                return web.json_response(headers=headers, data={
+                    "id": f"chatcmpl-{time.time_ns()}",
+                    "object": "chat.completion",
+                    "model": data['model'],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": ' '.join(words)}, "finish_reason": "stop"}],
+                    "usage": usage,
+                })
+
+            response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', **headers})
+            await response.prepare(request)
+            for i, word in enumerate(words):
+                await asyncio.sleep(delay / len(words))
+                event = {"object": "chat.completion.chunk", "model": data['model'],
+                         "choices": [{"index": 0, "delta": {"content": word if i == 0 else ' ' + word}}]}
+                await response.write(f'data: {json.dumps(event)}\n\n'.encode('utf-8'))
+            await response.write(f'data: {json.dumps({"choices": [], "usage": usage})}\n\n'.encode('utf-8'))
+            await response.write(b'data: [DONE]\n\n')
+            await response.write_eof()
+            return response
+        finally:
+            stats['in_flight'] -= 1
+
+    async def get_stats(request: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post('/v1/chat/completions', completions)
+    app.router.add_get('/stats', get_stats)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='A fake OpenAI compatible chat completion api.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=1.0, help='Seconds per completion.')
+    parser.add_argument('--jitter', type=float, default=0.2)
+    parser.add_argument('--rpm', type=int, default=None, help='Enforce this requests-per-minute quota.')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='Fraction of requests answered with 429.')
+    args = parser.parse_args()
+
+    web.run_app(create_app(args.latency, args.jitter, args.rate_limit_rate, args.rpm), host=args.host, port=args.port, access_log=None)
@@ -0,0 +1,134 @@
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+from flask import Flask, jsonify, request
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from image_utils import load_image
+from micro_batcher import MicroBatcher
+from transport import read_caption_request, resolve_image
+from visual_budget import fit_to_budget, visual_tokens
+
+
+'''
+A stand-in for the api_providers servers: same /caption and /caption_batch endpoints, no GPU.
+
+Each generate takes `latency` +- `jitter` seconds (+ `item_latency` per extra image in a batch), and a request fails
+with 503 with probability `error_rate`. Requests are merged into batches like the real providers do (see micro_batcher.py).
+With decode=True the server also opens the image like a real provider would, so a path or data url that can't be
+read is an error, and counts its Qwen2-VL visual tokens (see visual_budget.py). /stats then reports the visual tokens
+of the batches and how many of them were padding. With `token_latency`, a generate also takes that many seconds per
+padded visual token (longest image x batch size), like a real prefill.
+
+    python benchmarks/mock_server.py --port 5090 --latency 0.8 --jitter 0.2 --error-rate 0.01
+'''
+
+
+def create_app(latency: float = 0.5, jitter: float = 0.1, error_rate: float = 0.0, max_batch_size: int = 8,
+               max_batch_wait: float = 0.02, item_latency: float = 0.05, decode: bool = True,
+               token_latency: float = 0.0) -> Flask:
+    app = Flask(__name__)
+    app.config['stats'] = stats = {'requests': 0, 'errors': 0, 'batches': 0, 'visual_tokens': 0, 'visual_padding_tokens': 0}
+    stats_lock = threading.Lock()
+
+    def generate(items):
+        # items: [(prompt, image, visual tokens), ...]. Sleeps like a batched generate would take.
+        tokens = [item[2] for item in items]
+        padded = max(tokens) * len(tokens)
+        time.sleep(max(0.0, latency + random.uniform(-jitter, jitter)) + item_latency * (len(items) - 1)
+                   + token_latency * padded)
+        with stats_lock:
+            stats['batches'] += 1
+            stats['visual_tokens'] += sum(tokens)
+            stats['visual_padding_tokens'] += padded - sum(tokens)
+        return [f'A mock caption of an image, asked: {prompt[:60]}' for prompt, _, _ in items]
+
+    def count_tokens(image) -> int:
+        if not decode:
+            return 0
+        # Decoded and resized to the budget like the qwen2 provider does.
+        img = load_image(image, max_size=None)
+        tokens = visual_tokens(*img.size)
+        fit_to_budget(img).load()
+        return tokens
+
+    batcher = MicroBatcher(generate, max_batch_size=max_batch_size, max_wait=max_batch_wait)
+
+    def failed():
+        with stats_lock:
+            stats['requests'] += 1
+            if random.random() < error_rate:
+                stats['errors'] += 1
+                return True
+        return False
+
+    @app.route('/caption', methods=['POST'])
+    def api():
+        if failed():
+            return jsonify({"error": "Injected failure."}), 503
+        data = read_caption_request(request)
+        try:
+            caption = batcher.submit((data.get("prompt"), data.get("image"), count_tokens(data.get("image"))))
+        except Exception as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify({"caption": caption})
+
+    @app.route('/caption_batch', methods=['POST'])
+    def api_batch():
+        if failed():
+            return jsonify({"error": "Injected failure."}), 503
+        items = [(item.get("prompt"), resolve_image(item.get("image"))) for item in request.json.get("items", [])]
+        try:
+            captions = batcher.submit_many([(prompt, image, count_tokens(image)) for prompt, image in items])
+        except Exception as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify({"captions": captions})
+
+    @app.route('/health', methods=['GET'])
+    def health():
+        return jsonify({"status": "ok"})
+
+    @app.route('/stats', methods=['GET'])
+    def get_stats():
+        with stats_lock:
+            return jsonify(dict(stats))
+
+    return app
+
+
+def start_mock_server(port: int = 5391, host: str = '127.0.0.1', **kwargs) -> str:
+    # Runs the server in a daemon thread. Returns the caption url once the server accepts connections.
+    import requests
+
+    app = create_app(**kwargs)
+    threading.Thread(target=lambda: app.run(host=host, port=port, threaded=True), daemon=True).start()
+    url = f'http://{host}:{port}'
+    for _ in range(100):
+        try:
+            requests.get(f'{url}/health', timeout=1)
+            break
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.05)
+    return f'{url}/caption'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='A mock caption server with configurable latency and errors.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5090)
+    parser.add_argument('--latency', type=float, default=0.5, help='Seconds per generate.')
+    parser.add_argument('--jitter', type=float, default=0.1, help='Uniform +- jitter on the latency, in seconds.')
+    parser.add_argument('--item-latency', type=float, default=0.05, help='Extra seconds per additional image in a batch.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with 503.')
+    parser.add_argument('--max-batch-size', type=int, default=8)
+    parser.add_argument('--token-latency', type=float, default=0.0, help='Extra seconds per padded visual token in a batch.')
+    parser.add_argument('--no-decode', action='store_true', help="Don't open the images.")
+    args = parser.parse_args()
+
+    create_app(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, max_batch_size=args.max_batch_size,
+               item_latency=args.item_latency, decode=not args.no_decode, token_latency=args.token_latency) \
+        .run(host=args.host, port=args.port, threaded=True)
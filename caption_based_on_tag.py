@@ -1,10 +1,25 @@
 import os
 import json
-import requests
+import argparse
 from tqdm import tqdm
-import base64
-from PIL import Image
-import io
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from caption_cache import CaptionCache
+from caption_sink import TxtSink, open_sink
+from http_client import HTTPClient
+from image_utils import DEFAULT_MAX_SIZE, image_to_data_url
+from job_manifest import FAILED, PENDING, JobManifest, image_id_of
+from load_balancer import POLICIES, LoadBalancer
+from metrics import ERRORS, stage_summary, start_metrics_server, timed
+from pipeline import PreencodePipeline
+from prompt_table import iter_prompts
+from prompts import Prompt, build_prompt, split_prompt
+from sharding import check_shard_args, in_shard
+from tag_store import TagStore
+from tar_source import TarImageSource
+from transport import TRANSPORTS, post_caption
+from visual_budget import DEFAULT_MAX_PIXELS, DEFAULT_MIN_PIXELS, bucket_jobs
 
 
 '''
@@ -18,38 +33,16 @@ TODO:
 Notice: The dataset has switched to danbooru because the access to the Pixiv-2.6M dataset has been disabled.
 '''
 
+# Set by main() if a caption cache is used (see caption_cache.py).
+caption_cache = None
+# How images are sent to the server (see transport.py).
+caption_transport = 'json'
+# Send the fixed instructions as a separate system turn (see prompts.split_prompt).
+shared_prefix = False
 
-def resize_and_encode_image(image_path, max_size=1024):
-    with Image.open(image_path) as img:
-        # 获取原始尺寸
-        original_width, original_height = img.size
-
-        # 计算调整后的尺寸，保持宽高比
-        if max(original_width, original_height) > max_size:
-            if original_width > original_height:
-                new_width = max_size
-                new_height = int((new_width / original_width) * original_height)
-            else:
-                new_height = max_size
-                new_width = int((new_height / original_height) * original_width)
-
-            # 调整图像大小
-            img = img.resize((new_width, new_height), Image.BICUBIC)
-            img = img.convert('RGB')
-
-        # 将图像转为字节流
-        img_byte_array = io.BytesIO()
-        img.save(img_byte_array, format='PNG')
-        img_byte_array = img_byte_array.getvalue()
-
-    # 将字节流编码为base64
-    image_base64 = base64.b64encode(img_byte_array).decode('utf-8')
-    return image_base64
-
-def load_tags_from_json(tag_file):
-    with open(tag_file, 'r') as f:
-        tags_dict = json.load(f)
 
+def parse_tags(tags_dict, pid):
+    tags_dict = dict(tags_dict)
     if tags_dict['rating'] == 'explicit':
         tags_dict['general'] += ', NSFW Image'
 
@@ -60,7 +53,7 @@ def load_tags_from_json(tag_file):
         tags_dict['character'] = [tags_dict['character']]
 
     result = {
-        'pid': id,
+        'pid': pid,
         'general_tags': tags_dict['general'] + tags_dict['meta'],
         'character_tags': tags_dict['character'],
         'copyright_tags': tags_dict['copyright'],
@@ -68,7 +61,18 @@ def load_tags_from_json(tag_file):
     }
     return result
 
-def generate_prompt(image):
+def load_tags_from_json(tag_file):
+    with open(tag_file, 'r') as f:
+        tags_dict = json.load(f)
+    return parse_tags(tags_dict, os.path.splitext(os.path.basename(tag_file))[0])
+
+def load_tags(tags):
+    # tags: Path of a tag json file, or a dict from TagStore.get.
+    if isinstance(tags, dict):
+        return parse_tags(tags, tags.get('id'))
+    return load_tags_from_json(tags)
+
+def generate_prompt(tags):
     '''
     tags_dict = {
         'pid': '12345',
@@ -78,59 +82,17 @@ def generate_prompt(image):
         'artist_tags': 'John Doe'
     }
     '''
-    tags_dict = load_tags_from_json(image)
-    prompt = f"Here's some accurate tags for this image: {tags_dict['general_tags']}. "
+    if isinstance(tags, Prompt):
+        # Already built by prompt_table.py.
+        return tags
 
-    if 'character_tags' in tags_dict.keys():
-        character = tags_dict['character_tags']
+    tags_dict = load_tags(tags)
+    return build_prompt(tags_dict['general_tags'], tags_dict['character_tags'],
+                        tags_dict['copyright_tags'], tags_dict['artist_tags'])
 
-        if len(character) == 1:
-            if '(' in character and ')' in character:
-                character_tag = character.split('(')[0]
-                series_tag = tags_dict['copyright_tags']
-                prompt += f"The character in this image is '{character_tag}'. The series is '{series_tag}'. If you know about the series, response this series is game or anime."
-            else:
-                character_tag = character[0]
-                prompt += f"The character in this image is '{character_tag}'."
-        elif len(character) > 1:
-            characters_tag = []
-            series = set()
-            for value in character:
-                if '(' in value and ')' in value:
-                    character_tag = value.split('(')[0]
-                    series_tag = tags_dict['copyright_tags']
-                    characters_tag.append(character_tag)
-                    series.add(series_tag)
-                else:
-                    characters_tag.append(value)
-            characters = ", ".join(characters_tag)
-            prompt += f"These characters in this image is '{characters}'."
-            # tqdm.write(f"Notice: There's many characters in image {tags_dict['pid']}. {prompt}")
-            multiple_characters_dict[tags_dict['pid']] = characters
-            if len(series) != 0:
-                series_prompt = 'The series is'
-                for serial in series:
-                    series_prompt += f"'{serial}'."
-                series_prompt += ' If you know about the series, response this series is game or anime.'
-                prompt += series_prompt
-            else:
-                prompt += f"The image shows a original character."
-
-    if 'artist_tags' in tags_dict.keys():
-        # Has artist tags
-        artist_prompt = f"This image is created by artist {tags_dict['artist_tags']}"
-        prompt += artist_prompt
-    else:
-        artist_prompt = f"This image is created by an anonymous artist."
-        prompt += artist_prompt
-
-    base_prompt = f"Please describe this image based on these tags. The response must include these tags. And should in a word range from 50 to 255. Do not describe anything else. Response the description as sentences (with the following: 'An image of ...'). No need to response as markdown format. If there's tags with 'NSFW images', please make sure to indicate that it is an NSFW image."
-    generated_prompt = prompt + '. ' + base_prompt
-
-    return generated_prompt
-
-def image_re_caption(image_path, tags_path):
-    generated_prompt = generate_prompt(tags_path)
+def image_re_caption(image_path, tags_path, image_payload=None):
+    with timed('prompt'):
+        generated_prompt = generate_prompt(tags_path)
     # tqdm.write(f'\n\nAsk: {generated_prompt}')
     '''
     # Via OpenAI API
@@ -142,76 +104,349 @@ def image_re_caption(image_path, tags_path):
     img.save(img_byte_arr, format='PNG')
     img_byte_arr = img_byte_arr.getvalue()
     '''
-    api_url = "http://127.0.0.1:5090/caption"
-    # image_base64 = resize_and_encode_image(image_path)
+    # image_payload is the data url, or (image bytes, mime type) for the binary transports, prepared by the
+    # pre-encoding stage (see pipeline.py), if enabled.
 
     '''
     {
         "prompt": 'Describe this image.',
-        "image": image path
+        "image": image path or data url,
+        "system": the fixed instructions, with shared_prefix (the prompt is then only the tag part)
     }
     '''
 
-    # response = requests.post(api_url, json={"prompt": generated_prompt, "image": "data:image/png;base64," + image_base64})
-    response = requests.post(api_url,
-                             json={"prompt": generated_prompt, "image": image_path})
-    
-    if response.status_code == 200:
-        caption = response.json().get('caption')
-        # tqdm.write(f"Response: {caption}")
-    else:
-        # tqdm.write(f"Failed to get caption: {response.status_code}")
-        return None
-    
+    fingerprint = None
+    if caption_cache is not None:
+        # A duplicate (or near duplicate) of an image captioned before doesn't need the VLM.
+        with timed('cache'):
+            fingerprint = caption_cache.fingerprint(image_path)
+            caption = caption_cache.get(fingerprint, generated_prompt)
+        if caption is not None:
+            return caption
+
+    if image_payload is None and not isinstance(image_path, str) and caption_transport == 'json':
+        # Read from a tar archive, the server can't open it by path. (The binary transports send the bytes as they are.)
+        with timed('preprocess'):
+            image_payload = image_to_data_url(image_path)
+
+    image, mime = image_payload or image_path, None
+    if isinstance(image, tuple):
+        image, mime = image
+
+    system, prompt = split_prompt(generated_prompt) if shared_prefix else (None, generated_prompt)
+    # Failed requests (after retries) raise HTTPClientError, so they are reported instead of silently skipped.
+    with timed('http'):
+        response = post_caption(caption_client, prompt, image, caption_transport, mime, system=system)
+    caption = response.get('caption')
+    # tqdm.write(f"Response: {caption}")
+
+    if caption and fingerprint is not None:
+        caption_cache.put(fingerprint, generated_prompt, caption)
+
     return caption
 
-def process_image(image_path:str, tag_path:str, output_file:str):
+def process_image(image_path:str, tag_path:str, output_file:str, image_payload=None, on_written=None):
 
-    result = image_re_caption(image_path, tag_path)
+    if isinstance(image_payload, Exception):
+        raise RuntimeError(f'Failed to prepare {image_path}: {image_payload}')
+
+    result = image_re_caption(image_path, tag_path, image_payload)
 
     if result is None:
-        return
-    
-    if os.path.exists(output_file):
-        os.remove(output_file)
+        return False
     
     # tqdm.write(f"\n\nVLM: {result}")
     
-    with open(output_file, 'w', encoding='UTF-8') as f:
-        f.write(result)
+    with timed('write'):
+        caption_sink.write(image_id_of(image_path), result, output_file, on_written)
+    return True
 
-def main(tags_dir: str, image_dir: str, output_base_dir: str):
-    global multiple_characters_dict
-    multiple_characters_dict = {}
+def process_job(image_path:str, tag_path:str, output_file:str, image_payload=None, manifest:JobManifest=None):
+    # process_image, recording the result in the job manifest if there's one.
+    if manifest is None:
+        return process_image(image_path, tag_path, output_file, image_payload)
 
-    if not os.path.exists(output_base_dir):
-        os.makedirs(output_base_dir, exist_ok=True)
+    image_id = image_id_of(image_path)
+    start = time.perf_counter()
+    try:
+        # Marked done only once the caption is really written, buffered sinks write it later.
+        result = process_image(image_path, tag_path, output_file, image_payload,
+                               on_written=lambda: manifest.mark_done(image_id, time.perf_counter() - start))
+    except Exception as e:
+        manifest.mark_failed(image_id, str(e), time.perf_counter() - start)
+        raise
+    if not result:
+        manifest.mark_failed(image_id, 'Empty caption.', time.perf_counter() - start)
+    return result
 
+def list_images(image_dir: str):
+    # Yields (image id, image path) of every .webp in image_dir.
+    for filename in os.listdir(image_dir):
+        if filename.endswith('.webp'):
+            yield os.path.splitext(filename)[0], os.path.join(image_dir, filename)
+
+def collect_jobs(tags_dir: str, image_dir: str, output_base_dir: str, tag_store: TagStore = None, captioned_ids: set = None,
+                 images=None, num_shards: int = 1, shard_index: int = 0):
+    # Yields (image path, tags, output path). tags is a tag json path, or a tags dict if a tag store is used.
+    # captioned_ids: Ids that already have a caption (see caption_sink.py). If not given, check for <id>.txt in output_base_dir.
+    # images: (image id, image) pairs to caption instead of listing image_dir, e.g. a TarImageSource.
+    # num_shards, shard_index: Only the images of this shard (see sharding.py), skipped before their tags are looked up.
+    if images is None:
+        images = list_images(image_dir)
+    for image_id, image_path in images:
+        if not in_shard(image_id, num_shards, shard_index):
+            continue
+        if tag_store is not None:
+            # One indexed lookup instead of a stat and an open per image.
+            tags = tag_store.get(image_id) if image_id.isdigit() else None
+            if tags is None:
+                tqdm.write(f"Tags of {image_id} not found in the tag store. Skipping {image_path}.")
+                continue
+        else:
+            tags = os.path.join(tags_dir, image_id + '.json')
+
+            if not os.path.exists(tags):
+                tqdm.write(f"Tag file {tags} not found. Skipping {image_path}.")
+                continue
+
+        output_path = os.path.join(output_base_dir, image_id + '.txt')
+        if captioned_ids is not None:
+            already_captioned = image_id in captioned_ids
+        else:
+            already_captioned = os.path.exists(output_path)
+        if already_captioned:
+            # print(f"Tag file {image_path} has been captioned. Skipping...")
+            continue
+        yield image_path, tags, output_path
+
+def collect_jobs_from_prompt_table(prompt_table_path: str, image_dir: str, output_base_dir: str, captioned_ids: set = None,
+                                   tar_source: TarImageSource = None, num_shards: int = 1, shard_index: int = 0):
+    # Streams (image path, prompt, output path) from a prompt table built by prompt_table.py.
+    # The directories are listed once, instead of a stat per image.
+    # tar_source: Look the images up in the tar archives instead of image_dir.
+    # num_shards, shard_index: Only the images of this shard (see sharding.py), skipped before they are looked up.
+    images = set(os.listdir(image_dir)) if tar_source is None else None
+    if captioned_ids is None:
+        captioned_ids = TxtSink(output_base_dir).captioned_ids()
+    for image_id, prompt in iter_prompts(prompt_table_path):
+        if not in_shard(image_id, num_shards, shard_index) or str(image_id) in captioned_ids:
+            continue
+        if tar_source is not None:
+            image_path = tar_source.member(image_id)
+            if image_path is None:
+                continue
+        elif f'{image_id}.webp' in images:
+            image_path = os.path.join(image_dir, f'{image_id}.webp')
+        else:
+            continue
+        yield image_path, prompt, os.path.join(output_base_dir, f'{image_id}.txt')
+
+def main(tags_dir: str, image_dir: str, output_base_dir: str, max_in_flight: int = 8,
+         api_url: str = "http://127.0.0.1:5090/caption", preencode_workers: int = 0, preencode_queue_size: int = 64,
+         tag_store_path: str = None, prompt_table_path: str = None, manifest_path: str = None,
+         retry_failed: bool = False, rescan: bool = False, output_format: str = 'txt', shard_size: int = 100000,
+         num_shards: int = 1, shard_index: int = 0, lb_policy: str = 'least_outstanding', tar_index_path: str = None,
+         cache_path: str = None, cache_threshold: int = 0, cache_model: str = None, cache_max_entries: int = 1000000,
+         metrics_port: int = None, transport: str = 'json', use_shared_prefix: bool = False, bucket_window: int = 0,
+         min_pixels: int = DEFAULT_MIN_PIXELS, max_pixels: int = DEFAULT_MAX_PIXELS):
+    '''
+    max_in_flight: How many caption requests are kept outstanding at the same time.
+                   Set it to 1 to caption images one by one like before.
+    api_url: The caption endpoint of the provider server, or a list of them to spread the load across.
+    preencode_workers: If > 0, this many processes decode/resize/encode images ahead of dispatch and the server
+                       receives a data url (or the encoded bytes, with a binary transport) instead of a path.
+                       (So the server doesn't need access to the images.)
+    preencode_queue_size: Max number of images prepared ahead of dispatch.
+    tag_store_path: Read tags from this SQLite tag store (see tag_store.py) instead of tags_dir.
+    prompt_table_path: Stream prebuilt prompts from this prompt table (see prompt_table.py) instead of building them.
+    manifest_path: Track every image in this job manifest (see job_manifest.py). The directories are only scanned
+                   when the manifest is created (or with rescan=True), later runs resume from the manifest.
+    retry_failed: With a manifest, only caption the images that failed before.
+    rescan: With a manifest, scan the directories again and add new images to it.
+    output_format: 'txt' writes one <id>.txt per image into output_base_dir. 'jsonl' or 'parquet' append captions to
+                   sharded files in output_base_dir instead (export them with `python caption_sink.py`).
+    shard_size: Captions per shard for 'jsonl' and 'parquet'.
+    num_shards, shard_index: Only caption the images whose id hashes to `shard_index` (see sharding.py), so several
+                             processes/hosts can each caption a disjoint part of the same dataset.
+    lb_policy: How requests are spread across several api urls, 'least_outstanding' or 'latency' (see load_balancer.py).
+    tar_index_path: Read the images in place from the dataset's tar archives through this index (see tar_source.py)
+                    instead of image_dir. The images are sent as data urls.
+    cache_path: Reuse captions of duplicate images from this caption cache (see caption_cache.py), and add new ones to it.
+    cache_threshold: Max dHash distance, in bits, of a near duplicate image. 0 only reuses captions of identical files.
+    cache_model: Identifies the model in the cache, e.g. 'qwen2-vl-7b'. Defaults to the api url(s).
+    cache_max_entries: Captions kept in the cache, the least recently used ones are evicted.
+    metrics_port: Serve Prometheus metrics (request counts, latencies, time per stage) at http://<host>:<port>/metrics.
+    transport: How images are sent (see transport.py). 'json' sends paths (or data urls), 'multipart' the raw image bytes
+               (the server doesn't need access to the images), 'shm' shares them in memory with a server on the same host.
+    use_shared_prefix: Send the fixed instructions as a system turn in front of the image, the same for every image, so
+                       the local providers can reuse its KV cache instead of prefilling it again (see prefix_cache.py).
+    bucket_window: If > 0, reorder the images this many at a time by their Qwen2-VL visual token count (see
+                   visual_budget.py), so images of similar resolution are in flight together and the server's batches
+                   pad less.
+    min_pixels, max_pixels: The server's pixel budget per image, to count the visual tokens with.
+    '''
+    global caption_client, caption_sink, caption_cache, caption_transport, shared_prefix
+    if transport not in TRANSPORTS:
+        raise ValueError(f'Unknown transport {transport}, use one of {", ".join(TRANSPORTS)}.')
+    caption_transport = transport
+    shared_prefix = use_shared_prefix
+    check_shard_args(num_shards, shard_index)
+    metrics_server = start_metrics_server(metrics_port) if metrics_port else None
+    api_urls = [api_url] if isinstance(api_url, str) else list(api_url)
+    if len(api_urls) > 1:
+        caption_client = LoadBalancer(api_urls, policy=lb_policy, pool_size=max_in_flight)
+    else:
+        caption_client = HTTPClient(api_urls[0], pool_size=max_in_flight)
+
+    # Shards sharing an output directory write to their own files.
+    prefix = f'captions-{shard_index:03d}-of-{num_shards:03d}' if num_shards > 1 else 'captions'
+    caption_sink = open_sink(output_format, output_base_dir, shard_size=shard_size, prefix=prefix)
+    # Set on every call: a previous main() in this process may have left its (closed) cache here.
+    caption_cache = CaptionCache(cache_path, model=cache_model or ','.join(sorted(api_urls)),
+                                 threshold=cache_threshold, max_entries=cache_max_entries) if cache_path else None
+
+    captioned = 0
+    start_time = time.perf_counter()
+    stages_before = stage_summary()
+    progress = tqdm()
+    manifest = None
     try:
-        for filename in tqdm(os.listdir(image_dir)):
-            if filename.endswith('.webp'):
-                image_path = os.path.join(image_dir, filename)
-                tag_filename = os.path.splitext(filename)[0] + '.json'
-                tag_path = os.path.join(tags_dir, tag_filename)
-
-                if not os.path.exists(tag_path):
-                    print(f"Tag file {tag_path} not found. Skipping {image_path}.")
-                    continue
-
-                filename, extension = os.path.splitext(tag_filename)
-                txt_filename = filename + '.txt'
-                output_path = os.path.join(output_base_dir, txt_filename)
-                if os.path.exists(output_path):
-                    # print(f"Tag file {image_path} has been captioned. Skipping...")
-                    continue
-                process_image(image_path, tag_path, output_path)
+        def scan_jobs():
+            # Lazy, so resuming from a manifest doesn't scan anything.
+            captioned_ids = caption_sink.captioned_ids()
+            tar_source = TarImageSource(tar_index_path) if tar_index_path else None
+            if prompt_table_path:
+                yield from collect_jobs_from_prompt_table(prompt_table_path, image_dir, output_base_dir, captioned_ids,
+                                                          tar_source, num_shards, shard_index)
+            else:
+                tag_store = TagStore(tag_store_path) if tag_store_path else None
+                yield from collect_jobs(tags_dir, image_dir, output_base_dir, tag_store, captioned_ids, tar_source,
+                                        num_shards, shard_index)
+
+        jobs = scan_jobs()
+
+        if manifest_path:
+            manifest = JobManifest(manifest_path)
+            if len(manifest) == 0 or rescan:
+                tqdm.write(f"Added {manifest.add_jobs(jobs)} images to the manifest.")
+            manifest.recover()
+            statuses = (FAILED,) if retry_failed else (PENDING,)
+            progress.total = manifest.count(statuses)
+            jobs = manifest.iter_claimed(statuses)
+
+        if bucket_window > 0:
+            # Pre-encoded images (and tar members sent as data urls) reach the server shrunk to DEFAULT_MAX_SIZE.
+            resized = preencode_workers > 0 or (tar_index_path and transport == 'json')
+            jobs = bucket_jobs(jobs, bucket_window, min_pixels, max_pixels, max_size=DEFAULT_MAX_SIZE if resized else None)
+
+        if preencode_workers > 0:
+            jobs = ((*job, payload) for job, payload in
+                    PreencodePipeline(jobs, workers=preencode_workers, queue_size=preencode_queue_size,
+                                      binary=transport != 'json'))
+
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            in_flight = set()
+            for job in jobs:
+                # Keep at most `max_in_flight` requests outstanding, so the server is never idle
+                # while we are reading files or writing captions.
+                if len(in_flight) >= max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    captioned += _collect_results(done, progress, start_time, captioned)
+                in_flight.add(executor.submit(process_job, *job, manifest=manifest))
+
+            done, _ = wait(in_flight)
+            captioned += _collect_results(done, progress, start_time, captioned)
 
     except Exception as e:
         print('Error when processing:', e)
+    finally:
+        progress.close()
+        if isinstance(caption_client, LoadBalancer):
+            for backend in caption_client.stats():
+                tqdm.write(f"Backend {backend}")
+        caption_client.close()
+        caption_sink.close()
+        if caption_cache is not None:
+            tqdm.write(f"Caption cache: {caption_cache.stats()}")
+            caption_cache.close()
+            caption_cache = None
+        if manifest is not None:
+            tqdm.write(f"Manifest: {manifest.progress()}")
+            manifest.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Captioned {captioned} images in {elapsed:.1f}s ({captioned / max(elapsed, 1e-9):.2f} images/sec).")
+    # Summed over the concurrent requests, so the stages add up to more than the elapsed time.
+    print('Time per stage: ' + ', '.join(f'{stage} {total:.1f}s ({total / count * 1000:.1f} ms avg)'
+                                         for stage, (count, total) in stage_summary(since=stages_before).items()))
+
+def _collect_results(done, progress, start_time, captioned):
+    count = 0
+    for future in done:
+        try:
+            if future.result():
+                count += 1
+        except Exception as e:
+            ERRORS.inc(stage='job', error=type(e).__name__)
+            tqdm.write(f'Error when processing: {e}')
+        progress.update(1)
+    elapsed = time.perf_counter() - start_time
+    progress.set_postfix(images_per_sec=f'{(captioned + count) / max(elapsed, 1e-9):.2f}')
+    return count
 
 if __name__ == "__main__": 
-    captions_output_dir = './NL-captions'
-    images_path = './image'
-    tags_dir = './tags'
-
-    main(tags_dir, images_path, captions_output_dir)
+    parser = argparse.ArgumentParser(description='Re-caption images with a VLM based on their danbooru tags.')
+    parser.add_argument('--image-dir', default='./image')
+    parser.add_argument('--tags-dir', default='./tags')
+    parser.add_argument('--output-dir', default='./NL-captions')
+    parser.add_argument('--api-url', nargs='+', default=["http://127.0.0.1:5090/caption"],
+                        help='Caption endpoint(s). With several, requests are load balanced across them.')
+    parser.add_argument('--lb-policy', default='least_outstanding', choices=POLICIES,
+                        help='How requests are spread across several --api-url.')
+    parser.add_argument('--max-in-flight', type=int, default=8,
+                        help='Concurrent caption requests. Match it with how many requests your server can handle.')
+    parser.add_argument('--preencode-workers', type=int, default=0,
+                        help='Prepare images in this many worker processes and send them as data urls. e.g. os.cpu_count()')
+    parser.add_argument('--tag-store', default=None,
+                        help='SQLite tag store built by `python tag_store.py`. Much faster than --tags-dir on a network filesystem.')
+    parser.add_argument('--prompt-table', default=None,
+                        help='Prompt table built by `python prompt_table.py`. Skips prompt building entirely.')
+    parser.add_argument('--manifest', default=None,
+                        help='Job manifest, e.g. ./caption_jobs.sqlite. Resume/retry from it instead of scanning the directories.')
+    parser.add_argument('--retry-failed', action='store_true', help='With --manifest, only retry the images that failed before.')
+    parser.add_argument('--rescan', action='store_true', help='With --manifest, add new images to it.')
+    parser.add_argument('--output-format', default='txt', choices=['txt', 'jsonl', 'parquet'],
+                        help="'jsonl' or 'parquet' write sharded files instead of one .txt per image.")
+    parser.add_argument('--tar-index', default=None,
+                        help='Read the images from the tar archives through this index (built by `python tar_source.py`) instead of --image-dir.')
+    parser.add_argument('--cache', default=None,
+                        help='Caption cache, e.g. ./caption_cache.sqlite. Duplicate images reuse the cached caption instead of calling the VLM.')
+    parser.add_argument('--cache-threshold', type=int, default=0,
+                        help='Max dHash distance (bits) of a near duplicate. 0 only matches identical files, 1-3 also near identical variants.')
+    parser.add_argument('--cache-model', default=None, help='Model id the cached captions belong to. Defaults to the api url(s).')
+    parser.add_argument('--cache-max-entries', type=int, default=1000000, help='Captions kept in the cache (LRU).')
+    parser.add_argument('--transport', default='json', choices=TRANSPORTS,
+                        help="How images are sent: 'json' (paths/data urls), 'multipart' (raw bytes, server on another machine) "
+                             "or 'shm' (shared memory, server on the same host).")
+    parser.add_argument('--shared-prefix', action='store_true',
+                        help='Send the fixed instructions as a system turn, so the qwen2/phi3.5 providers can cache their prefill.')
+    parser.add_argument('--bucket-window', type=int, default=0,
+                        help='Reorder the images this many at a time by resolution (Qwen2-VL visual tokens), so batches pad less. E.g. 256.')
+    parser.add_argument('--min-pixels', type=int, default=DEFAULT_MIN_PIXELS, help="The server's min pixels per image, for --bucket-window.")
+    parser.add_argument('--max-pixels', type=int, default=DEFAULT_MAX_PIXELS, help="The server's max pixels per image, for --bucket-window.")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics of the captioner on this port, e.g. 9100.')
+    parser.add_argument('--num-shards', type=int, default=1, help='Split the dataset into this many disjoint shards.')
+    parser.add_argument('--shard-index', type=int, default=0, help='The shard this process captions, in [0, num-shards).')
+    args = parser.parse_args()
+
+    main(args.tags_dir, args.image_dir, args.output_dir, max_in_flight=args.max_in_flight, api_url=args.api_url,
+         preencode_workers=args.preencode_workers, tag_store_path=args.tag_store, prompt_table_path=args.prompt_table,
+         manifest_path=args.manifest, retry_failed=args.retry_failed, rescan=args.rescan,
+         output_format=args.output_format, num_shards=args.num_shards, shard_index=args.shard_index,
+         lb_policy=args.lb_policy, tar_index_path=args.tar_index, cache_path=args.cache,
+         cache_threshold=args.cache_threshold, cache_model=args.cache_model, cache_max_entries=args.cache_max_entries,
+         metrics_port=args.metrics_port, transport=args.transport, use_shared_prefix=args.shared_prefix,
+         bucket_window=args.bucket_window, min_pixels=args.min_pixels, max_pixels=args.max_pixels)
@@ -0,0 +1,188 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from image_utils import load_image, read_image_bytes
+
+
+'''
+A caption cache, so exact re-uploads and near identical variants of an image aren't sent to the VLM again.
+
+Key: (image hash, prompt hash, model id). The image hash is
+- exact: blake2b of the original image bytes, for byte identical re-uploads.
+- near duplicate: a 64 bit difference hash (dHash) of the image. Two images are near duplicates if their hashes differ
+  in at most `threshold` bits. The hash is split into 4 indexed 16 bit bands: images within 3 bits of each other
+  share at least one band, so up to threshold=3 every near duplicate is found with an index lookup.
+  Above that only the near duplicates sharing a band are found.
+
+The cache is one SQLite file, bounded to `max_entries` captions. The least recently used ones are evicted.
+
+    python caption_based_on_tag.py --cache caption_cache.sqlite --cache-threshold 2
+    python caption_cache.py --cache caption_cache.sqlite             # Stats
+'''
+
+HASH_BITS = 64
+BANDS = 4
+BAND_BITS = HASH_BITS // BANDS
+
+SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS captions (
+    image_hash TEXT NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    model TEXT NOT NULL,
+    dhash INTEGER NOT NULL,
+    {', '.join(f'band{band} INTEGER NOT NULL' for band in range(BANDS))},
+    caption TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (image_hash, prompt_hash, model)
+);
+{''.join(f'CREATE INDEX IF NOT EXISTS captions_band{band} ON captions (prompt_hash, model, band{band});' for band in range(BANDS))}
+CREATE INDEX IF NOT EXISTS captions_last_used ON captions (last_used);
+'''
+
+
+def _blake2b(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def dhash(image, hash_size: int = 8) -> int:
+    # Difference hash: shrink to (hash_size + 1) x hash_size grayscale, one bit per "is brighter than its right neighbour".
+    img = load_image(image, max_size=128).convert('L').resize((hash_size + 1, hash_size))
+    pixels = img.tobytes()
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            offset = row * (hash_size + 1) + col
+            value = (value << 1) | (pixels[offset] > pixels[offset + 1])
+    return value
+
+
+def _to_signed(value: int) -> int:
+    # SQLite integers are signed 64 bit.
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def _bands(value: int) -> list:
+    mask = (1 << BAND_BITS) - 1
+    return [(value >> (band * BAND_BITS)) & mask for band in range(BANDS)]
+
+
+class Fingerprint:
+    def __init__(self, image_hash: str, dhash: int = None):
+        self.image_hash = image_hash
+        self.dhash = dhash
+
+
+class CaptionCache:
+    def __init__(self, db_path: str, model: str = 'default', threshold: int = 0, max_entries: int = 1000000):
+        '''
+        model: Identifies the captioning model (and its settings). Captions of another model are never reused.
+        threshold: Max dHash distance, in bits, of a near duplicate. 0 only reuses captions of byte identical images.
+        max_entries: Captions kept. The least recently used ones are evicted beyond that.
+        '''
+        if not 0 <= threshold < HASH_BITS:
+            raise ValueError(f'threshold must be in [0, {HASH_BITS}).')
+        self.db_path = db_path
+        self.model = model
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+        self._entries = self._conn.execute('SELECT COUNT(*) FROM captions').fetchone()[0]
+
+    def __len__(self):
+        return self._entries
+
+    def fingerprint(self, image) -> Fingerprint:
+        # The original image, not the resized payload, so the hash doesn't depend on the preprocessing settings.
+        data = read_image_bytes(image)
+        return Fingerprint(_blake2b(data), dhash(data) if self.threshold > 0 else None)
+
+    def get(self, fingerprint: Fingerprint, prompt: str):
+        prompt_hash = _blake2b(prompt.encode('utf-8'))
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT image_hash, caption FROM captions WHERE image_hash = ? AND prompt_hash = ? AND model = ?',
+                (fingerprint.image_hash, prompt_hash, self.model)).fetchone()
+            if row is None and fingerprint.dhash is not None:
+                row = self._nearest(fingerprint.dhash, prompt_hash)
+                if row is not None:
+                    self.near_hits += 1
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute('UPDATE captions SET last_used = ? WHERE image_hash = ? AND prompt_hash = ? AND model = ?',
+                               (time.time(), row[0], prompt_hash, self.model))
+            return row[1]
+
+    def _nearest(self, value: int, prompt_hash: str):
+        candidates = {}
+        for band, band_value in enumerate(_bands(value)):
+            for image_hash, candidate, caption in self._conn.execute(
+                    f'SELECT image_hash, dhash, caption FROM captions WHERE prompt_hash = ? AND model = ? AND band{band} = ?',
+                    (prompt_hash, self.model, band_value)):
+                candidates[image_hash] = (bin((candidate & ((1 << HASH_BITS) - 1)) ^ value).count('1'), caption)
+        if not candidates:
+            return None
+        image_hash, (distance, caption) = min(candidates.items(), key=lambda item: item[1][0])
+        if distance > self.threshold:
+            return None
+        return image_hash, caption
+
+    def put(self, fingerprint: Fingerprint, prompt: str, caption: str):
+        value = fingerprint.dhash if fingerprint.dhash is not None else 0
+        # Without a dHash the bands can't match anything, -1 is outside the range of a band.
+        bands = _bands(value) if fingerprint.dhash is not None else [-1] * BANDS
+        key = (fingerprint.image_hash, _blake2b(prompt.encode('utf-8')), self.model)
+        with self._lock:
+            # Two requests for identical images can both miss, the second one only replaces the caption.
+            exists = self._conn.execute('SELECT 1 FROM captions WHERE image_hash = ? AND prompt_hash = ? AND model = ?',
+                                        key).fetchone() is not None
+            self._conn.execute(f'INSERT OR REPLACE INTO captions VALUES (?, ?, ?, ?, {", ".join("?" * BANDS)}, ?, ?)',
+                               (*key, _to_signed(value), *bands, caption, time.time()))
+            if not exists:
+                self._entries += 1
+            if self._entries > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        # Evict down to 90% of max_entries at once, so we don't evict on every put.
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._conn.execute('DELETE FROM captions WHERE rowid IN (SELECT rowid FROM captions ORDER BY last_used LIMIT ?)',
+                               (self._entries - int(self.max_entries * 0.9),))
+            self._conn.execute('COMMIT')
+        except Exception:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._entries = self._conn.execute('SELECT COUNT(*) FROM captions').fetchone()[0]
+
+    def stats(self) -> dict:
+        return {'entries': self._entries, 'hits': self.hits, 'near_hits': self.near_hits, 'misses': self.misses}
+
+    def close(self):
+        self._conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Show the contents of a caption cache.')
+    parser.add_argument('--cache', default='caption_cache.sqlite')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.cache):
+        raise FileNotFoundError(f'Caption cache {args.cache} not found.')
+    conn = sqlite3.connect(f'file:{args.cache}?mode=ro', uri=True)
+    print(f"{conn.execute('SELECT COUNT(*) FROM captions').fetchone()[0]} captions")
+    for model, count in conn.execute('SELECT model, COUNT(*) FROM captions GROUP BY model'):
+        print(f'  {model}: {count}')
+    conn.close()
@@ -0,0 +1,341 @@
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+
+
+'''
+Where captions are written.
+
+TxtSink:          One <id>.txt per image, the layout trainers expect. (What the captioner always did.)
+JsonlShardSink:   Captions are buffered and appended to sharded JSONL files, {"id": ..., "caption": ...} per line.
+ParquetShardSink: The same, as parquet files with `id` and `caption` columns.
+
+A shard is written as <name>.part, fsync-ed periodically, and renamed to its final name when it's full (or the sink is closed),
+so a finished shard is never half written. A .part file left by a crash is recovered on the next start: the complete
+lines of a JSONL one are kept, a parquet one (unreadable without its footer) is dropped, so its captions are only
+reported written once the shard is finished.
+
+Export shards to the per-image .txt layout:
+    python caption_sink.py --shards ./NL-captions-shards --output ./NL-captions
+'''
+
+
+class TxtSink:
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        os.makedirs(output_dir, exist_ok=True)
+
+    def captioned_ids(self) -> set:
+        # One listing instead of a stat per image.
+        return {os.path.splitext(name)[0] for name in os.listdir(self.output_dir) if name.endswith('.txt')}
+
+    def write(self, image_id: str, caption: str, output_path: str = None, on_written=None):
+        output_path = output_path or os.path.join(self.output_dir, f'{image_id}.txt')
+        with open(output_path, 'w', encoding='UTF-8') as f:
+            f.write(caption)
+        if on_written is not None:
+            on_written()
+
+    def close(self):
+        pass
+
+
+class _ShardSink(ABC):
+    extension = None
+    # Whether records written to a .part shard survive a crash (see _recover). If they don't, on_written is only
+    # called once the shard is finished.
+    part_recoverable = True
+
+    def __init__(self, output_dir: str, shard_size: int = 100000, flush_every: int = 1000, fsync_interval: float = 10.0,
+                 prefix: str = 'captions'):
+        '''
+        shard_size: Captions per shard before rotating to a new file.
+        flush_every: Captions buffered in memory before they are written.
+        fsync_interval: Seconds between fsyncs of the current shard. Also the longest a caption stays buffered: the buffer
+            is flushed when its oldest caption is that old, even if fewer than flush_every captions are in it.
+        prefix: File name prefix. Use a different prefix per process if several processes share output_dir.
+        '''
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.flush_every = flush_every
+        self.fsync_interval = fsync_interval
+        self.prefix = prefix
+        # <prefix>-00012<extension>, and its .part while it's written. Not the shards of another prefix starting with this one.
+        self._shard_name = re.compile(re.escape(prefix) + r'-\d{5}' + re.escape(self.extension) + r'(\.part)?')
+
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._unpublished = [] # on_written callbacks waiting for the current shard to be finished.
+        self._shard_count = 0
+        self._shard_path = None
+        self._last_fsync = time.monotonic()
+        self._buffered_since = None # When the oldest caption in the buffer was written.
+        self._closed = threading.Event()
+        os.makedirs(output_dir, exist_ok=True)
+        self._recover()
+        if fsync_interval > 0:
+            threading.Thread(target=self._flush_periodically, daemon=True).start()
+
+    def _shards(self, part: bool = False):
+        # Finished shards, or the .part files of unfinished ones.
+        names = []
+        for name in os.listdir(self.output_dir):
+            match = self._shard_name.fullmatch(name)
+            if match and bool(match.group(1)) == part:
+                names.append(name)
+        return sorted(names)
+
+    def _new_shard_path(self):
+        index = len(self._shards())
+        while True:
+            path = os.path.join(self.output_dir, f'{self.prefix}-{index:05d}{self.extension}.part')
+            if not os.path.exists(path) and not os.path.exists(path[:-len('.part')]):
+                return path
+            index += 1
+
+    def captioned_ids(self) -> set:
+        ids = set()
+        for name in self._shards():
+            ids.update(str(image_id) for image_id in self.read_ids(os.path.join(self.output_dir, name)))
+        return ids
+
+    def write(self, image_id: str, caption: str, output_path: str = None, on_written=None):
+        # on_written is called once the caption has actually been written to the shard, not when it's buffered
+        # (and for a sink whose .part files can't be recovered, only once the shard is finished).
+        with self._lock:
+            if not self._buffer:
+                self._buffered_since = time.monotonic()
+            self._buffer.append((str(image_id), caption, on_written))
+            if len(self._buffer) >= self.flush_every or self._buffer_expired():
+                self._flush()
+
+    def _buffer_expired(self) -> bool:
+        return bool(self._buffer) and time.monotonic() - self._buffered_since >= self.fsync_interval
+
+    def _flush_periodically(self):
+        # When captions trickle in (a slow backend, the last images of a run), no write fills the buffer, and
+        # none may come to check its age.
+        while not self._closed.wait(self.fsync_interval):
+            with self._lock:
+                if self._buffer_expired():
+                    self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            self._flush()
+            if self._shard_path is not None:
+                self._finish_shard()
+
+    def _flush(self):
+        while self._buffer:
+            if self._shard_path is None:
+                self._shard_path = self._new_shard_path()
+                self._open_shard(self._shard_path)
+                self._shard_count = 0
+            room = self.shard_size - self._shard_count
+            records, self._buffer = self._buffer[:room], self._buffer[room:]
+            self._write_records([(image_id, caption) for image_id, caption, _ in records])
+            self._shard_count += len(records)
+            callbacks = [on_written for _, _, on_written in records if on_written is not None]
+            if self.part_recoverable:
+                for on_written in callbacks:
+                    on_written()
+            else:
+                self._unpublished.extend(callbacks)
+            if self._shard_count >= self.shard_size:
+                self._finish_shard()
+            elif time.monotonic() - self._last_fsync >= self.fsync_interval:
+                self._fsync()
+                self._last_fsync = time.monotonic()
+
+    def _finish_shard(self):
+        # fsync, close, then atomically publish the shard under its final name.
+        self._close_shard()
+        os.replace(self._shard_path, self._shard_path[:-len('.part')])
+        self._shard_path = None
+        callbacks, self._unpublished = self._unpublished, []
+        for on_written in callbacks:
+            on_written()
+
+    @abstractmethod
+    def _recover(self):
+        pass
+
+    @abstractmethod
+    def _open_shard(self, path):
+        pass
+
+    @abstractmethod
+    def _write_records(self, records):
+        pass
+
+    @abstractmethod
+    def _fsync(self):
+        pass
+
+    @abstractmethod
+    def _close_shard(self):
+        pass
+
+    @staticmethod
+    @abstractmethod
+    def read_shard(path):
+        # Yields (id, caption).
+        pass
+
+    @staticmethod
+    @abstractmethod
+    def read_ids(path):
+        # Yields the ids only, without loading the captions.
+        pass
+
+
+_JSONL_ID = '{"id": '
+
+
+class JsonlShardSink(_ShardSink):
+    extension = '.jsonl'
+
+    def _recover(self):
+        for name in self._shards(part=True):
+            path = os.path.join(self.output_dir, name)
+            # Drop a last line that was only partly written, then publish what's left.
+            with open(path, 'rb+') as f:
+                data = f.read()
+                f.truncate(data.rfind(b'\n') + 1)
+            os.replace(path, path[:-len('.part')])
+
+    def _open_shard(self, path):
+        self._file = open(path, 'a', encoding='UTF-8')
+
+    def _write_records(self, records):
+        self._file.write(''.join(json.dumps({'id': image_id, 'caption': caption}, ensure_ascii=False) + '\n'
+                                 for image_id, caption in records))
+        self._file.flush()
+
+    def _fsync(self):
+        os.fsync(self._file.fileno())
+
+    def _close_shard(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+    @staticmethod
+    def read_shard(path):
+        with open(path, 'r', encoding='UTF-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record['id'], record['caption']
+
+    @staticmethod
+    def read_ids(path):
+        # Lines are written as {"id": ..., "caption": ...}: decode the id and skip the caption.
+        decoder = json.JSONDecoder()
+        with open(path, 'r', encoding='UTF-8') as f:
+            for line in f:
+                if line.startswith(_JSONL_ID):
+                    yield decoder.raw_decode(line, len(_JSONL_ID))[0]
+                elif line.strip():
+                    yield json.loads(line)['id']
+
+
+class ParquetShardSink(_ShardSink):
+    extension = '.parquet'
+    part_recoverable = False
+
+    def _recover(self):
+        # A parquet file without its footer can't be read back, so an unfinished shard is dropped.
+        # Its images aren't in any finished shard, so they are captioned again.
+        for name in self._shards(part=True):
+            os.remove(os.path.join(self.output_dir, name))
+
+    def _open_shard(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._schema = pa.schema([('id', pa.string()), ('caption', pa.string())])
+        self._writer = pq.ParquetWriter(path, self._schema)
+
+    def _write_records(self, records):
+        import pyarrow as pa
+
+        ids, captions = zip(*records)
+        self._writer.write_table(pa.table({'id': list(ids), 'caption': list(captions)}, schema=self._schema))
+
+    def _fsync(self):
+        # Row groups are only readable once the footer is written, fsync happens when the shard is finished.
+        pass
+
+    def _close_shard(self):
+        self._writer.close()
+        with open(self._shard_path, 'rb') as f:
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def read_shard(path):
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path, columns=['id', 'caption']).to_pydict()
+        yield from zip(table['id'], table['caption'])
+
+    @staticmethod
+    def read_ids(path):
+        import pyarrow.parquet as pq
+
+        yield from pq.read_table(path, columns=['id']).column('id').to_pylist()
+
+
+SINKS = {'txt': TxtSink, 'jsonl': JsonlShardSink, 'parquet': ParquetShardSink}
+
+
+def open_sink(output_format: str, output_dir: str, **kwargs):
+    if output_format not in SINKS:
+        raise ValueError(f'Unknown output format {output_format}, use one of {", ".join(SINKS)}.')
+    if output_format == 'txt':
+        # <id>.txt never collide between shards, no options needed.
+        return TxtSink(output_dir)
+    return SINKS[output_format](output_dir, **kwargs)
+
+
+def read_shards(shards_dir: str):
+    # Yields (id, caption) from every finished shard in shards_dir.
+    for name in sorted(os.listdir(shards_dir)):
+        path = os.path.join(shards_dir, name)
+        if name.endswith(JsonlShardSink.extension):
+            yield from JsonlShardSink.read_shard(path)
+        elif name.endswith(ParquetShardSink.extension):
+            yield from ParquetShardSink.read_shard(path)
+
+
+def export_txt(shards_dir: str, output_dir: str, overwrite: bool = False) -> int:
+    sink = TxtSink(output_dir)
+    exported = set() if overwrite else sink.captioned_ids()
+    count = 0
+    for image_id, caption in read_shards(shards_dir):
+        if str(image_id) in exported:
+            continue
+        sink.write(image_id, caption)
+        exported.add(str(image_id))
+        count += 1
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export caption shards to one <id>.txt per image.')
+    parser.add_argument('--shards', required=True, help='Directory of .jsonl/.parquet caption shards.')
+    parser.add_argument('--output', required=True, help='Directory to write <id>.txt files to.')
+    parser.add_argument('--overwrite', action='store_true', help='Overwrite .txt files that already exist.')
+    args = parser.parse_args()
+
+    print(f"Exported {export_txt(args.shards, args.output, args.overwrite)} captions to {args.output}")
@@ -1,5 +1,7 @@
-import os 
-import pandas as pd
+import os
+import argparse
+import re
+import sqlite3
 
 
 # If you want to set these environment variables, you have do it here. Else the environment variables will not be used.
@@ -12,30 +14,149 @@ except ImportError:
     print("cheesechaser not installed, please install it first")
 
 
+'''
+Download a subset of danbooru2024-sfw, in chunks, resumable.
 
-pool = Danbooru2024SfwDataPool() # sfw pool do not require token
+- The subset is selected with a filter on metadata.parquet (rating, score, tags). Rating and score filters are pushed
+  down to the parquet row groups, so row groups that can't match aren't even read. Only the `id` column is materialized.
+- Ids are streamed and downloaded `--chunk-size` at a time, so memory stays bounded.
+- Finished chunks are recorded in a ledger (SQLite). An interrupted run resumes from the ledger without listing ./images.
+  Only the ids whose image is actually in ./images are recorded, the ones that failed to download are retried next run.
 
+    python download_dataset.py --rating g s --min-score 10 --tags "1girl" "solo"
+'''
 
-if not os.path.exists('metadata.parquet'):
-    from huggingface_hub import hf_hub_download
-    hf_hub_download(repo_id='deepghs/danbooru2024-sfw', filename='metadata.parquet', repo_type="dataset", local_dir='.', endpoint=os.environ['HF_ENDPOINT'])
 
-df = pd.read_parquet('metadata.parquet', columns=['id'])
+IMAGE_EXTENSION = '.webp' # What the pool writes, and what caption_based_on_tag.py reads.
+
+
+def download_metadata():
+    if not os.path.exists('metadata.parquet'):
+        from huggingface_hub import hf_hub_download
+        hf_hub_download(repo_id='deepghs/danbooru2024-sfw', filename='metadata.parquet', repo_type="dataset", local_dir='.', endpoint=os.environ['HF_ENDPOINT'])
 
-
-ids = set(df.index.tolist())
-print(type(ids))
-print(f"Total IDs: {len(ids)}")
-
-if not os.path.exists('./images'):
-    os.makedirs('./images')
-
-
-remove_ids = set(int(id.split('.')[0]) for id in os.listdir('./images'))
-print(f"Total IDs already downloaded: {len(remove_ids)}")
-
-ids.difference_update(remove_ids)
-
-print(f"Total IDs to download: {len(ids)}")
-
-pool.batch_download_to_directory(resource_ids=ids, dst_dir='./images', max_workers=64, silent=True)
+
+def build_filter(ratings=None, min_score=None, max_score=None, tags=None):
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    conditions = []
+    if ratings:
+        conditions.append(ds.field('rating').isin(ratings))
+    if min_score is not None:
+        conditions.append(ds.field('score') >= min_score)
+    if max_score is not None:
+        conditions.append(ds.field('score') <= max_score)
+    for tag in tags or []:
+        # danbooru tags are space separated, with underscores instead of spaces.
+        tag = tag.strip().replace(' ', '_')
+        conditions.append(pc.match_substring_regex(ds.field('tag_string'), rf'(^| ){re.escape(tag)}( |$)'))
+
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def iter_selected_ids(metadata_path: str, expression=None, batch_size: int = 65536):
+    import pyarrow.dataset as ds
+
+    scanner = ds.dataset(metadata_path, format='parquet').scanner(columns=['id'], filter=expression, batch_size=batch_size)
+    for batch in scanner.to_batches():
+        yield from batch.column('id').to_pylist()
+
+
+def existing_ids(images_dir: str, ids: list) -> list:
+    # The ids of `ids` whose image is in images_dir. A stat per id instead of listing the (large) directory.
+    return [image_id for image_id in ids if os.path.exists(os.path.join(images_dir, f'{image_id}{IMAGE_EXTENSION}'))]
+
+
+class DownloadLedger:
+    def __init__(self, db_path: str):
+        self._conn = sqlite3.connect(db_path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS downloaded (id INTEGER PRIMARY KEY)')
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM downloaded').fetchone()[0]
+
+    def filter_new(self, ids: list) -> list:
+        # The ids of `ids` that aren't downloaded yet, checked in one query.
+        if not ids:
+            return []
+        self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS candidates (id INTEGER PRIMARY KEY)')
+        self._conn.execute('DELETE FROM candidates')
+        self._conn.executemany('INSERT OR IGNORE INTO candidates VALUES (?)', ((image_id,) for image_id in ids))
+        return [row[0] for row in self._conn.execute(
+            'SELECT id FROM candidates WHERE id NOT IN (SELECT id FROM downloaded) ORDER BY id')]
+
+    def mark_downloaded(self, ids):
+        with self._conn:
+            self._conn.executemany('INSERT OR IGNORE INTO downloaded VALUES (?)', ((image_id,) for image_id in ids))
+
+    def import_directory(self, images_dir: str) -> int:
+        # Seed the ledger with what a previous run (without a ledger) already downloaded. Lists the directory once.
+        ids = [int(name.split('.')[0]) for name in os.listdir(images_dir) if name.split('.')[0].isdigit()]
+        self.mark_downloaded(ids)
+        return len(ids)
+
+    def close(self):
+        self._conn.close()
+
+
+def download(pool, metadata_path: str, images_dir: str, ledger: DownloadLedger, expression=None, chunk_size: int = 10000,
+             max_workers: int = 64):
+    total = 0
+    chunk = []
+
+    def flush(chunk):
+        new_ids = ledger.filter_new(chunk)
+        if not new_ids:
+            return 0
+        # silent=True: ids that fail to download are skipped without an error.
+        pool.batch_download_to_directory(resource_ids=new_ids, dst_dir=images_dir, max_workers=max_workers, silent=True)
+        # Only recorded once the whole chunk is done, an interrupted chunk is downloaded again. The ids without an
+        # image stay pending, so they are retried by the next run.
+        downloaded = existing_ids(images_dir, new_ids)
+        ledger.mark_downloaded(downloaded)
+        if len(downloaded) < len(new_ids):
+            print(f"{len(new_ids) - len(downloaded)} images failed to download, they will be retried on the next run.")
+        return len(downloaded)
+
+    for image_id in iter_selected_ids(metadata_path, expression):
+        chunk.append(image_id)
+        if len(chunk) >= chunk_size:
+            total += flush(chunk)
+            print(f"Downloaded {total} new images. ({len(ledger)} in the ledger)")
+            chunk = []
+    total += flush(chunk)
+    print(f"Downloaded {total} new images. ({len(ledger)} in the ledger)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Download (a subset of) danbooru2024-sfw.')
+    parser.add_argument('--images-dir', default='./images')
+    parser.add_argument('--ledger', default='./download_ledger.sqlite', help='Records which ids are downloaded.')
+    parser.add_argument('--rating', nargs='+', default=None, help="Ratings to keep, e.g. g s (general, sensitive).")
+    parser.add_argument('--min-score', type=int, default=None)
+    parser.add_argument('--max-score', type=int, default=None)
+    parser.add_argument('--tags', nargs='+', default=None, help='Only images with all of these tags, e.g. "1girl" "long hair".')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='Ids submitted to the downloader at once.')
+    parser.add_argument('--max-workers', type=int, default=64)
+    args = parser.parse_args()
+
+    pool = Danbooru2024SfwDataPool() # sfw pool do not require token
+
+    download_metadata()
+
+    if not os.path.exists(args.images_dir):
+        os.makedirs(args.images_dir)
+
+    ledger_exists = os.path.exists(args.ledger)
+    ledger = DownloadLedger(args.ledger)
+    if not ledger_exists:
+        print(f"Total IDs already downloaded: {ledger.import_directory(args.images_dir)}")
+
+    expression = build_filter(args.rating, args.min_score, args.max_score, args.tags)
+    download(pool, 'metadata.parquet', args.images_dir, ledger, expression, args.chunk_size, args.max_workers)
+    ledger.close()
@@ -0,0 +1,175 @@
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import REGISTRY
+
+
+'''
+One shared HTTP client for talking to caption backends (our Flask providers, or a remote OpenAI compatible API).
+
+- Keep-alive connection pool, so we don't open a new TCP connection for every image.
+- Retries with jittered exponential backoff on 429/5xx (honours Retry-After).
+- Per-request timeouts.
+- A circuit breaker: after too many failures in a row, dispatch is paused until the backend is back.
+'''
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+CLIENT_REQUESTS = REGISTRY.counter('client_requests_total', 'Requests sent to caption backends, by status.', ['url', 'status'])
+CLIENT_REQUEST_SECONDS = REGISTRY.histogram('client_request_seconds', 'Request latency (with retries), per backend.', ['url'])
+
+
+class HTTPClientError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def backoff_delay(attempt: int, backoff_factor: float = 1.0, max_backoff: float = 60.0) -> float:
+    # "Full jitter": a random delay between 0 and the exponential backoff,
+    # so many workers failing at the same time don't retry at the same time.
+    return random.uniform(0, min(max_backoff, backoff_factor * (2 ** attempt)))
+
+
+class JitteredRetry(Retry):
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        if backoff <= 0:
+            return 0
+        return random.uniform(0, backoff)
+
+
+class CircuitBreaker:
+    '''
+    closed    -> requests go through.
+    open      -> `failure_threshold` failures in a row. Requests wait `reset_timeout` seconds.
+    half-open -> after `reset_timeout`, one probe request goes through. Success closes the breaker, failure opens it again.
+    '''
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0, name: str = 'backend'):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.name = name
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def remaining(self) -> float:
+        # Seconds until the breaker lets a probe through. 0 if it's closed or ready to probe.
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def trip(self):
+        # Open the breaker right away, e.g. when a health check fails.
+        with self._lock:
+            if self._opened_at is None:
+                print(f'{self.name} is unhealthy, pausing dispatch for {self.reset_timeout}s.')
+            self._opened_at = time.monotonic()
+            self._probing = False
+
+    def acquire_delay(self) -> float:
+        # Returns 0 if a request may be sent now, otherwise how long the caller should wait before asking again.
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                return remaining
+            if self._probing:
+                # Someone else is already probing the backend.
+                return min(1.0, self.reset_timeout)
+            self._probing = True
+            return 0.0
+
+    def try_acquire_probe(self) -> bool:
+        # acquire_delay without waiting: True if a request may be sent now. When half-open, only the first caller gets
+        # True (the probe), everyone else False until the probe's result closes or opens the breaker again.
+        return self.acquire_delay() <= 0
+
+    def wait_until_ready(self):
+        while True:
+            delay = self.acquire_delay()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                print(f'{self.name} is back, resuming dispatch.')
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    print(f'{self.name} failed {self._failures} times in a row, pausing dispatch for {self.reset_timeout}s.')
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+class HTTPClient:
+    def __init__(self, url: str, pool_size: int = 16, retries: int = 5, backoff_factor: float = 1.0,
+                 timeout=(10, 180), failure_threshold: int = 5, reset_timeout: float = 30.0, headers: dict = None):
+        '''
+        url: The endpoint every request goes to, e.g. http://127.0.0.1:5090/caption
+        pool_size: Keep-alive connections kept open. Should be >= the number of requests in flight.
+        timeout: (connect timeout, read timeout) in seconds.
+        '''
+        self.url = url
+        self.timeout = timeout
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout, name=url)
+
+        retry = JitteredRetry(total=retries, backoff_factor=backoff_factor, status_forcelist=RETRY_STATUS,
+                              allowed_methods=["HEAD", "GET", "OPTIONS", "POST"], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if headers:
+            self.session.headers.update(headers)
+
+    def post(self, headers: dict = None, timeout=None, acquired: bool = False, **kwargs) -> requests.Response:
+        # acquired: The caller already got the go-ahead from breaker.try_acquire_probe(), don't wait for the breaker.
+        if not acquired:
+            self.breaker.wait_until_ready()
+        start = time.perf_counter()
+        try:
+            response = self.session.post(self.url, headers=headers, timeout=timeout or self.timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            self.breaker.record_failure()
+            CLIENT_REQUESTS.inc(url=self.url, status='error')
+            raise HTTPClientError(f'Request to {self.url} failed: {e}') from e
+        CLIENT_REQUESTS.inc(url=self.url, status=response.status_code)
+        CLIENT_REQUEST_SECONDS.observe(time.perf_counter() - start, url=self.url)
+
+        if response.status_code in RETRY_STATUS:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+        if response.status_code != 200:
+            raise HTTPClientError(f'{self.url} returned {response.status_code}: {response.text[:200]}',
+                                  status_code=response.status_code)
+        return response
+
+    def post_json(self, payload: dict, headers: dict = None, timeout=None) -> dict:
+        return self.post(headers=headers, timeout=timeout, json=payload).json()
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,142 @@
+import base64
+import io
+
+from PIL import Image
+
+
+'''
+Image preprocessing shared by the captioner and the api providers.
+
+Compared with the old resize_and_encode_image (full decode -> BICUBIC resize -> lossless PNG):
+- Large images are shrunk while decoding (JPEG draft mode, Image.reduce for other formats) via thumbnail(reducing_gap=...).
+- The output format and quality are configurable. JPEG/WebP are much faster to produce and much smaller than PNG.
+- If the source already fits `max_size`, the original bytes are sent as is, no re-encoding at all.
+'''
+
+DEFAULT_MAX_SIZE = 1024
+DEFAULT_FORMAT = 'JPEG'
+DEFAULT_QUALITY = 90
+
+MIME_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp'}
+
+
+def is_data_url(image) -> bool:
+    return isinstance(image, str) and image.startswith('data:')
+
+
+def split_data_url(data_url: str):
+    # 'data:image/jpeg;base64,xxxx' -> ('image/jpeg', 'xxxx')
+    header, image_base64 = data_url.split(',', 1)
+    return header[len('data:'):].split(';')[0], image_base64
+
+
+def _open(image):
+    # image: a path, a data url, raw bytes, a file-like object, an already opened PIL image,
+    #        or anything with read_bytes() (pathlib.Path, tar_source.TarMember).
+    if isinstance(image, Image.Image):
+        return image
+    if hasattr(image, 'read_bytes'):
+        image = image.read_bytes()
+    if is_data_url(image):
+        image = base64.b64decode(split_data_url(image)[1])
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image = io.BytesIO(image)
+    return Image.open(image)
+
+
+def read_image_bytes(image) -> bytes:
+    # The encoded bytes of `image` (a path, data url, bytes, file-like object or anything with read_bytes()), as they are.
+    if hasattr(image, 'read_bytes'):
+        return image.read_bytes()
+    if isinstance(image, (bytes, bytearray)):
+        return bytes(image)
+    if isinstance(image, memoryview):
+        return image.tobytes()
+    if is_data_url(image):
+        return base64.b64decode(split_data_url(image)[1])
+    if isinstance(image, str):
+        with open(image, 'rb') as f:
+            return f.read()
+    if hasattr(image, 'read'):
+        image.seek(0)
+        return image.read()
+    return None
+
+
+def read_image_size(image) -> tuple:
+    # (width, height) from the image header, the pixels aren't decoded.
+    img = _open(image)
+    size = img.size
+    if img is not image:
+        img.close()
+    return size
+
+
+def load_image(image, max_size: int = DEFAULT_MAX_SIZE, reducing_gap: float = 2.0) -> Image.Image:
+    '''
+    Open `image` and shrink it so that its long side is at most `max_size`, keeping the aspect ratio.
+    reducing_gap: Use draft/reduce to shrink during decoding, then resample with BICUBIC. Larger is slower but more accurate.
+    '''
+    img = _open(image)
+    if max_size and max(img.size) > max_size:
+        img.thumbnail((max_size, max_size), Image.BICUBIC, reducing_gap=reducing_gap)
+    return img
+
+
+def encode_image(image, max_size: int = DEFAULT_MAX_SIZE, format: str = DEFAULT_FORMAT,
+                 quality: int = DEFAULT_QUALITY, passthrough: bool = True):
+    '''
+    Returns (image bytes, mime type).
+    format: 'JPEG', 'WEBP' or 'PNG'.
+    quality: JPEG/WebP quality. Ignored by PNG.
+    passthrough: If the source already fits max_size (and is JPEG/PNG/WebP), return the source bytes without re-encoding.
+    '''
+    format = format.upper()
+    source_img = _open(image)
+    try:
+        if passthrough and (not max_size or max(source_img.size) <= max_size) and source_img.format in MIME_TYPES:
+            source = read_image_bytes(image)
+            if source is not None:
+                return source, MIME_TYPES[source_img.format]
+
+        img = load_image(source_img, max_size)
+        if format == 'JPEG' and img.mode != 'RGB':
+            img = img.convert('RGB')
+        elif format == 'WEBP' and img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+
+        img_byte_array = io.BytesIO()
+        if format == 'PNG':
+            img.save(img_byte_array, format='PNG', compress_level=1)
+        elif format == 'WEBP':
+            img.save(img_byte_array, format='WEBP', quality=quality, method=0)
+        else:
+            img.save(img_byte_array, format=format, quality=quality)
+        return img_byte_array.getvalue(), MIME_TYPES.get(format, f'image/{format.lower()}')
+    finally:
+        if source_img is not image:
+            source_img.close()
+
+
+def encode_image_base64(image, max_size: int = DEFAULT_MAX_SIZE, format: str = DEFAULT_FORMAT,
+                        quality: int = DEFAULT_QUALITY, passthrough: bool = True):
+    # Returns (base64 string, mime type).
+    if is_data_url(image):
+        # Already prepared by the client (see pipeline.py), don't decode and encode it again.
+        mime, image_base64 = split_data_url(image)
+        return image_base64, mime
+    data, mime = encode_image(image, max_size, format, quality, passthrough)
+    return base64.b64encode(data).decode('utf-8'), mime
+
+
+def image_to_data_url(image, max_size: int = DEFAULT_MAX_SIZE, format: str = DEFAULT_FORMAT,
+                      quality: int = DEFAULT_QUALITY, passthrough: bool = True) -> str:
+    image_base64, mime = encode_image_base64(image, max_size, format, quality, passthrough)
+    return f'data:{mime};base64,{image_base64}'
+
+
+def resize_and_encode_image(image_path, max_size: int = DEFAULT_MAX_SIZE, format: str = DEFAULT_FORMAT,
+                            quality: int = DEFAULT_QUALITY, passthrough: bool = True) -> str:
+    # Kept for the old call sites: returns only the base64 string. Use image_to_data_url if you need the mime type.
+    image_base64, _ = encode_image_base64(image_path, max_size, format, quality, passthrough)
+    return image_base64
@@ -0,0 +1,167 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from prompts import Prompt
+from tar_source import image_ref_from_string
+
+
+'''
+A persistent job manifest (SQLite in WAL mode): one row per image with its status, attempt count, latency and last error.
+
+The image directory is scanned once, when the manifest is created. After that, resuming a job is a query on
+the manifest instead of a directory listing plus a stat per image, and failed images are recorded instead of forgotten.
+
+status: pending -> running -> done
+                           -> failed  (retried with retry_failed=True)
+Items left `running` by a run that crashed are put back to `pending` on the next start.
+'''
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    image_path TEXT NOT NULL,
+    tags_kind TEXT NOT NULL,
+    tags TEXT NOT NULL,
+    output_path TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    latency REAL,
+    error TEXT,
+    updated_at REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, updated_at);
+'''
+
+
+def image_id_of(image_path) -> str:
+    # image_path: a path, or a tar_source.TarMember.
+    if hasattr(image_path, 'image_id'):
+        return image_path.image_id
+    return os.path.splitext(os.path.basename(image_path))[0]
+
+
+def _dump_tags(tags):
+    # tags: a tag json path, a tags dict from TagStore or a prebuilt Prompt.
+    if isinstance(tags, Prompt):
+        return 'prompt', str(tags)
+    if isinstance(tags, dict):
+        return 'tags', json.dumps(tags)
+    return 'path', tags
+
+
+def _load_tags(kind, tags):
+    if kind == 'prompt':
+        return Prompt(tags)
+    if kind == 'tags':
+        return json.loads(tags)
+    return tags
+
+
+class JobManifest:
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+
+    def _transaction(self, sql, parameters=(), many=False):
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                if many:
+                    cursor = self._conn.executemany(sql, parameters)
+                else:
+                    cursor = self._conn.execute(sql, parameters)
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            return cursor.rowcount
+
+    def add_jobs(self, jobs, batch_size: int = 10000) -> int:
+        # jobs: (image path, tags, output path). Images already in the manifest are left as they are.
+        added = 0
+        rows = []
+        for image_path, tags, output_path in jobs:
+            rows.append((image_id_of(image_path), str(image_path), *_dump_tags(tags), output_path))
+            if len(rows) >= batch_size:
+                added += self._insert(rows)
+                rows = []
+        return added + self._insert(rows)
+
+    def _insert(self, rows):
+        if not rows:
+            return 0
+        return self._transaction('INSERT OR IGNORE INTO jobs (id, image_path, tags_kind, tags, output_path) VALUES (?, ?, ?, ?, ?)',
+                                 rows, many=True)
+
+    def recover(self) -> int:
+        # Items a crashed run left `running` go back to pending.
+        return self._transaction('UPDATE jobs SET status = ? WHERE status = ?', (PENDING, RUNNING))
+
+    def count(self, statuses=(PENDING,), before: float = None) -> int:
+        with self._lock:
+            return self._conn.execute(
+                f'SELECT COUNT(*) FROM jobs WHERE status IN ({", ".join("?" * len(statuses))}) AND updated_at < ?',
+                (*statuses, before or time.time())).fetchone()[0]
+
+    def claim(self, limit: int, statuses=(PENDING,), before: float = None) -> list:
+        '''
+        Atomically take up to `limit` items with one of `statuses` and mark them running.
+        before: Only take items last updated before this time, so an item failing in this run isn't claimed again by the same run.
+        Returns [(image path, tags, output path), ...]
+        '''
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._conn.execute(
+                    f'SELECT id, image_path, tags_kind, tags, output_path FROM jobs '
+                    f'WHERE status IN ({", ".join("?" * len(statuses))}) AND updated_at < ? LIMIT ?',
+                    (*statuses, before or now, limit)).fetchall()
+                self._conn.executemany('UPDATE jobs SET status = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?',
+                                       [(RUNNING, now, row[0]) for row in rows])
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return [(image_ref_from_string(image_path), _load_tags(kind, tags), output_path)
+                for _, image_path, kind, tags, output_path in rows]
+
+    def mark_done(self, image_id: str, latency: float = None):
+        self._transaction('UPDATE jobs SET status = ?, latency = ?, error = NULL, updated_at = ? WHERE id = ?',
+                          (DONE, latency, time.time(), image_id))
+
+    def mark_failed(self, image_id: str, error: str, latency: float = None):
+        self._transaction('UPDATE jobs SET status = ?, latency = ?, error = ?, updated_at = ? WHERE id = ?',
+                          (FAILED, latency, error, time.time(), image_id))
+
+    def progress(self) -> dict:
+        with self._lock:
+            return dict(self._conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+    def iter_claimed(self, statuses=(PENDING,), batch_size: int = 256):
+        # Keep claiming batches until nothing claimable is left from before this run started.
+        started_at = time.time()
+        while True:
+            batch = self.claim(batch_size, statuses, before=started_at)
+            if not batch:
+                return
+            yield from batch
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,170 @@
+import random
+import threading
+import time
+
+import requests
+
+from http_client import RETRY_STATUS, HTTPClient, HTTPClientError
+
+
+'''
+Client-side load balancing across several caption backends (e.g. one Qwen2 and one Phi-3.5 server per GPU).
+
+    balancer = LoadBalancer(['http://gpu0:5090/caption', 'http://gpu1:5000/caption'], policy='latency')
+    balancer.post_json({"prompt": ..., "image": ...})
+
+Policies:
+- least_outstanding: send to the backend with the fewest requests in flight.
+- latency: send to the backend with the lowest expected completion time, (in flight + 1) * average latency.
+  A slower GPU gets proportionally fewer requests.
+
+Each backend has its own HTTPClient and circuit breaker. A backend is ejected (its breaker opened) after repeated failures
+or a failed health check (GET /health answering anything but 200), and comes back only when a probe request succeeds,
+`eject_time` seconds later. A failed request is retried on another backend.
+'''
+
+POLICIES = ('least_outstanding', 'latency')
+
+
+class Backend:
+    def __init__(self, url: str, client: HTTPClient, ewma_alpha: float = 0.2):
+        self.url = url
+        self.client = client
+        self.ewma_alpha = ewma_alpha
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.latency = None # Exponentially weighted moving average, in seconds.
+        self._lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        # Closed breaker. A half-open backend only gets the single probe handed out by pick().
+        return not self.client.breaker.is_open
+
+    def expected_latency(self, default: float) -> float:
+        return (self.outstanding + 1) * (self.latency if self.latency is not None else default)
+
+    def start(self):
+        with self._lock:
+            self.outstanding += 1
+            self.requests += 1
+
+    def finish(self, latency: float = None, failed: bool = False):
+        with self._lock:
+            self.outstanding -= 1
+            if failed:
+                self.failures += 1
+            elif latency is not None:
+                self.latency = latency if self.latency is None else \
+                    self.ewma_alpha * latency + (1 - self.ewma_alpha) * self.latency
+
+    def stats(self) -> dict:
+        return {
+            'url': self.url,
+            'available': self.available,
+            'outstanding': self.outstanding,
+            'requests': self.requests,
+            'failures': self.failures,
+            'latency': round(self.latency, 3) if self.latency is not None else None,
+        }
+
+
+class LoadBalancer:
+    def __init__(self, urls: list, policy: str = 'least_outstanding', pool_size: int = 16, health_interval: float = 10.0,
+                 failure_threshold: int = 3, eject_time: float = 30.0, timeout=(10, 180), max_attempts: int = None):
+        '''
+        urls: The caption endpoints, e.g. ['http://127.0.0.1:5090/caption', 'http://127.0.0.1:5000/caption']
+        health_interval: Seconds between health checks. 0 disables them.
+        failure_threshold: Failures in a row before a backend is ejected.
+        eject_time: Seconds an ejected backend gets no requests before it's probed again.
+        max_attempts: Backends tried per request. Defaults to the number of backends.
+        '''
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown policy {policy}, use one of {", ".join(POLICIES)}.')
+        self.policy = policy
+        self.health_interval = health_interval
+        self.max_attempts = max_attempts or len(urls)
+        # Failover to another backend is faster than retrying the same one, so each client only retries once.
+        self.backends = [Backend(url, HTTPClient(url, pool_size=pool_size, retries=1, timeout=timeout,
+                                                 failure_threshold=failure_threshold, reset_timeout=eject_time))
+                         for url in urls]
+
+        self._stopped = threading.Event()
+        self._health_thread = None
+        if health_interval > 0:
+            self._health_thread = threading.Thread(target=self._health_loop, daemon=True)
+            self._health_thread.start()
+
+    def pick(self, exclude=()) -> Backend:
+        while True:
+            remaining = [backend for backend in self.backends if backend not in exclude]
+            if not remaining:
+                raise HTTPClientError('No backend left to try.')
+            for backend in remaining:
+                # An ejected backend whose eject time is over gets one probe request, from the first caller to ask.
+                if backend.client.breaker.is_open and backend.client.breaker.try_acquire_probe():
+                    return backend
+            candidates = [backend for backend in remaining if backend.available]
+            if candidates:
+                break
+            # Every backend is ejected (or being probed). Wait for the first one to come back.
+            time.sleep(min(backend.client.breaker.remaining() for backend in remaining) or 0.1)
+
+        if self.policy == 'latency':
+            known = [backend.latency for backend in candidates if backend.latency is not None]
+            default = sum(known) / len(known) if known else 1.0
+            best = min(backend.expected_latency(default) for backend in candidates)
+            candidates = [backend for backend in candidates if backend.expected_latency(default) == best]
+        else:
+            least = min(backend.outstanding for backend in candidates)
+            candidates = [backend for backend in candidates if backend.outstanding == least]
+        return random.choice(candidates)
+
+    def post(self, headers: dict = None, timeout=None, **kwargs) -> requests.Response:
+        # Like HTTPClient.post, on the backend picked by the policy. kwargs go to requests, e.g. json=... or files=...
+        tried = []
+        while True:
+            backend = self.pick(exclude=tried)
+            tried.append(backend)
+            backend.start()
+            start = time.perf_counter()
+            try:
+                response = backend.client.post(headers=headers, timeout=timeout, acquired=True, **kwargs)
+            except HTTPClientError as e:
+                backend.finish(failed=True)
+                retryable = e.status_code is None or e.status_code in RETRY_STATUS
+                if not retryable or len(tried) >= self.max_attempts:
+                    raise
+                continue
+            backend.finish(time.perf_counter() - start)
+            return response
+
+    def post_json(self, payload: dict, headers: dict = None, timeout=None) -> dict:
+        return self.post(headers=headers, timeout=timeout, json=payload).json()
+
+    def _health_check(self, backend: Backend):
+        # Every provider serves GET /health. A failed check ejects the backend, a passing one never brings it back:
+        # a server can be up and still fail its /caption requests, so only the probe after eject_time closes the breaker.
+        health_url = backend.url.rsplit('/', 1)[0] + '/health'
+        try:
+            healthy = backend.client.session.get(health_url, timeout=5).status_code == 200
+        except requests.exceptions.RequestException:
+            healthy = False
+        if not healthy:
+            backend.client.breaker.trip()
+
+    def _health_loop(self):
+        while not self._stopped.wait(self.health_interval):
+            for backend in self.backends:
+                self._health_check(backend)
+
+    def stats(self) -> list:
+        return [backend.stats() for backend in self.backends]
+
+    def close(self):
+        self._stopped.set()
+        if self._health_thread is not None:
+            self._health_thread.join()
+        for backend in self.backends:
+            backend.client.close()
@@ -0,0 +1,314 @@
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+'''
+Minimal Prometheus instrumentation, shared by the api providers and the captioner. (No prometheus_client needed.)
+
+    from metrics import timed, GENERATED_TOKENS
+    with timed('generate'):
+        ...
+
+Providers: instrument_app(app) adds GET /metrics (Prometheus text format) and counts every request.
+Captioner: `--metrics-port 9100` serves the same /metrics from the captioning process.
+
+Where the time goes, per stage:
+    rate(caption_stage_seconds_sum[5m]) / rate(caption_stage_seconds_count[5m])
+Stages: image_load, preprocess, tokenize, generate, decode, serialize (providers);
+        prompt, cache, preprocess, http, write (captioner).
+generate dominating means GPU bound, image_load/preprocess CPU bound, http on the captioner (minus the server's
+request time) the network.
+'''
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, labelvalues, extra: dict = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in (extra or {}).items()]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects the labels {self.labelnames}, got {tuple(labels)}.')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        # [(suffix, label values, extra labels, value), ...]
+        with self._lock:
+            return [('', key, None, value) for key, value in self._values.items()]
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for suffix, key, extra, value in self._samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._function = None
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        # The value is read from `function()` at scrape time, e.g. the depth of a queue.
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            return [('', (), None, self._function())]
+        return super()._samples()
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def totals(self) -> dict:
+        # {label values: (count, sum)}
+        with self._lock:
+            return {key: (sum(counts), total) for key, (counts, total) in self._values.items()}
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append(('_bucket', key, {'le': _format_value(bound)}, cumulative))
+                samples.append(('_sum', key, None, total))
+                samples.append(('_count', key, None, cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, help, labelnames, **kwargs):
+        # Registering the same name again returns the existing metric, so modules can declare what they use.
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labelnames, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f'{name} is already registered as a {metric.type}.')
+            return metric
+
+    def counter(self, name: str, help: str, labelnames=()) -> Counter:
+        return self._register(Counter, name, help, labelnames)
+
+    def gauge(self, name: str, help: str, labelnames=()) -> Gauge:
+        return self._register(Gauge, name, help, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help, labelnames, buckets=buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+STAGE_SECONDS = REGISTRY.histogram('caption_stage_seconds', 'Time spent in each stage of captioning.', ['stage'])
+ERRORS = REGISTRY.counter('caption_errors_total', 'Errors, by stage and exception type.', ['stage', 'error'])
+GENERATED_TOKENS = REGISTRY.counter('caption_generated_tokens_total', 'Tokens generated by the model.')
+TOKENS_PER_SECOND = REGISTRY.gauge('caption_generate_tokens_per_second', 'Generated tokens/sec of the last generate.')
+BATCH_SIZE = REGISTRY.histogram('caption_batch_size', 'Requests per batched generate.', buckets=(1, 2, 4, 8, 16, 32, 64))
+QUEUE_DEPTH = REGISTRY.gauge('caption_queue_depth', 'Requests waiting for a batch.')
+
+
+@contextmanager
+def timed(stage: str):
+    # Times the block as `stage`, and counts the exception it raises, if any.
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        ERRORS.inc(stage=stage, error=type(e).__name__)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+def record_generation(tokens: int, seconds: float):
+    GENERATED_TOKENS.inc(tokens)
+    if seconds > 0:
+        TOKENS_PER_SECOND.set(tokens / seconds)
+
+
+def stage_summary(since: dict = None) -> dict:
+    '''
+    {stage: (count, total seconds)}, e.g. for a summary at the end of a run.
+    since: An earlier stage_summary(). STAGE_SECONDS is never reset, so this gives the time spent after it only.
+    '''
+    summary = {key[0]: totals for key, totals in STAGE_SECONDS.totals().items()}
+    if since:
+        summary = {stage: (count - since.get(stage, (0, 0.0))[0], total - since.get(stage, (0, 0.0))[1])
+                   for stage, (count, total) in summary.items()}
+    return {stage: (count, total) for stage, (count, total) in summary.items() if count > 0}
+
+
+def instrument_app(app, registry: Registry = REGISTRY):
+    # Counts the requests of a Flask app per endpoint and status, and serves the registry at /metrics.
+    from flask import Response, g, request
+
+    requests_total = registry.counter('http_requests_total', 'HTTP requests handled.', ['endpoint', 'status'])
+    request_seconds = registry.histogram('http_request_seconds', 'Time to handle a request.', ['endpoint'])
+    in_progress = registry.gauge('http_requests_in_progress', 'HTTP requests being handled.')
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_start = time.perf_counter()
+        in_progress.inc()
+
+    @app.after_request
+    def _record(response):
+        endpoint = request.endpoint or 'unknown'
+        requests_total.inc(endpoint=endpoint, status=response.status_code)
+        request_seconds.observe(time.perf_counter() - g.metrics_start, endpoint=endpoint)
+        return response
+
+    @app.teardown_request
+    def _finish(exception):
+        # Unhandled exceptions still go through after_request, as a 500.
+        in_progress.dec()
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(registry.render(), mimetype=CONTENT_TYPE)
+
+    return app
+
+
+def instrument_aiohttp_app(app, registry: Registry = REGISTRY):
+    # instrument_app for an aiohttp.web application. Call it before the app is started.
+    from aiohttp import web
+
+    requests_total = registry.counter('http_requests_total', 'HTTP requests handled.', ['endpoint', 'status'])
+    request_seconds = registry.histogram('http_request_seconds', 'Time to handle a request.', ['endpoint'])
+    in_progress = registry.gauge('http_requests_in_progress', 'HTTP requests being handled.')
+
+    @web.middleware
+    async def middleware(request, handler):
+        endpoint = request.match_info.route.name or request.path
+        start = time.perf_counter()
+        in_progress.inc()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            in_progress.dec()
+            requests_total.inc(endpoint=endpoint, status=status)
+            request_seconds.observe(time.perf_counter() - start, endpoint=endpoint)
+
+    async def metrics(request):
+        return web.Response(body=registry.render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+    app.middlewares.append(middleware)
+    app.router.add_get('/metrics', metrics, name='metrics')
+    return app
+
+
+def start_metrics_server(port: int, host: str = '0.0.0.0', registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    # Serves /metrics from a background thread, for processes that aren't Flask apps (the captioner).
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,89 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+'''
+Dynamic micro-batching for the local model providers.
+
+Flask handles each /caption request in its own thread. Instead of each thread calling model.generate for one image,
+requests are put in a queue. A single worker thread collects whatever arrived within `max_wait` seconds
+(up to `max_batch_size` requests), runs one batched generate, and hands each result back to the request that asked for it.
+
+    batcher = MicroBatcher(caption_batch, max_batch_size=8, max_wait=0.02)
+    caption = batcher.submit((prompt, image))
+
+`process_batch` gets a list of items and must return a list of results in the same order.
+It doesn't need to know anything about the model, so it can be tested with a stub on CPU.
+'''
+
+
+class MicroBatcher:
+    def __init__(self, process_batch, max_batch_size: int = 8, max_wait: float = 0.02):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def submit_async(self, item) -> Future:
+        if self._stopped.is_set():
+            raise RuntimeError('MicroBatcher has been stopped.')
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def submit(self, item, timeout: float = None):
+        return self.submit_async(item).result(timeout)
+
+    def submit_many(self, items, timeout: float = None) -> list:
+        # The items may be split across batches or merged with other requests' items.
+        futures = [self.submit_async(item) for item in items]
+        return [future.result(timeout) for future in futures]
+
+    def stop(self):
+        self._stopped.set()
+        self._worker.join()
+
+    def _collect(self):
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopped.is_set() or not self._queue.empty():
+            batch = self._collect()
+            if not batch:
+                continue
+            # Skip requests whose caller has already given up.
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                results = self.process_batch([item for item, _ in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f'process_batch returned {len(results)} results for {len(batch)} items.')
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
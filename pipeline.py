@@ -0,0 +1,92 @@
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from image_utils import DEFAULT_FORMAT, DEFAULT_MAX_SIZE, DEFAULT_QUALITY, encode_image, image_to_data_url
+
+
+'''
+Producer/consumer pre-encoding stage.
+
+Decoding, resizing and base64 encoding are CPU-bound. Instead of doing them in the request path (behind the GIL
+and behind the model call), a process pool prepares the image payloads ahead of time. The dispatch stage only
+sends payloads that are ready.
+
+    jobs ──> ProcessPoolExecutor (prepare_payload) ──> bounded queue ──> dispatch
+
+At most `queue_size` payloads are being prepared or waiting to be sent, so memory stays bounded
+however many images there are.
+'''
+
+_DONE = object()
+
+
+def prepare_payload(image, max_size=DEFAULT_MAX_SIZE, format=DEFAULT_FORMAT, quality=DEFAULT_QUALITY, binary=False):
+    # Runs in a worker process. binary: Return (image bytes, mime type) instead of a data url, for the binary transports.
+    if binary:
+        return encode_image(image, max_size, format, quality)
+    return image_to_data_url(image, max_size, format, quality)
+
+
+class PreencodePipeline:
+    def __init__(self, jobs, workers: int = None, queue_size: int = 64, max_size: int = DEFAULT_MAX_SIZE,
+                 format: str = DEFAULT_FORMAT, quality: int = DEFAULT_QUALITY, image_of=lambda job: job[0],
+                 binary: bool = False):
+        '''
+        jobs: Iterable of jobs. `image_of(job)` is the image (path or bytes) to prepare.
+        workers: Number of worker processes. Defaults to os.cpu_count().
+        queue_size: Max number of payloads prepared ahead of dispatch.
+        binary: Prepare (image bytes, mime type) instead of a data url (see transport.py).
+        Iterating the pipeline yields (job, payload or the exception raised while preparing it), in job order.
+        '''
+        self.jobs = jobs
+        self.workers = workers
+        self.queue_size = queue_size
+        self.encode_args = (max_size, format, quality, binary)
+        self.image_of = image_of
+
+    def _produce(self, executor, ready, slots, stop):
+        try:
+            for job in self.jobs:
+                # Backpressure: wait until the consumer has taken a payload before preparing another one.
+                while not slots.acquire(timeout=0.5):
+                    if stop.is_set():
+                        return
+                if stop.is_set():
+                    return
+                ready.put((job, executor.submit(prepare_payload, self.image_of(job), *self.encode_args)))
+        except Exception as e:
+            ready.put((None, e))
+        finally:
+            ready.put(_DONE)
+
+    def __iter__(self):
+        ready = queue.Queue()
+        slots = threading.Semaphore(self.queue_size)
+        stop = threading.Event()
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            producer = threading.Thread(target=self._produce, args=(executor, ready, slots, stop), daemon=True)
+            producer.start()
+            try:
+                while True:
+                    item = ready.get()
+                    if item is _DONE:
+                        break
+                    job, future = item
+                    if job is None:
+                        # The job iterable itself failed.
+                        raise future
+                    try:
+                        payload = future.result()
+                    except Exception as e:
+                        payload = e
+                    slots.release()
+                    yield job, payload
+            finally:
+                stop.set()
+                producer.join()
+                while not ready.empty():
+                    item = ready.get()
+                    if item is not _DONE and item[0] is not None:
+                        item[1].cancel()
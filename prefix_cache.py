@@ -0,0 +1,126 @@
+import copy
+import threading
+from collections import OrderedDict
+
+import torch
+
+from metrics import REGISTRY
+
+
+'''
+KV prefix caching for the local model providers.
+
+With a shared prefix (`--shared-prefix` in the captioner), every prompt starts with the same system turn: the fixed
+captioning instructions (prompts.BASE_PROMPT). Its keys/values are the same for every image, so instead of prefilling
+it again in every generate, it is run through the model once and its KV cache is reused.
+
+    prefix_cache = PrefixCache(model)
+    generate_ids = prefix_cache.generate(inputs, prefix_ids, max_new_tokens=512)
+
+inputs: The batch as the provider builds it (left padded, every row starting with prefix_ids after its padding).
+prefix_ids: The token ids of the shared prefix (1D).
+
+The padding is moved after the prefix ([prefix][padding][rest] instead of [padding][prefix][rest]), so one cached
+prefix fits every row. The attention mask hides the padding, and the position ids are computed from the mask, so the
+model sees exactly the same thing as without the cache. The output has the same length as model.generate's for the
+original inputs, so the generated tokens are still the ones after inputs['input_ids'].shape[1].
+If a row doesn't start with the prefix (no shared prefix, or a different one), the batch is generated without the cache.
+
+The logic doesn't depend on the model: it can be checked on CPU with a tiny randomly initialized model, by comparing
+greedy generations with and without the cache (tests/test_prefix_cache.py does, for a text model and for Qwen2-VL).
+Models whose remote code returns the legacy ((key, value), ...) tuples (Phi-3.5-vision) get them wrapped in a DynamicCache.
+'''
+
+LOOKUPS = REGISTRY.counter('prefix_cache_lookups_total', 'Generates by prefix cache result (hit, miss, bypass).', ['result'])
+REUSED_TOKENS = REGISTRY.counter('prefix_cache_reused_tokens_total', 'Prompt tokens taken from the prefix cache instead of prefilled.')
+
+
+def as_cache(past_key_values):
+    # A Cache as it is, legacy per layer (key, value) tuples wrapped in a DynamicCache.
+    if not isinstance(past_key_values, (tuple, list)):
+        return past_key_values
+    from transformers import DynamicCache
+
+    if hasattr(DynamicCache, 'from_legacy_cache'):
+        return DynamicCache.from_legacy_cache(past_key_values)
+    return DynamicCache(past_key_values)
+
+
+def move_prefix_first(inputs: dict, prefix_length: int, prefix_ids: torch.Tensor = None) -> dict:
+    '''
+    Left padded rows [padding][prefix][rest] -> [prefix][padding][rest], for every tensor shaped like input_ids
+    (attention_mask, token type ids...). Returns None if a row doesn't start with prefix_ids after its padding.
+    '''
+    input_ids, attention_mask = inputs['input_ids'], inputs['attention_mask']
+    padding = (attention_mask == 0).long().argmin(dim=1) # Index of the first real token of each row.
+    if prefix_ids is not None:
+        prefix_ids = prefix_ids.to(input_ids.device)
+        for row, start in zip(input_ids, padding.tolist()):
+            if row.shape[0] - start < prefix_length or not torch.equal(row[start:start + prefix_length], prefix_ids):
+                return None
+
+    length = input_ids.shape[1]
+    positions = torch.arange(length, device=input_ids.device).expand(input_ids.shape[0], -1)
+    # Source index of each target position: the prefix first, then the padding, then the rest.
+    order = torch.where(positions < prefix_length, positions + padding[:, None],
+                        torch.where(positions < prefix_length + padding[:, None], positions - prefix_length, positions))
+    return {key: torch.gather(value, 1, order.to(value.device))
+            if isinstance(value, torch.Tensor) and value.shape == input_ids.shape else value
+            for key, value in inputs.items()}
+
+
+class PrefixCache:
+    def __init__(self, model, max_entries: int = 4, enabled: bool = True):
+        '''
+        max_entries: Prefixes (e.g. system prompts) whose KV cache is kept, least recently used first out.
+        enabled: If False, every generate is a plain model.generate.
+        '''
+        self.model = model
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._entries = OrderedDict() # Prefix token ids -> KV cache of batch size 1.
+        self._lock = threading.Lock()
+
+    def prefix_state(self, prefix_ids: torch.Tensor):
+        key = tuple(prefix_ids.tolist())
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key], True
+
+        with torch.no_grad():
+            state = as_cache(self.model(input_ids=prefix_ids[None].to(self.model.device), use_cache=True).past_key_values)
+        with self._lock:
+            self._entries[key] = state
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return state, False
+
+    def generate(self, inputs: dict, prefix_ids: torch.Tensor = None, **generate_kwargs):
+        reordered = None
+        if self.enabled and prefix_ids is not None and len(prefix_ids) > 0:
+            reordered = move_prefix_first(inputs, len(prefix_ids), prefix_ids)
+        if reordered is None:
+            LOOKUPS.inc(result='bypass')
+            return self.model.generate(**inputs, **generate_kwargs)
+
+        state, hit = self.prefix_state(prefix_ids)
+        LOOKUPS.inc(result='hit' if hit else 'miss')
+        # generate extends the cache in place, the cached prefix is only ever copied.
+        past_key_values = copy.deepcopy(state)
+        batch_size = reordered['input_ids'].shape[0]
+        if batch_size > 1:
+            past_key_values.batch_repeat_interleave(batch_size)
+        REUSED_TOKENS.inc(len(prefix_ids) * batch_size)
+
+        # Qwen2-VL keeps the rope offsets of the last batch. With a non-empty cache it would reuse them instead of
+        # computing this batch's.
+        for module in (self.model, getattr(self.model, 'model', None)):
+            if module is not None and getattr(module, 'rope_deltas', None) is not None:
+                module.rope_deltas = None
+
+        return self.model.generate(**reordered, past_key_values=past_key_values, **generate_kwargs)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
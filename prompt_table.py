@@ -0,0 +1,120 @@
+import argparse
+import json
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from prompts import (ARTIST_TEMPLATE, CHARACTER_TEMPLATE, CHARACTERS_TEMPLATE, GENERAL_TEMPLATE, ORIGINAL_CHARACTER,
+                     PROMPT_TEMPLATE, SERIES_TEMPLATE, Prompt, parse_character)
+from tag_store import FIELDS, PARQUET_COLUMNS, RATINGS
+
+
+'''
+Build the prompt of every image at once and save them in a prompt table (parquet, sorted by id).
+
+Instead of building the prompt one image at a time in the dispatch loop, the whole tag table is turned into prompts
+with pandas string operations. Character/series parsing is done once per distinct character tag.
+The captioner then streams (id, prompt) from the table, and reruns don't rebuild anything.
+
+    python prompt_table.py --tag-store tags.sqlite --output prompts.parquet
+    python prompt_table.py --parquet metadata.parquet --output prompts.parquet
+    python prompt_table.py --tags-dir ./tags --output prompts.parquet
+
+The prompts are exactly the ones generate_prompt (prompts.build_prompt) builds.
+'''
+
+
+def load_tag_table(tag_store_path: str = None, parquet_path: str = None, tags_dir: str = None) -> pd.DataFrame:
+    # Returns a DataFrame with an `id` column and the tag_store.FIELDS columns.
+    if tag_store_path:
+        with sqlite3.connect(tag_store_path) as conn:
+            tags = pd.read_sql_query(f'SELECT id, {", ".join(FIELDS)} FROM tags', conn)
+    elif parquet_path:
+        tags = pd.read_parquet(parquet_path, columns=['id', *PARQUET_COLUMNS.values()])
+        tags = tags.rename(columns={column: field for field, column in PARQUET_COLUMNS.items()})
+        tags['rating'] = tags['rating'].map(lambda rating: RATINGS.get(rating, rating))
+        for field in FIELDS[1:]:
+            # 'long_hair blue_eyes' -> 'long hair, blue eyes'
+            tags[field] = tags[field].fillna('').str.replace('_', ' ', regex=False).str.split().str.join(', ')
+    elif tags_dir:
+        rows = []
+        for filename in os.listdir(tags_dir):
+            image_id, extension = os.path.splitext(filename)
+            if extension != '.json' or not image_id.isdigit():
+                continue
+            with open(os.path.join(tags_dir, filename), 'r') as f:
+                tags_dict = json.load(f)
+            rows.append({'id': int(image_id), **{field: tags_dict.get(field, '') for field in FIELDS}})
+        tags = pd.DataFrame(rows, columns=['id', *FIELDS])
+    else:
+        raise ValueError('One of tag_store_path, parquet_path or tags_dir is required.')
+    return tags
+
+
+def _wrap(template: str, values: pd.Series) -> pd.Series:
+    prefix, suffix = template.split('{}')
+    return prefix + values + suffix
+
+
+def build_prompt_table(tags: pd.DataFrame) -> pd.DataFrame:
+    tags = tags.reset_index(drop=True)
+    for field in FIELDS:
+        tags[field] = tags[field].fillna('').astype(str)
+
+    general = tags['general'] + pd.Series(np.where(tags['rating'] == 'explicit', ', NSFW Image', ''), index=tags.index) + tags['meta']
+
+    # One row per (image, character), parsed once per distinct character tag.
+    characters = tags['character'].str.split(',').explode()
+    characters = characters[characters.str.strip() != '']
+    parsed = {tag: parse_character(tag) for tag in pd.unique(characters)}
+    names = characters.map(lambda tag: parsed[tag][0])
+    has_series = characters.map(lambda tag: parsed[tag][1]).astype(bool)
+
+    count = names.groupby(level=0).size().reindex(tags.index, fill_value=0)
+    joined = names.groupby(level=0).agg(', '.join).reindex(tags.index, fill_value='')
+    any_series = has_series.groupby(level=0).any().reindex(tags.index, fill_value=False).astype(bool)
+
+    series = _wrap(SERIES_TEMPLATE, tags['copyright'])
+    character = pd.Series(np.select(
+        [(count == 1) & any_series, count == 1, (count > 1) & any_series, count > 1],
+        [_wrap(CHARACTER_TEMPLATE, joined) + series,
+         _wrap(CHARACTER_TEMPLATE, joined),
+         _wrap(CHARACTERS_TEMPLATE, joined) + series,
+         _wrap(CHARACTERS_TEMPLATE, joined) + ORIGINAL_CHARACTER],
+        default=''), index=tags.index)
+
+    prompt = _wrap(GENERAL_TEMPLATE, general) + character + _wrap(ARTIST_TEMPLATE, tags['artist'])
+    prompt = _wrap(PROMPT_TEMPLATE, prompt)
+
+    return pd.DataFrame({'id': tags['id'].astype('int64'), 'prompt': prompt, 'characters': count.astype('int32')}) \
+        .sort_values('id').reset_index(drop=True)
+
+
+def write_prompt_table(prompt_table: pd.DataFrame, output_path: str, row_group_size: int = 65536):
+    prompt_table.to_parquet(output_path, index=False, row_group_size=row_group_size)
+
+
+def iter_prompts(prompt_table_path: str, batch_size: int = 65536):
+    # Streams (id, Prompt) without loading the whole table in memory.
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(prompt_table_path).iter_batches(batch_size=batch_size, columns=['id', 'prompt']):
+        columns = batch.to_pydict()
+        for image_id, prompt in zip(columns['id'], columns['prompt']):
+            yield image_id, Prompt(prompt)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the prompt of every image into a prompt table.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--tag-store', help='SQLite tag store built by tag_store.py.')
+    source.add_argument('--parquet', help='metadata.parquet of the danbooru dataset.')
+    source.add_argument('--tags-dir', help='Directory of per-image <id>.json tag files.')
+    parser.add_argument('--output', default='prompts.parquet')
+    args = parser.parse_args()
+
+    prompt_table = build_prompt_table(load_tag_table(args.tag_store, args.parquet, args.tags_dir))
+    write_prompt_table(prompt_table, args.output)
+    print(f"{len(prompt_table)} prompts written to {args.output}")
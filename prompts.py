@@ -0,0 +1,80 @@
+from functools import lru_cache
+
+
+'''
+Prompt templates, shared by generate_prompt (one image at a time) and prompt_table.py (the whole dataset at once),
+so both build exactly the same prompt for the same tags.
+'''
+
+BASE_PROMPT = "Please describe this image based on these tags. The response must include these tags. And should in a word range from 50 to 255. Do not describe anything else. Response the description as sentences (with the following: 'An image of ...'). No need to response as markdown format. If there's tags with 'NSFW images', please make sure to indicate that it is an NSFW image."
+
+GENERAL_TEMPLATE = "Here's some accurate tags for this image: {}. "
+CHARACTER_TEMPLATE = "The character in this image is '{}'."
+CHARACTERS_TEMPLATE = "These characters in this image is '{}'."
+SERIES_TEMPLATE = " The series is '{}'. If you know about the series, response this series is game or anime."
+ORIGINAL_CHARACTER = " The image shows a original character."
+ARTIST_TEMPLATE = "This image is created by artist {}"
+PROMPT_TEMPLATE = "{}. " + BASE_PROMPT
+
+
+class Prompt(str):
+    # A prompt that has already been built (e.g. read from a prompt table), so it's sent as is.
+    pass
+
+
+@lru_cache(maxsize=65536)
+def parse_character(character_tag: str):
+    '''
+    'hatsune miku (vocaloid)' -> ('hatsune miku', True)
+    'hatsune miku'            -> ('hatsune miku', False)
+    The same characters show up again and again in the dataset, so the result is cached.
+    '''
+    character_tag = character_tag.strip()
+    if '(' in character_tag and ')' in character_tag:
+        return character_tag.split('(')[0].strip(), True
+    return character_tag, False
+
+
+def split_characters(character_tags) -> tuple:
+    # 'a, b' or ['a', 'b'] -> ('a', 'b'). Empty tags are dropped.
+    if isinstance(character_tags, str):
+        character_tags = character_tags.split(',')
+    return tuple(tag for tag in character_tags if tag and tag.strip())
+
+
+@lru_cache(maxsize=65536)
+def character_prompt(characters: tuple, copyright_tags: str) -> str:
+    if not characters:
+        return ''
+
+    parsed = [parse_character(character) for character in characters]
+    has_series = any(series for _, series in parsed)
+    if len(parsed) == 1:
+        prompt = CHARACTER_TEMPLATE.format(parsed[0][0])
+        if has_series:
+            prompt += SERIES_TEMPLATE.format(copyright_tags)
+        return prompt
+
+    prompt = CHARACTERS_TEMPLATE.format(', '.join(name for name, _ in parsed))
+    if has_series:
+        prompt += SERIES_TEMPLATE.format(copyright_tags)
+    else:
+        prompt += ORIGINAL_CHARACTER
+    return prompt
+
+
+def split_prompt(prompt: str) -> tuple:
+    '''
+    A prompt -> (system, prompt) with the fixed instructions (BASE_PROMPT) as the system turn, for the providers'
+    prefix cache (see prefix_cache.py). Prompts that don't end with BASE_PROMPT are returned as (None, prompt).
+    '''
+    if not prompt.endswith(BASE_PROMPT):
+        return None, prompt
+    return BASE_PROMPT, prompt[:-len(BASE_PROMPT)].rstrip()
+
+
+def build_prompt(general_tags: str, character_tags, copyright_tags: str, artist_tags: str) -> str:
+    prompt = GENERAL_TEMPLATE.format(general_tags)
+    prompt += character_prompt(split_characters(character_tags), copyright_tags)
+    prompt += ARTIST_TEMPLATE.format(artist_tags)
+    return PROMPT_TEMPLATE.format(prompt)
@@ -0,0 +1,193 @@
+import asyncio
+import base64
+import io
+import math
+import re
+import time
+
+from PIL import Image
+
+from image_utils import is_data_url, split_data_url
+from metrics import REGISTRY
+
+
+'''
+Client-side rate limiting for remote apis with requests-per-minute (RPM) and tokens-per-minute (TPM) quotas.
+
+Instead of finding out about the quota from a 429 and backing off (throttling, then idling), every request waits for
+its turn here: one token bucket for requests, one for tokens, both refilled continuously. Requests are queued (FIFO),
+never failed.
+
+- The token cost of a request is estimated before sending it: prompt text (~4 characters per token) + image tokens
+  (OpenAI's tile formula) + the expected completion length (a running average of the real ones).
+  Once the response arrives, the bucket is corrected with the real usage.
+- x-ratelimit-* response headers (OpenAI, OpenRouter, Mistral style) override the local view: the limits become
+  the bucket sizes, the remaining budget is never assumed to be larger than what the server says, and an exhausted
+  budget pauses the limiter until its reset time.
+- A 429 anyway pauses the limiter for Retry-After seconds.
+
+    limiter = RateLimiter(rpm=500, tpm=200000, name='openai')
+    cost = limiter.estimate(prompt, image_data_url, max_tokens) # Reads the image header: in an executor on an event loop.
+    await limiter.acquire(cost)
+    ... send ...
+    limiter.update_from_headers(response.headers)
+    limiter.record_usage(cost, response_json.get('usage'))
+'''
+
+WAITING = REGISTRY.gauge('rate_limiter_waiting', 'Requests queued by the rate limiter.', ['backend'])
+WAIT_SECONDS = REGISTRY.histogram('rate_limiter_wait_seconds', 'Time a request waited for its rate limit budget.', ['backend'])
+
+
+def parse_duration(value: str) -> float:
+    # x-ratelimit-reset-* values: '1s', '6m0s', '20ms', '1h2m3.5s' or plain seconds.
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    parts = re.findall(r'([\d.]+)(ms|h|m|s)', value)
+    if not parts:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def image_tokens(width: int, height: int, detail: str = 'high') -> int:
+    # OpenAI's vision pricing: fit in 2048x2048, shortest side to 768, then 170 tokens per 512px tile + 85.
+    if detail == 'low':
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def data_url_size(image_data_url: str):
+    # Only the image header is parsed, not the pixels. Still a base64 decode: on an event loop, run it in an executor.
+    if not is_data_url(image_data_url):
+        return None
+    with Image.open(io.BytesIO(base64.b64decode(split_data_url(image_data_url)[1]))) as img:
+        return img.size
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / 60.0
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        # Seconds until `amount` is available. A request larger than the bucket only waits for a full bucket.
+        self.refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def consume(self, amount: float):
+        # Can go below 0, e.g. when the real usage was higher than estimated. Later requests then wait longer.
+        self.refill()
+        self.level -= amount
+
+
+class RateLimiter:
+    def __init__(self, rpm: float = None, tpm: float = None, name: str = 'backend', chars_per_token: float = 4.0,
+                 expected_completion_tokens: int = 300):
+        '''
+        rpm, tpm: The quota. None means unlimited.
+        expected_completion_tokens: Initial guess of a caption's length, refined with the real usage.
+        '''
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.chars_per_token = chars_per_token
+        self.completion_tokens = expected_completion_tokens
+        self._paused_until = 0.0
+        self._lock = None
+
+    def estimate(self, prompt: str, image_data_url: str = None, max_tokens: int = None, image_size: tuple = None) -> int:
+        '''
+        image_size: (width, height) of the image, if already known. Otherwise it's read from image_data_url (blocking).
+        '''
+        tokens = math.ceil(len(prompt or '') / self.chars_per_token)
+        if image_size is None and image_data_url is not None:
+            image_size = data_url_size(image_data_url) or (1024, 1024)
+        if image_size is not None:
+            tokens += image_tokens(*image_size)
+        completion = self.completion_tokens if max_tokens is None else min(self.completion_tokens, max_tokens)
+        return tokens + math.ceil(completion)
+
+    async def acquire(self, tokens: int = 0):
+        if self.requests is None and self.tokens is None:
+            return
+        if self._lock is None:
+            # Created lazily, on the event loop that uses it.
+            self._lock = asyncio.Lock()
+        start = time.monotonic()
+        WAITING.inc(backend=self.name)
+        try:
+            # One request at a time takes its budget, in arrival order.
+            async with self._lock:
+                while True:
+                    wait = max(self._paused_until - time.monotonic(),
+                               self.requests.wait_time(1) if self.requests else 0.0,
+                               self.tokens.wait_time(tokens) if self.tokens else 0.0)
+                    if wait <= 0:
+                        break
+                    await asyncio.sleep(wait)
+                if self.requests:
+                    self.requests.consume(1)
+                if self.tokens:
+                    self.tokens.consume(tokens)
+        finally:
+            WAITING.dec(backend=self.name)
+            WAIT_SECONDS.observe(time.monotonic() - start, backend=self.name)
+
+    def record_usage(self, estimated: int, usage: dict = None):
+        # Correct the token bucket with the real usage of a request.
+        if not usage:
+            return
+        completion = usage.get('completion_tokens')
+        if completion is not None:
+            self.completion_tokens = 0.8 * self.completion_tokens + 0.2 * completion
+        total = usage.get('total_tokens')
+        if total is not None and self.tokens is not None:
+            self.tokens.consume(total - estimated)
+
+    def update_from_headers(self, headers):
+        for kind, bucket in (('requests', self.requests), ('tokens', self.tokens)):
+            limit = headers.get(f'x-ratelimit-limit-{kind}')
+            remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+            if limit is None and remaining is None:
+                continue
+            if bucket is None:
+                # No quota was configured, but the server has one: use it.
+                if limit is None:
+                    continue
+                bucket = TokenBucket(float(limit))
+                setattr(self, kind, bucket)
+                print(f'{self.name}: rate limit of {limit} {kind}/min taken from the response headers.')
+            if limit is not None and float(limit) != bucket.capacity:
+                # The configured quota was wrong (or the quota changed).
+                bucket.capacity = float(limit)
+            if remaining is not None:
+                bucket.refill()
+                bucket.level = min(bucket.level, float(remaining))
+                reset = parse_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+                if float(remaining) <= 0 and reset:
+                    self._paused_until = max(self._paused_until, time.monotonic() + reset)
+
+    def on_rate_limited(self, retry_after: float = None):
+        # A 429 anyway: nothing is sent until the server says so (or for a second if it doesn't).
+        self._paused_until = max(self._paused_until, time.monotonic() + (retry_after or 1.0))
+        if self.tokens:
+            self.tokens.level = min(self.tokens.level, 0)
@@ -0,0 +1,97 @@
+import argparse
+import hashlib
+import os
+
+from caption_sink import TxtSink, read_shards
+
+
+'''
+Deterministic sharding of the captioning job across processes and hosts.
+
+Every image id goes to shard `hash(id) % num_shards`, with a stable hash (not Python's hash(), which changes per process).
+Run one captioner per shard with the same --num-shards and its own --shard-index. Every host computes the same partition
+without talking to each other, and the shards are disjoint.
+
+Check that the shards together cover the dataset (and copy them into one directory):
+    python sharding.py --num-shards 4 --image-dir ./image --outputs ./NL-captions-0 ./NL-captions-1 ... --merged ./NL-captions
+'''
+
+
+def shard_of(image_id, num_shards: int) -> int:
+    digest = hashlib.blake2b(str(image_id).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') % num_shards
+
+
+def in_shard(image_id, num_shards: int, shard_index: int) -> bool:
+    return num_shards <= 1 or shard_of(image_id, num_shards) == shard_index
+
+
+def check_shard_args(num_shards: int, shard_index: int):
+    if num_shards < 1 or not 0 <= shard_index < num_shards:
+        raise ValueError(f'shard_index must be in [0, {num_shards}), got {shard_index}.')
+
+
+def read_captions(output_dir: str):
+    # (id, caption) from a directory of <id>.txt files and/or caption shards.
+    for name in sorted(os.listdir(output_dir)):
+        if name.endswith('.txt'):
+            with open(os.path.join(output_dir, name), 'r', encoding='UTF-8') as f:
+                yield os.path.splitext(name)[0], f.read()
+    yield from read_shards(output_dir)
+
+
+def merge_shards(output_dirs: list, expected_ids: set, num_shards: int, merged_dir: str = None) -> dict:
+    '''
+    output_dirs: Output directory of each shard. (Several shards may share one.)
+    expected_ids: Every image id that should have a caption.
+    merged_dir: If set, every caption is written there as <id>.txt.
+    Returns a report: missing ids per shard, ids captioned by a shard they don't belong to, and ids captioned more than once.
+    '''
+    sink = TxtSink(merged_dir) if merged_dir else None
+    seen = {}
+    duplicates = set()
+    unexpected = set()
+    for output_dir in dict.fromkeys(output_dirs):
+        for image_id, caption in read_captions(output_dir):
+            image_id = str(image_id)
+            if image_id in seen:
+                duplicates.add(image_id)
+                continue
+            seen[image_id] = output_dir
+            if image_id not in expected_ids:
+                unexpected.add(image_id)
+            if sink is not None:
+                sink.write(image_id, caption)
+
+    missing = {shard_index: [] for shard_index in range(num_shards)}
+    for image_id in expected_ids - seen.keys():
+        missing[shard_of(image_id, num_shards)].append(image_id)
+
+    return {
+        'expected': len(expected_ids),
+        'captioned': len(seen.keys() & expected_ids),
+        'missing': {shard_index: sorted(ids) for shard_index, ids in missing.items()},
+        'duplicates': sorted(duplicates),
+        'unexpected': sorted(unexpected),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check the coverage of sharded caption outputs and merge them.')
+    parser.add_argument('--num-shards', type=int, required=True)
+    parser.add_argument('--image-dir', required=True, help='The full image directory, every .webp in it should have a caption.')
+    parser.add_argument('--outputs', nargs='+', required=True, help='Output directories of the shards.')
+    parser.add_argument('--merged', default=None, help='Write every caption here as <id>.txt.')
+    args = parser.parse_args()
+
+    expected_ids = {os.path.splitext(name)[0] for name in os.listdir(args.image_dir) if name.endswith('.webp')}
+    report = merge_shards(args.outputs, expected_ids, args.num_shards, args.merged)
+
+    print(f"Captioned {report['captioned']} / {report['expected']} images.")
+    for shard_index, ids in report['missing'].items():
+        if ids:
+            print(f"Shard {shard_index}: {len(ids)} missing, e.g. {', '.join(ids[:5])}")
+    if report['duplicates']:
+        print(f"{len(report['duplicates'])} images were captioned by more than one shard, e.g. {', '.join(report['duplicates'][:5])}")
+    if report['unexpected']:
+        print(f"{len(report['unexpected'])} captions have no image in {args.image_dir}, e.g. {', '.join(report['unexpected'][:5])}")
@@ -0,0 +1,150 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+
+from tqdm import tqdm
+
+
+'''
+All tags in one indexed SQLite file, instead of one tags/<id>.json per image.
+
+Opening millions of small json files (and stat-ing them first) is slow, especially on a network filesystem.
+A lookup here is a primary key lookup in one file.
+
+Build it from the per-image json files:
+    python tag_store.py --tags-dir ./tags --output tags.sqlite
+or directly from the dataset metadata:
+    python tag_store.py --parquet metadata.parquet --output tags.sqlite
+'''
+
+FIELDS = ('rating', 'general', 'meta', 'character', 'copyright', 'artist')
+
+# metadata.parquet of deepghs/danbooru2024 uses danbooru's column names and one letter ratings.
+PARQUET_COLUMNS = {
+    'rating': 'rating',
+    'general': 'tag_string_general',
+    'meta': 'tag_string_meta',
+    'character': 'tag_string_character',
+    'copyright': 'tag_string_copyright',
+    'artist': 'tag_string_artist',
+}
+RATINGS = {'g': 'general', 's': 'sensitive', 'q': 'questionable', 'e': 'explicit'}
+
+SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS tags (
+    id INTEGER PRIMARY KEY,
+    {', '.join(f'{field} TEXT' for field in FIELDS)}
+)
+'''
+
+
+def _connect_for_write(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute(SCHEMA)
+    return conn
+
+
+def _insert(conn, rows):
+    conn.executemany(f'INSERT OR REPLACE INTO tags (id, {", ".join(FIELDS)}) VALUES ({", ".join("?" * (len(FIELDS) + 1))})', rows)
+
+
+def build_from_json(db_path: str, tags_dir: str, batch_size: int = 10000):
+    conn = _connect_for_write(db_path)
+    rows = []
+    with conn:
+        for filename in tqdm(os.listdir(tags_dir), desc='Building tag store'):
+            image_id, extension = os.path.splitext(filename)
+            if extension != '.json' or not image_id.isdigit():
+                continue
+            with open(os.path.join(tags_dir, filename), 'r') as f:
+                tags_dict = json.load(f)
+            rows.append((int(image_id), *(tags_dict.get(field, '') for field in FIELDS)))
+            if len(rows) >= batch_size:
+                _insert(conn, rows)
+                rows = []
+        _insert(conn, rows)
+    conn.close()
+
+
+def _danbooru_tags(tag_string):
+    # 'long_hair blue_eyes' -> 'long hair, blue eyes'
+    if not tag_string:
+        return ''
+    return ', '.join(tag.replace('_', ' ') for tag in tag_string.split())
+
+
+def build_from_parquet(db_path: str, parquet_path: str, batch_size: int = 65536):
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(parquet_path)
+    conn = _connect_for_write(db_path)
+    with conn:
+        progress = tqdm(total=parquet_file.metadata.num_rows, desc='Building tag store')
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=['id', *PARQUET_COLUMNS.values()]):
+            columns = batch.to_pydict()
+            rows = []
+            for i, image_id in enumerate(columns['id']):
+                rating = columns[PARQUET_COLUMNS['rating']][i]
+                rows.append((int(image_id), RATINGS.get(rating, rating),
+                             *(_danbooru_tags(columns[PARQUET_COLUMNS[field]][i]) for field in FIELDS[1:])))
+            _insert(conn, rows)
+            progress.update(len(rows))
+        progress.close()
+    conn.close()
+
+
+class TagStore:
+    '''
+    store = TagStore('tags.sqlite')
+    store.get(12345) -> {'id': 12345, 'rating': 'general', 'general': '...', 'meta': '...', 'character': '...', 'copyright': '...', 'artist': '...'}
+
+    Safe to use from several threads (each thread gets its own read-only connection).
+    '''
+    def __init__(self, db_path: str):
+        if not os.path.exists(db_path):
+            raise FileNotFoundError(f'Tag store {db_path} not found. Build it with tag_store.py first.')
+        self.db_path = db_path
+        self._local = threading.local()
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True, check_same_thread=False)
+            self._local.conn = conn
+        return conn
+
+    def get(self, image_id):
+        row = self._conn.execute(f'SELECT {", ".join(FIELDS)} FROM tags WHERE id = ?', (int(image_id),)).fetchone()
+        if row is None:
+            return None
+        return {'id': int(image_id), **dict(zip(FIELDS, row))}
+
+    def __contains__(self, image_id):
+        return self._conn.execute('SELECT 1 FROM tags WHERE id = ?', (int(image_id),)).fetchone() is not None
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM tags').fetchone()[0]
+
+    def ids(self):
+        for (image_id,) in self._conn.execute('SELECT id FROM tags ORDER BY id'):
+            yield image_id
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compile tags into one indexed SQLite file.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--tags-dir', help='Directory of per-image <id>.json tag files.')
+    source.add_argument('--parquet', help='metadata.parquet of the danbooru dataset.')
+    parser.add_argument('--output', default='tags.sqlite')
+    args = parser.parse_args()
+
+    if args.tags_dir:
+        build_from_json(args.output, args.tags_dir)
+    else:
+        build_from_parquet(args.output, args.parquet)
+    print(f"Tag store written to {args.output}")
@@ -0,0 +1,174 @@
+import argparse
+import json
+import mmap
+import os
+import sqlite3
+import tarfile
+import threading
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+from tqdm import tqdm
+
+
+'''
+Read images in place from the dataset's tar archives, instead of extracting millions of files first.
+
+1. Download the archives (not extracted), e.g.
+       huggingface-cli download deepghs/danbooru2024-sfw --repo-type dataset --include "images/*" --local-dir .
+2. Build an offset index once:
+       python tar_source.py --tars ./images/*.tar --output tar_index.sqlite
+   If an archive has an index json next to it (images/0000.json, {"files": {name: {"offset", "size"}}}), it's used
+   instead of scanning the archive.
+3. Caption with `python caption_based_on_tag.py --tar-index tar_index.sqlite`.
+
+An image is a TarMember (archive path, offset, size). Reading it is a slice of the memory-mapped archive,
+so worker processes (see pipeline.py) can read it themselves and only the small TarMember is sent to them.
+'''
+
+IMAGE_EXTENSIONS = ('.webp', '.png', '.jpg', '.jpeg')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS members (
+    id TEXT PRIMARY KEY,
+    tar_path TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL
+)
+'''
+
+# Memory maps opened by this process, shared by every TarMember of the same archive.
+_mmaps = {}
+_mmaps_lock = threading.Lock()
+
+
+def _mmap_of(tar_path: str) -> mmap.mmap:
+    with _mmaps_lock:
+        mapped = _mmaps.get(tar_path)
+        if mapped is None:
+            with open(tar_path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            _mmaps[tar_path] = mapped
+        return mapped
+
+
+class TarMember:
+    def __init__(self, image_id: str, tar_path: str, offset: int, size: int):
+        self.image_id = image_id
+        self.tar_path = tar_path
+        self.offset = offset
+        self.size = size
+
+    def read_bytes(self) -> bytes:
+        return _mmap_of(self.tar_path)[self.offset:self.offset + self.size]
+
+    def to_url(self) -> str:
+        # tar:///data/images/0000.tar?offset=1536&size=123456#12345
+        return f'tar://{quote(os.path.abspath(self.tar_path))}?offset={self.offset}&size={self.size}#{self.image_id}'
+
+    @classmethod
+    def from_url(cls, url: str):
+        parsed = urlparse(url)
+        query = parse_qs(parsed.query)
+        return cls(parsed.fragment, unquote(parsed.path), int(query['offset'][0]), int(query['size'][0]))
+
+    def __str__(self):
+        return self.to_url()
+
+    def __repr__(self):
+        return f'TarMember({self.image_id!r}, {self.tar_path!r}, {self.offset}, {self.size})'
+
+
+def image_ref_from_string(image: str):
+    # Inverse of str(): a path stays a path, a tar:// url becomes a TarMember.
+    if image.startswith('tar://'):
+        return TarMember.from_url(image)
+    return image
+
+
+def _members_from_json(tar_path: str, json_path: str):
+    with open(json_path, 'r') as f:
+        files = json.load(f)['files']
+    for name, info in files.items():
+        yield name, info['offset'], info['size']
+
+
+def _members_from_scan(tar_path: str):
+    # Only the headers are read, the data of each member is skipped with a seek.
+    with tarfile.open(tar_path, 'r:') as tar:
+        for member in tar:
+            if member.isfile():
+                yield member.name, member.offset_data, member.size
+
+
+def build_tar_index(tar_paths: list, index_path: str, batch_size: int = 10000):
+    conn = sqlite3.connect(index_path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(SCHEMA)
+    with conn:
+        for tar_path in tqdm(tar_paths, desc='Indexing tar archives'):
+            tar_path = os.path.abspath(tar_path)
+            json_path = os.path.splitext(tar_path)[0] + '.json'
+            members = _members_from_json(tar_path, json_path) if os.path.exists(json_path) else _members_from_scan(tar_path)
+
+            rows = []
+            for name, offset, size in members:
+                image_id, extension = os.path.splitext(os.path.basename(name))
+                if extension.lower() not in IMAGE_EXTENSIONS:
+                    continue
+                rows.append((image_id, tar_path, offset, size))
+                if len(rows) >= batch_size:
+                    conn.executemany('INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?)', rows)
+                    rows = []
+            conn.executemany('INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?)', rows)
+    conn.close()
+
+
+class TarImageSource:
+    '''
+    source = TarImageSource('tar_index.sqlite')
+    for image_id, member in source:   # In archive order, so the archives are read sequentially.
+        data = member.read_bytes()
+    source.member('12345') -> TarMember or None
+    '''
+    def __init__(self, index_path: str):
+        if not os.path.exists(index_path):
+            raise FileNotFoundError(f'Tar index {index_path} not found. Build it with tar_source.py first.')
+        self.index_path = index_path
+        self._local = threading.local()
+
+    @property
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(f'file:{self.index_path}?mode=ro', uri=True, check_same_thread=False)
+            self._local.conn = conn
+        return conn
+
+    def member(self, image_id):
+        row = self._conn.execute('SELECT tar_path, offset, size FROM members WHERE id = ?', (str(image_id),)).fetchone()
+        if row is None:
+            return None
+        return TarMember(str(image_id), *row)
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM members').fetchone()[0]
+
+    def __iter__(self):
+        # A separate connection, so lookups with member() can run while iterating.
+        conn = sqlite3.connect(f'file:{self.index_path}?mode=ro', uri=True)
+        try:
+            for image_id, tar_path, offset, size in conn.execute(
+                    'SELECT id, tar_path, offset, size FROM members ORDER BY tar_path, offset'):
+                yield image_id, TarMember(image_id, tar_path, offset, size)
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build an offset index of the images in tar archives.')
+    parser.add_argument('--tars', nargs='+', required=True, help='The tar archives, e.g. ./images/*.tar')
+    parser.add_argument('--output', default='tar_index.sqlite')
+    args = parser.parse_args()
+
+    build_tar_index(args.tars, args.output)
+    print(f"Tar index written to {args.output}")
@@ -0,0 +1,64 @@
+import json
+import os
+import socket
+import sys
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+import caption_based_on_tag
+from mock_server import start_mock_server
+from sharding import shard_of
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def make_dataset(data_dir, count: int):
+    # <data_dir>/image/<id>.webp and <data_dir>/tags/<id>.json, like the crawled dataset.
+    image_dir, tags_dir = os.path.join(data_dir, 'image'), os.path.join(data_dir, 'tags')
+    os.makedirs(image_dir)
+    os.makedirs(tags_dir)
+    for i in range(count):
+        Image.new('RGB', (64 + i, 48), (i * 40 % 256, 90, 160)).save(os.path.join(image_dir, f'{i}.webp'))
+        with open(os.path.join(tags_dir, f'{i}.json'), 'w') as f:
+            json.dump({'rating': 'general', 'general': '1girl, solo, smile', 'meta': '', 'character': '',
+                       'copyright': '', 'artist': f'artist_{i}'}, f)
+    return image_dir, tags_dir
+
+
+def test_a_run_without_cache_after_a_run_with_one(tmp_path):
+    image_dir, tags_dir = make_dataset(str(tmp_path / 'data'), 6)
+    api_url = start_mock_server(free_port(), latency=0.0, jitter=0.0)
+
+    cached_output, uncached_output = str(tmp_path / 'cached'), str(tmp_path / 'uncached')
+    caption_based_on_tag.main(tags_dir, image_dir, cached_output, api_url=api_url, cache_path=str(tmp_path / 'cache.db'))
+    caption_based_on_tag.main(tags_dir, image_dir, uncached_output, api_url=api_url)
+
+    assert len(os.listdir(cached_output)) == 6
+    assert len(os.listdir(uncached_output)) == 6
+    assert caption_based_on_tag.caption_cache is None
+
+
+class RecordingTagStore:
+    # Stands in for a TagStore, records the ids whose tags were looked up.
+    def __init__(self):
+        self.looked_up = []
+
+    def get(self, image_id):
+        self.looked_up.append(image_id)
+        return {'general': 'solo'}
+
+
+def test_other_shards_are_skipped_before_their_tags_are_looked_up(tmp_path):
+    image_dir, tags_dir = make_dataset(str(tmp_path / 'data'), 12)
+    tag_store = RecordingTagStore()
+    jobs = list(caption_based_on_tag.collect_jobs(tags_dir, image_dir, str(tmp_path / 'out'), tag_store, set(),
+                                                  num_shards=3, shard_index=1))
+
+    ids = [os.path.splitext(os.path.basename(image_path))[0] for image_path, _, _ in jobs]
+    assert ids and all(shard_of(image_id, 3) == 1 for image_id in ids)
+    assert tag_store.looked_up == ids
@@ -0,0 +1,100 @@
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+
+import pytest
+
+from caption_sink import open_sink
+from job_manifest import DONE, JobManifest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Captions 120 images like the captioner does (mark_done from on_written), then dies without closing anything,
+# in the middle of the second shard.
+CRASHING_RUN = textwrap.dedent('''
+    import os, sys
+    sys.path.insert(0, {root!r})
+    from caption_sink import open_sink
+    from job_manifest import JobManifest
+
+    manifest = JobManifest({db!r})
+    manifest.add_jobs((f'/images/{{i:04d}}.jpg', 'tags.json', '') for i in range(200))
+    sink = open_sink({output_format!r}, {output_dir!r}, shard_size=50, flush_every=10, fsync_interval=0)
+    for i, (image_path, _, _) in enumerate(manifest.iter_claimed(batch_size=10)):
+        if i == 120:
+            os._exit(1)
+        image_id = os.path.splitext(os.path.basename(str(image_path)))[0]
+        sink.write(image_id, f'caption {{image_id}}', on_written=lambda image_id=image_id: manifest.mark_done(image_id))
+''')
+
+
+def done_ids(manifest: JobManifest) -> set:
+    with manifest._lock:
+        return {row[0] for row in manifest._conn.execute('SELECT id FROM jobs WHERE status = ?', (DONE,))}
+
+
+@pytest.mark.parametrize('output_format', ['jsonl', 'parquet'])
+def test_done_ids_survive_a_crash_mid_shard(tmp_path, output_format):
+    if output_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    db, output_dir = str(tmp_path / 'manifest.db'), str(tmp_path / 'captions')
+    script = CRASHING_RUN.format(root=ROOT, db=db, output_format=output_format, output_dir=output_dir)
+    assert subprocess.run([sys.executable, '-c', script]).returncode == 1
+    assert any(name.endswith('.part') for name in os.listdir(output_dir))
+
+    manifest = JobManifest(db)
+    manifest.recover()
+    sink = open_sink(output_format, output_dir)
+    try:
+        done, captioned = done_ids(manifest), sink.captioned_ids()
+        assert done, 'nothing was marked done before the crash'
+        assert done <= captioned
+        if output_format == 'jsonl':
+            assert len(done) == 120
+        else:
+            assert len(done) == 100 # Only the finished shards.
+    finally:
+        sink.close()
+        manifest.close()
+
+
+@pytest.mark.parametrize('output_format', ['jsonl', 'parquet'])
+def test_captioned_ids_only_reads_its_own_prefix(tmp_path, output_format):
+    if output_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    for prefix, ids in [('captions', ['a', 'b "quoted"']), ('captions-000-of-004', ['c'])]:
+        sink = open_sink(output_format, str(tmp_path), prefix=prefix)
+        for image_id in ids:
+            sink.write(image_id, f'caption of {image_id}, {{"id": "not this"}}')
+        sink.close()
+
+    sink = open_sink(output_format, str(tmp_path), prefix='captions')
+    try:
+        assert sink.captioned_ids() == {'a', 'b "quoted"'}
+    finally:
+        sink.close()
+    assert sorted(os.listdir(tmp_path)) == [f'captions-000-of-004-00000.{output_format}', f'captions-00000.{output_format}']
+
+
+def test_buffered_captions_are_written_after_fsync_interval(tmp_path):
+    # Far fewer captions than flush_every, and no write after them.
+    sink = open_sink('jsonl', str(tmp_path), flush_every=1000, fsync_interval=0.1)
+    written = threading.Event()
+    try:
+        sink.write('a', 'caption of a')
+        sink.write('b', 'caption of b', on_written=written.set)
+        assert written.wait(5)
+        with open(os.path.join(tmp_path, 'captions-00000.jsonl.part')) as f:
+            assert len(f.readlines()) == 2
+    finally:
+        sink.close()
+
+
+def test_shard_sink_is_abstract(tmp_path):
+    from caption_sink import _ShardSink
+
+    with pytest.raises(TypeError):
+        _ShardSink(str(tmp_path))
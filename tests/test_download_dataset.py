@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+
+from download_dataset import DownloadLedger, download
+
+
+class FlakyPool:
+    # Writes <id>.webp for every id, except the ones in `failing`, which it skips silently like the real pool does.
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.requested = []
+
+    def batch_download_to_directory(self, resource_ids, dst_dir, max_workers=None, silent=False):
+        self.requested.extend(resource_ids)
+        for image_id in resource_ids:
+            if image_id not in self.failing:
+                with open(os.path.join(dst_dir, f'{image_id}.webp'), 'wb') as f:
+                    f.write(b'image')
+
+
+def test_failed_downloads_stay_pending(tmp_path):
+    metadata_path = str(tmp_path / 'metadata.parquet')
+    pq.write_table(pa.table({'id': list(range(1, 11))}), metadata_path)
+    images_dir = str(tmp_path / 'images')
+    os.makedirs(images_dir)
+    ledger = DownloadLedger(str(tmp_path / 'ledger.sqlite'))
+    try:
+        download(FlakyPool(failing={3, 7}), metadata_path, images_dir, ledger, chunk_size=4)
+        assert len(ledger) == 8
+        assert ledger.filter_new(list(range(1, 11))) == [3, 7]
+
+        retry = FlakyPool()
+        download(retry, metadata_path, images_dir, ledger, chunk_size=4)
+        assert retry.requested == [3, 7]
+        assert len(ledger) == 10
+    finally:
+        ledger.close()
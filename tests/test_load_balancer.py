@@ -0,0 +1,52 @@
+import os
+import socket
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from load_balancer import LoadBalancer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from mock_server import start_mock_server
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_half_open_backend_gets_a_single_probe():
+    balancer = LoadBalancer(['http://127.0.0.1:9/a/caption', 'http://127.0.0.1:9/b/caption'], health_interval=0,
+                            eject_time=0.05)
+    ejected, healthy = balancer.backends
+    try:
+        ejected.client.breaker.trip()
+        assert not ejected.available
+        time.sleep(0.1) # Half-open: ready for one probe.
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            picked = list(executor.map(lambda _: balancer.pick(), range(32)))
+        assert picked.count(ejected) == 1
+        assert picked.count(healthy) == 31
+
+        ejected.client.breaker.record_success()
+        assert ejected.available
+    finally:
+        balancer.close()
+
+
+def test_passing_health_checks_dont_bring_back_an_ejected_backend():
+    # The failing server is up (its /health answers 200) but every /caption fails with 503.
+    failing = start_mock_server(free_port(), latency=0.0, jitter=0.0, error_rate=1.0, decode=False)
+    working = start_mock_server(free_port(), latency=0.0, jitter=0.0, decode=False)
+    balancer = LoadBalancer([failing, working], health_interval=0.05, failure_threshold=2, eject_time=30)
+    try:
+        for _ in range(30):
+            assert 'caption' in balancer.post_json({'prompt': 'Describe it.', 'image': 'unused'})
+            time.sleep(0.01)
+        failing_backend = balancer.backends[0]
+        assert not failing_backend.available
+        assert failing_backend.requests <= 2
+    finally:
+        balancer.close()
@@ -0,0 +1,82 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from micro_batcher import MicroBatcher
+
+
+class RecordingBatch:
+    # A stub process_batch: echoes every item, records the batches it was given.
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.batches = []
+        self._lock = threading.Lock()
+
+    def __call__(self, items):
+        with self._lock:
+            self.batches.append(list(items))
+        time.sleep(self.delay)
+        return [f'result of {item}' for item in items]
+
+
+@pytest.fixture
+def recording():
+    return RecordingBatch(delay=0.01)
+
+
+@pytest.fixture
+def batcher(recording):
+    batcher = MicroBatcher(recording, max_batch_size=4, max_wait=0.05)
+    yield batcher
+    batcher.stop()
+
+
+def test_every_caller_gets_its_own_result(batcher, recording):
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(batcher.submit, range(40)))
+    assert results == [f'result of {i}' for i in range(40)]
+    assert all(len(batch) <= 4 for batch in recording.batches)
+    assert len(recording.batches) < 40 # Concurrent requests were batched together.
+    assert sorted(item for batch in recording.batches for item in batch) == list(range(40))
+
+
+def test_submit_many_keeps_the_order_of_its_items(batcher, recording):
+    items = list(range(10))
+    assert batcher.submit_many(items) == [f'result of {i}' for i in items]
+    # Split across batches in submission order.
+    assert [item for batch in recording.batches for item in batch] == items
+
+
+def test_a_failing_batch_fails_only_its_requests():
+    def process_batch(items):
+        if 'bad' in items:
+            raise ValueError('bad item')
+        return list(items)
+
+    batcher = MicroBatcher(process_batch, max_batch_size=1, max_wait=0.0)
+    try:
+        with pytest.raises(ValueError):
+            batcher.submit('bad', timeout=5)
+        assert batcher.submit('good', timeout=5) == 'good'
+    finally:
+        batcher.stop()
+
+
+def test_wrong_number_of_results_is_an_error():
+    batcher = MicroBatcher(lambda items: items[:-1], max_batch_size=8, max_wait=0.0)
+    try:
+        with pytest.raises(RuntimeError, match='returned 0 results for 1 items'):
+            batcher.submit('item', timeout=5)
+    finally:
+        batcher.stop()
+
+
+def test_stop_finishes_queued_requests_and_refuses_new_ones(recording):
+    batcher = MicroBatcher(recording, max_batch_size=2, max_wait=0.0)
+    futures = [batcher.submit_async(i) for i in range(6)]
+    batcher.stop()
+    assert [future.result(timeout=0) for future in futures] == [f'result of {i}' for i in range(6)]
+    with pytest.raises(RuntimeError):
+        batcher.submit_async(6)
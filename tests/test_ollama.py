@@ -0,0 +1,143 @@
+import asyncio
+import importlib.util
+import os
+import sys
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip('flask')
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CAPTION = 'A fake caption of a fake image, streamed one word at a time.'
+
+
+class FakeAsyncClient:
+    # Stands in for ollama.AsyncClient: answers every chat with CAPTION, a word per part when streamed.
+    def __init__(self, host: str = None, delay: float = 0.0):
+        self.delay = delay
+        self.active = 0 # Chats in flight, and the most there ever were.
+        self.max_active = 0
+        self.parts = 0 # Stream parts sent, and streams closed.
+        self.closed = 0
+
+    def _start(self):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+
+    async def chat(self, model: str, messages: list, keep_alive=None, stream: bool = False):
+        if stream:
+            return self._stream()
+        self._start()
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+        return {'message': {'content': CAPTION}, 'done': True, 'eval_count': 12, 'eval_duration': 10**8}
+
+    async def _stream(self):
+        self._start()
+        try:
+            words = CAPTION.split(' ')
+            for i, word in enumerate(words):
+                await asyncio.sleep(self.delay)
+                self.parts += 1
+                last = i == len(words) - 1
+                yield {'message': {'content': word if last else word + ' '}, 'done': last}
+        finally:
+            self.active -= 1
+            self.closed += 1
+
+
+def load_ollama_api():
+    # Loaded with a fake ollama package, the real one talks to an Ollama server.
+    fake = types.ModuleType('ollama')
+    fake.AsyncClient = FakeAsyncClient
+    previous = sys.modules.get('ollama')
+    sys.modules['ollama'] = fake
+    try:
+        spec = importlib.util.spec_from_file_location('ollama_api', os.path.join(ROOT, 'api_providers', 'ollama_api.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    finally:
+        if previous is None:
+            del sys.modules['ollama']
+        else:
+            sys.modules['ollama'] = previous
+
+
+ollama_api = load_ollama_api()
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = str(tmp_path / 'image.png')
+    Image.new('RGB', (64, 48)).save(path)
+    return path
+
+
+@pytest.fixture
+def make_backend(monkeypatch):
+    # make_backend(delay, num_parallel) -> (backend, fake client), the backend the Flask routes use.
+    backends = []
+
+    def make(delay: float = 0.0, num_parallel: int = 4):
+        backend = ollama_api.OllamaBackend(model='fake-model', num_parallel=num_parallel)
+        backend.client = FakeAsyncClient(delay=delay)
+        monkeypatch.setattr(ollama_api, 'backend', backend, raising=False)
+        backends.append(backend)
+        return backend, backend.client
+
+    yield make
+    for backend in backends:
+        backend.loop.call_soon_threadsafe(backend.loop.stop)
+
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_caption(make_backend, image_path):
+    make_backend()
+    response = ollama_api.app.test_client().post('/caption', json={'prompt': 'Describe it.', 'image': image_path})
+    assert response.status_code == 200
+    assert response.json == {'caption': CAPTION}
+
+
+def test_stream(make_backend, image_path):
+    _, client = make_backend(delay=0.01)
+    response = ollama_api.app.test_client().post('/caption', json={'prompt': 'Describe it.', 'image': image_path, 'stream': True})
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    assert response.get_data(as_text=True) == CAPTION
+    wait_for(lambda: client.closed == 1)
+
+
+def test_chats_in_flight_are_capped_at_num_parallel(make_backend, image_path):
+    backend, client = make_backend(delay=0.05, num_parallel=2)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        captions = list(executor.map(lambda _: ollama_api.perform_caption('Describe it.', image_path), range(8)))
+    assert captions == [CAPTION] * 8
+    assert client.max_active == 2
+    assert backend.waiting == 0
+
+
+def test_disconnect_mid_stream_releases_the_slot(make_backend, image_path):
+    backend, client = make_backend(delay=0.05, num_parallel=1)
+    response = ollama_api.app.test_client().post('/caption', json={'prompt': 'Describe it.', 'image': image_path, 'stream': True},
+                                                 buffered=False)
+    assert next(iter(response.response)) # The first word, then the client goes away.
+    response.close()
+
+    wait_for(lambda: client.closed == 1)
+    assert client.parts < len(CAPTION.split(' '))
+    # The only slot is free again: the next chat doesn't wait for the abandoned stream.
+    messages = backend.build_messages('Describe it.', image_path)
+    assert backend.run(backend.caption(messages), timeout=5) == CAPTION
@@ -0,0 +1,117 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+
+from prefix_cache import PrefixCache
+
+GREEDY = dict(max_new_tokens=8, do_sample=False, pad_token_id=0)
+
+
+def left_pad(rows: list) -> dict:
+    length = max(len(row) for row in rows)
+    input_ids = torch.zeros(len(rows), length, dtype=torch.long)
+    attention_mask = torch.zeros(len(rows), length, dtype=torch.long)
+    for i, row in enumerate(rows):
+        input_ids[i, length - len(row):] = row
+        attention_mask[i, length - len(row):] = 1
+    return {'input_ids': input_ids, 'attention_mask': attention_mask}
+
+
+def assert_same_generations(model, prefix_cache, batches, prefix_ids):
+    # All the cached generates run one after the other, so state a generate leaves on the model shows in the next one.
+    with torch.no_grad():
+        expected = [model.generate(**inputs, **GREEDY) for inputs in batches]
+        cached = [prefix_cache.generate(inputs, prefix_ids, **GREEDY) for inputs in batches]
+    for inputs, expected_ids, cached_ids in zip(batches, expected, cached):
+        length = inputs['input_ids'].shape[1]
+        assert torch.equal(expected_ids[:, length:], cached_ids[:, length:])
+
+
+@pytest.fixture(scope='module')
+def llama():
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(vocab_size=200, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                                      num_attention_heads=4, num_key_value_heads=2, pad_token_id=0, bos_token_id=1,
+                                      eos_token_id=2)
+    return transformers.LlamaForCausalLM(config).eval()
+
+
+PREFIX = torch.tensor([1, 5, 10, 11, 12, 13, 14, 15, 16])
+
+
+def test_text_model_generations_are_unchanged(llama):
+    batches = [left_pad([torch.cat([PREFIX, torch.arange(20, 20 + n)]) for n in lengths]) for lengths in ([3, 7, 1], [5], [2, 2])]
+    # Twice: a miss, then hits on the cached prefix.
+    assert_same_generations(llama, PrefixCache(llama), batches + batches, PREFIX)
+
+
+def test_rows_without_the_prefix_bypass_the_cache(llama):
+    inputs = left_pad([torch.cat([PREFIX, torch.tensor([20, 21])]), torch.tensor([1, 30, 31, 32])])
+    assert_same_generations(llama, PrefixCache(llama), [inputs], PREFIX)
+
+
+def test_disabled_cache_is_plain_generate(llama):
+    prefix_cache = PrefixCache(llama, enabled=False)
+    assert_same_generations(llama, prefix_cache, [left_pad([torch.cat([PREFIX, torch.tensor([20])])])], PREFIX)
+    assert not prefix_cache._entries
+
+
+class LegacyCacheModel(torch.nn.Module):
+    # Stands in for remote code returning past_key_values as ((key, value), ...) per layer, like Phi-3.5-vision's.
+    def __init__(self, model):
+        super().__init__()
+        self.inner = model
+
+    @property
+    def device(self):
+        return self.inner.device
+
+    def forward(self, **kwargs):
+        outputs = self.inner(**kwargs)
+        outputs.past_key_values = tuple((layer.keys, layer.values) for layer in outputs.past_key_values.layers)
+        return outputs
+
+    def generate(self, **kwargs):
+        return self.inner.generate(**kwargs)
+
+
+def test_legacy_tuple_cache_is_wrapped(llama):
+    batches = [left_pad([torch.cat([PREFIX, torch.arange(20, 20 + n)]) for n in (4, 1, 6)])]
+    assert_same_generations(llama, PrefixCache(LegacyCacheModel(llama)), batches + batches, PREFIX)
+
+
+IMAGE, VISION_START, VISION_END = 90, 92, 93
+
+
+@pytest.fixture(scope='module')
+def qwen2_vl():
+    torch.manual_seed(0)
+    config = transformers.Qwen2VLConfig(
+        text_config=dict(vocab_size=128, hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4,
+                         num_key_value_heads=2, rope_scaling={'type': 'mrope', 'mrope_section': [2, 3, 3]},
+                         pad_token_id=0, eos_token_id=1),
+        vision_config=dict(depth=1, embed_dim=32, hidden_size=64, num_heads=2, patch_size=2, spatial_merge_size=2,
+                           temporal_patch_size=2, in_channels=3),
+        image_token_id=IMAGE, video_token_id=91, vision_start_token_id=VISION_START, vision_end_token_id=VISION_END,
+        pad_token_id=0, eos_token_id=1)
+    return transformers.Qwen2VLForConditionalGeneration(config).eval()
+
+
+def vl_batch(texts: list, grid: int = 4) -> dict:
+    # [prefix][image][text] rows. A grid x grid patch image is (grid / 2) ** 2 tokens after the 2x2 merge.
+    tokens = (grid // 2) ** 2
+    inputs = left_pad([torch.cat([PREFIX[1:], torch.tensor([VISION_START] + [IMAGE] * tokens + [VISION_END] + text)])
+                       for text in texts])
+    inputs['mm_token_type_ids'] = (inputs['input_ids'] == IMAGE).long()
+    inputs['pixel_values'] = torch.randn(len(texts) * grid * grid, 3 * 2 * 2 * 2)
+    inputs['image_grid_thw'] = torch.tensor([[1, grid, grid]] * len(texts))
+    return inputs
+
+
+def test_qwen2_vl_generations_are_unchanged(qwen2_vl):
+    torch.manual_seed(1)
+    batches = [vl_batch([[20, 21, 22], [30, 31, 32, 33, 34, 35, 36], [40]]), vl_batch([[50, 51]]),
+               vl_batch([[60], [61, 62]], grid=8)]
+    # Back and forth between batch and image sizes, so stale rope offsets of the previous batch would show.
+    assert_same_generations(qwen2_vl, PrefixCache(qwen2_vl), batches + batches[::-1], PREFIX[1:])
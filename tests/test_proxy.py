@@ -0,0 +1,110 @@
+import asyncio
+import importlib.util
+import json
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('aiohttp')
+from aiohttp import ClientSession
+from aiohttp.test_utils import TestServer
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import fake_openai_upstream
+
+
+def load_proxy_module():
+    # The file name isn't a valid module name.
+    spec = importlib.util.spec_from_file_location('openai_proxy', os.path.join(ROOT, 'api_providers', 'openai-competiable-api.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+proxy_module = load_proxy_module()
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = str(tmp_path / 'image.png')
+    Image.new('RGB', (64, 48)).save(path)
+    return path
+
+
+async def caption(upstream_app, request: dict, retries: int = 5):
+    # Runs the upstream and the proxy, sends one /caption request. Returns (status, content type, body, upstream stats).
+    upstream = TestServer(upstream_app)
+    await upstream.start_server()
+    config = {'backends': {'fake': {'url': str(upstream.make_url('/v1/chat/completions')), 'model': 'fake-model'}}}
+    proxy = TestServer(proxy_module.create_app(proxy_module.Proxy(config, retries=retries, backoff_factor=0.01)))
+    await proxy.start_server()
+    try:
+        async with ClientSession() as session:
+            async with session.post(proxy.make_url('/caption'), json=request) as response:
+                body = await response.text()
+                result = response.status, response.content_type, body
+            async with session.get(upstream.make_url('/stats')) as response:
+                return (*result, await response.json())
+    finally:
+        await proxy.close()
+        await upstream.close()
+
+
+def rate_limit_first(monkeypatch, count: int):
+    # The fake upstream answers 429 when random.random() < rate_limit_rate: the first `count` requests get one.
+    draws = iter([0.0] * count)
+    monkeypatch.setattr(fake_openai_upstream.random, 'random', lambda: next(draws, 1.0))
+
+
+def test_caption(image_path):
+    status, _, body, stats = asyncio.run(caption(fake_openai_upstream.create_app(latency=0.0, jitter=0.0),
+                                                 {'prompt': 'Describe it.', 'image': image_path}))
+    assert status == 200
+    assert json.loads(body) == {'caption': 'A fake caption from fake-model, asked: Describe it.'}
+    assert stats['requests'] == 1
+
+
+def test_rate_limited_request_is_retried(image_path, monkeypatch):
+    rate_limit_first(monkeypatch, 1)
+    app = fake_openai_upstream.create_app(latency=0.0, jitter=0.0, rate_limit_rate=0.5)
+    status, _, body, stats = asyncio.run(caption(app, {'prompt': 'Describe it.', 'image': image_path}))
+    assert status == 200
+    assert 'A fake caption' in body
+    assert (stats['requests'], stats['rate_limited']) == (2, 1)
+
+
+def test_rate_limit_is_passed_on_once_retries_are_exhausted(image_path, monkeypatch):
+    rate_limit_first(monkeypatch, 2)
+    app = fake_openai_upstream.create_app(latency=0.0, jitter=0.0, rate_limit_rate=0.5)
+    status, _, body, stats = asyncio.run(caption(app, {'prompt': 'Describe it.', 'image': image_path}, retries=1))
+    assert status == 429
+    assert 'Rate limit reached.' in body
+    assert (stats['requests'], stats['rate_limited']) == (2, 2)
+
+
+def test_retries_are_charged_to_the_token_budget_once(image_path, monkeypatch):
+    rate_limit_first(monkeypatch, 2)
+    charged = []
+    acquire = proxy_module.RateLimiter.acquire
+
+    async def recording_acquire(self, tokens=0):
+        charged.append(tokens)
+        await acquire(self, tokens)
+
+    monkeypatch.setattr(proxy_module.RateLimiter, 'acquire', recording_acquire)
+    app = fake_openai_upstream.create_app(latency=0.0, jitter=0.0, rate_limit_rate=0.5)
+    status, _, _, stats = asyncio.run(caption(app, {'prompt': 'Describe it.', 'image': image_path}))
+    assert status == 200
+    assert stats['requests'] == 3
+    assert len(charged) == 3 and charged[0] > 0 and charged[1:] == [0, 0]
+
+
+def test_stream_passes_the_caption_through_as_text(image_path):
+    app = fake_openai_upstream.create_app(latency=0.1, jitter=0.0)
+    status, content_type, body, _ = asyncio.run(caption(app, {'prompt': 'Describe it.', 'image': image_path, 'stream': True}))
+    assert status == 200
+    assert content_type == 'text/plain'
+    assert body == 'A fake caption from fake-model, asked: Describe it.'
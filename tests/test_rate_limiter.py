@@ -0,0 +1,105 @@
+import asyncio
+import base64
+import io
+import time
+
+import pytest
+from PIL import Image
+
+from rate_limiter import RateLimiter, TokenBucket, image_tokens
+
+
+def elapse(bucket: TokenBucket, seconds: float):
+    # As if `seconds` had passed since the bucket was last refilled.
+    bucket.updated -= seconds
+
+
+def test_bucket_refills_at_its_rate_up_to_its_capacity():
+    bucket = TokenBucket(60) # One per second.
+    bucket.consume(60)
+    assert bucket.wait_time(30) == pytest.approx(30, abs=0.1)
+
+    elapse(bucket, 10)
+    assert bucket.wait_time(30) == pytest.approx(20, abs=0.1)
+    # Larger than the bucket: only waits for a full one.
+    assert bucket.wait_time(1000) == pytest.approx(50, abs=0.1)
+
+    elapse(bucket, 600)
+    bucket.refill()
+    assert bucket.level == 60
+    assert bucket.wait_time(60) == 0
+
+
+def test_consume_can_go_into_debt():
+    bucket = TokenBucket(60)
+    bucket.consume(90)
+    assert bucket.wait_time(1) == pytest.approx(31, abs=0.1)
+
+
+def data_url(width: int, height: int) -> str:
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height)).save(buffer, format='PNG')
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+
+def test_estimate():
+    limiter = RateLimiter(tpm=100000, expected_completion_tokens=300)
+    assert limiter.estimate('x' * 41) == 11 + 300
+    assert limiter.estimate('x' * 40, max_tokens=100) == 10 + 100
+    assert limiter.estimate('x' * 40, image_size=(512, 512)) == 10 + image_tokens(512, 512) + 300
+    # The size is read from the image header.
+    assert limiter.estimate('', data_url(100, 50)) == image_tokens(100, 50) + 300
+
+
+def test_image_tokens():
+    assert image_tokens(512, 512) == 85 + 170 # Never upscaled.
+    assert image_tokens(4096, 1024) == 85 + 170 * 4 # Fit in 2048x2048: 2048x512.
+    assert image_tokens(4096, 3072) == 85 + 170 * 4 # 2048x1536, then the shortest side to 768: 1024x768.
+    assert image_tokens(4096, 4096, detail='low') == 85
+
+
+def test_record_usage_corrects_the_estimate():
+    limiter = RateLimiter(tpm=6000, expected_completion_tokens=300)
+    limiter.tokens.consume(1000)
+    limiter.record_usage(1000, {'completion_tokens': 800, 'total_tokens': 1500})
+    assert limiter.tokens.level == pytest.approx(4500, abs=1)
+    assert limiter.completion_tokens == pytest.approx(0.8 * 300 + 0.2 * 800)
+
+
+def test_headers_adapt_the_buckets():
+    limiter = RateLimiter(rpm=100)
+    limiter.update_from_headers({'x-ratelimit-limit-requests': '500', 'x-ratelimit-remaining-requests': '20',
+                                 'x-ratelimit-limit-tokens': '10000', 'x-ratelimit-remaining-tokens': '3000'})
+    # A wrong configured quota is corrected, a missing one is taken from the server.
+    assert limiter.requests.capacity == 500
+    assert limiter.tokens.capacity == 10000
+    # The remaining budget is never assumed larger than the server's.
+    assert limiter.requests.level <= 20
+    assert limiter.tokens.level <= 3000
+    assert limiter._paused_until == 0.0
+
+
+def test_an_exhausted_budget_pauses_until_its_reset():
+    limiter = RateLimiter(rpm=6000)
+    limiter.update_from_headers({'x-ratelimit-remaining-requests': '0', 'x-ratelimit-reset-requests': '200ms'})
+    start = time.monotonic()
+    asyncio.run(limiter.acquire())
+    assert time.monotonic() - start >= 0.19
+
+
+def test_a_429_pauses_every_request():
+    limiter = RateLimiter(rpm=6000, tpm=600000)
+    limiter.on_rate_limited(retry_after=0.2)
+    assert limiter.tokens.level <= 0
+
+    async def acquire_all():
+        start = time.monotonic()
+
+        async def acquire():
+            await limiter.acquire(10)
+            return time.monotonic() - start
+
+        return await asyncio.gather(*(acquire() for _ in range(3)))
+
+    assert all(waited >= 0.19 for waited in asyncio.run(acquire_all()))
+
@@ -0,0 +1,130 @@
+from multiprocessing import resource_tracker, shared_memory
+from urllib.parse import parse_qs, urlparse
+
+from image_utils import read_image_bytes
+
+
+'''
+How the image of a /caption request gets to the provider.
+
+- json:      {"prompt": ..., "image": path or data url, "system": optional}. A path only works if the client and the server share a disk,
+             a data url costs 33% more bytes and a json parse of megabytes.
+- multipart: multipart/form-data with a `prompt` field and the raw image bytes as the `image` file. No base64, and the
+             server doesn't need access to the client's disk, so the captioner can run on another machine.
+- shm:       client and server on the same host. The client puts the image bytes in a shared memory block and sends
+             {"prompt": ..., "image": "shm://<block name>?size=<bytes>"}. The server reads the image straight from the
+             block, nothing goes through the socket but the small json. The client frees the block after the response.
+
+Providers: data = read_caption_request(request) (Flask) or await read_caption_request_async(request) (aiohttp).
+data["image"] is then a path, a data url or the image bytes, all of which image_utils.load_image opens.
+Captioner: post_caption(client, prompt, image, transport).
+'''
+
+TRANSPORTS = ('json', 'multipart', 'shm')
+SHM_SCHEME = 'shm://'
+_created = set() # Blocks created by this process (client and server can be one process, e.g. in the benchmarks).
+
+
+def is_shm_url(image) -> bool:
+    return isinstance(image, str) and image.startswith(SHM_SCHEME)
+
+
+class SharedImage:
+    # Client side: the image bytes in a shared memory block, freed on close().
+    def __init__(self, data: bytes):
+        self._shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+        self._shm.buf[:len(data)] = data
+        self.url = f'{SHM_SCHEME}{self._shm.name}?size={len(data)}'
+        _created.add(self._shm.name)
+
+    def close(self):
+        _created.discard(self._shm.name)
+        self._shm.close()
+        self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    # The server only reads the block, the client owns it. Don't let this process' resource tracker unlink it at exit.
+    try:
+        return shared_memory.SharedMemory(name=name, track=False) # Python 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        if name not in _created:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def read_shared(url: str) -> bytes:
+    parsed = urlparse(url)
+    size = int(parse_qs(parsed.query)['size'][0])
+    shm = _attach(parsed.netloc)
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+
+
+def resolve_image(image):
+    # A shm:// url becomes the image bytes. Paths and data urls are left to load_image.
+    if is_shm_url(image):
+        return read_shared(image)
+    return image
+
+
+def _parse_form(fields: dict) -> dict:
+    # Form fields are strings. Only "stream" is a flag.
+    data = dict(fields)
+    if 'stream' in data:
+        data['stream'] = str(data['stream']).lower() in ('1', 'true', 'yes')
+    return data
+
+
+def read_caption_request(request) -> dict:
+    # A Flask request to /caption, in any transport -> {"prompt": ..., "image": ..., other fields}.
+    if request.files:
+        data = _parse_form(request.form.to_dict())
+        data['image'] = request.files['image'].read()
+        return data
+    data = request.get_json()
+    data['image'] = resolve_image(data.get('image'))
+    return data
+
+
+async def read_caption_request_async(request) -> dict:
+    # read_caption_request for an aiohttp request.
+    if request.content_type.startswith('multipart/'):
+        form = await request.post()
+        data = _parse_form({key: value for key, value in form.items() if key != 'image'})
+        data['image'] = form['image'].file.read()
+        return data
+    data = await request.json()
+    data['image'] = resolve_image(data.get('image'))
+    return data
+
+
+def post_caption(client, prompt: str, image, transport: str = 'json', mime: str = None, system: str = None) -> dict:
+    '''
+    client: http_client.HTTPClient or load_balancer.LoadBalancer.
+    image: A path or data url for 'json'. For 'multipart' and 'shm' also bytes, or anything read_image_bytes reads.
+    mime: The mime type of the image bytes, if known.
+    system: The system turn, sent before the image (see prompts.split_prompt). Only sent if set.
+    '''
+    fields = {"prompt": prompt}
+    if system is not None:
+        fields["system"] = system
+    if transport == 'json':
+        return client.post_json({**fields, "image": image})
+
+    data = read_image_bytes(image)
+    if transport == 'multipart':
+        return client.post(data=fields, files={"image": ("image", data, mime or 'application/octet-stream')}).json()
+    if transport == 'shm':
+        with SharedImage(data) as shared:
+            return client.post_json({**fields, "image": shared.url})
+    raise ValueError(f'Unknown transport {transport}, use one of {", ".join(TRANSPORTS)}.')
@@ -0,0 +1,108 @@
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from image_utils import read_image_size
+from metrics import timed
+
+
+'''
+Visual token budget of Qwen2-VL, and resolution bucketing of the captioner's jobs.
+
+Qwen2-VL takes images at (almost) any resolution: one visual token per 28x28 pixels (14x14 patches, merged 2x2).
+Left alone, a large image costs thousands of tokens, so a few of them dominate the latency and the memory of a batch.
+With a budget, every image is resized (aspect ratio kept, sides multiples of 28) to between min_pixels and max_pixels,
+i.e. between min_pixels / 784 and max_pixels / 784 visual tokens. The token count of an image is then known before
+it's sent, from its size alone.
+
+The provider resizes every image to the budget (fit_to_budget). The captioner can reorder its jobs so that images with
+a similar token count are dispatched together (bucket_jobs), so the provider's batches pad less.
+'''
+
+PATCH_SIZE = 14
+MERGE_SIZE = 2
+FACTOR = PATCH_SIZE * MERGE_SIZE # Pixels per side of one visual token.
+DEFAULT_MIN_PIXELS = 256 * FACTOR * FACTOR
+DEFAULT_MAX_PIXELS = 1024 * FACTOR * FACTOR
+
+
+def smart_resize(width: int, height: int, min_pixels: int = DEFAULT_MIN_PIXELS, max_pixels: int = DEFAULT_MAX_PIXELS,
+                 factor: int = FACTOR) -> tuple:
+    '''
+    The size Qwen2-VL's preprocessing resizes an image to: sides rounded to multiples of `factor`, then scaled (aspect
+    ratio kept) into [min_pixels, max_pixels]. Same rounding as qwen_vl_utils.smart_resize, but (width, height) like PIL.
+    '''
+    new_width = max(factor, round(width / factor) * factor)
+    new_height = max(factor, round(height / factor) * factor)
+    if new_width * new_height > max_pixels:
+        beta = math.sqrt(width * height / max_pixels)
+        new_width = max(factor, math.floor(width / beta / factor) * factor)
+        new_height = max(factor, math.floor(height / beta / factor) * factor)
+    elif new_width * new_height < min_pixels:
+        beta = math.sqrt(min_pixels / (width * height))
+        new_width = math.ceil(width * beta / factor) * factor
+        new_height = math.ceil(height * beta / factor) * factor
+    return new_width, new_height
+
+
+def visual_tokens(width: int, height: int, min_pixels: int = DEFAULT_MIN_PIXELS, max_pixels: int = DEFAULT_MAX_PIXELS) -> int:
+    new_width, new_height = smart_resize(width, height, min_pixels, max_pixels)
+    return (new_width // FACTOR) * (new_height // FACTOR)
+
+
+def fit_to_budget(img: Image.Image, min_pixels: int = DEFAULT_MIN_PIXELS, max_pixels: int = DEFAULT_MAX_PIXELS,
+                  reducing_gap: float = 2.0) -> Image.Image:
+    '''
+    Resize an opened (not yet decoded) image to its smart_resize size. A large JPEG is shrunk while decoding (draft),
+    like image_utils.load_image does.
+    '''
+    size = smart_resize(*img.size, min_pixels, max_pixels)
+    if size == img.size:
+        return img
+    if size[0] * size[1] >= img.size[0] * img.size[1]:
+        return img.resize(size, Image.BICUBIC)
+    img.draft(None, (int(size[0] * reducing_gap), int(size[1] * reducing_gap)))
+    return img.resize(size, Image.BICUBIC, reducing_gap=reducing_gap)
+
+
+def sent_size(width: int, height: int, max_size: int = None) -> tuple:
+    # The size of an image shrunk to a long side of at most max_size, like image_utils.load_image does (give or take
+    # a pixel of rounding) before an image is sent encoded.
+    if not max_size or max(width, height) <= max_size:
+        return width, height
+    scale = max_size / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def bucket_jobs(jobs, window: int = 256, min_pixels: int = DEFAULT_MIN_PIXELS, max_pixels: int = DEFAULT_MAX_PIXELS,
+                max_size: int = None, workers: int = 16):
+    '''
+    Reorders jobs (tuples whose first item is the image) `window` at a time, by their visual token count, so the
+    requests in flight at the same time (and so the provider's batches) have similar token counts.
+    max_size: The long side the images are shrunk to before they are sent (pre-encoded), None if they're sent as they are.
+              The tokens are counted from the size the server gets.
+    workers: Threads reading the image headers of a window (only the headers are read, the pixels aren't decoded).
+    An image that can't be read counts as 0 tokens, and fails later as usual.
+    '''
+    def tokens_of(job):
+        try:
+            return visual_tokens(*sent_size(*read_image_size(job[0]), max_size), min_pixels, max_pixels)
+        except Exception:
+            return 0
+
+    def flush(pending):
+        with timed('bucket'):
+            tokens = list(executor.map(tokens_of, pending))
+        order = sorted(range(len(pending)), key=tokens.__getitem__)
+        for i in order:
+            yield pending[i]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for job in jobs:
+            pending.append(job)
+            if len(pending) >= window:
+                yield from flush(pending)
+                pending = []
+        yield from flush(pending)